@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Pedestrian storage and pedestrian sources.
+
+AgentPool keeps the pedestrians in arrays of slots that grow with the number of pedestrians, not with the grid.
+A slot freed by a pedestrian that leaves the system goes on a stack of free slots and is handed to a later pedestrian
+that enters, so long runs with pedestrians coming and going never allocate per pedestrian. The pool also keeps
+the order the update modes process the pedestrians in.
+
+A Source spawns pedestrians on the free cells of a rectangle at a fixed rate, see System.sources.
+"""
+import numpy as np
+
+INITIAL_CAPACITY = 1024  # Slots of a new pool, it doubles whenever they are all taken
+
+
+class PoolFull(Exception):
+    """
+    Raised when a pedestrian is added to an AgentPool that holds its limit of pedestrians.
+    """
+
+
+class AgentPool:
+    """
+    Struct of arrays with one slot per pedestrian: the flat grid index of its cell, its speed,
+    the lowest target distance it has reached, which System.step uses to tell progress from pacing back and forth,
+    and its id. slot_at maps every cell to the slot of the pedestrian on it, so pedestrians are found and removed
+    in O(1). Slots are reused, ids are not: every pedestrian added gets the next id, so ids identify pedestrians
+    over a whole run, e.g. in a recorder.TrajectoryRecorder file.
+    :param cells: number of cells of the grid
+    :param limit: most pedestrians the pool holds, by default one per cell, which a grid can never exceed
+    """
+
+    def __init__(self, cells, limit=None):
+        self.limit = cells if limit is None else limit
+        self.capacity = 0  # Allocated slots, grown by grow
+        self.index = np.zeros(0, dtype=np.intp)
+        self.speed = np.zeros(0, dtype=np.double)
+        self.alive = np.zeros(0, dtype=bool)
+        self.closest = np.zeros(0)  # Lowest target distance each pedestrian has reached so far
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.next_id = 0
+        self.slot_at = np.full(cells, -1, dtype=np.intp)
+        # Stack of free slots in free[:free_count]: freed slots are reused last in first out,
+        # slots added by grow are handed out lowest first
+        self.free = np.zeros(0, dtype=np.intp)
+        self.free_count = 0
+        self.count = 0  # Pedestrians in the pool
+        self.order = np.zeros(0, dtype=np.intp)  # Slots of the pedestrians in processing order
+        self.added = []  # Slots added since order was last built, they go to its end
+        self.released = []  # Slots removed since order was last built, they are freed once it is
+        self.grow(min(self.limit, INITIAL_CAPACITY))
+
+    def __len__(self):
+        return self.count
+
+    def vacancies(self):
+        """
+        Returns how many more pedestrians the pool can hold.
+        :return:
+        """
+        return self.limit - self.count
+
+    def grow(self, capacity):
+        """
+        Allocates slots up to the given capacity, the new slots go on top of the free stack.
+        :param capacity:
+        :return:
+        """
+        added = capacity - self.capacity
+        if added <= 0:
+            return
+        self.index = np.concatenate([self.index, np.zeros(added, dtype=np.intp)])
+        self.speed = np.concatenate([self.speed, np.ones(added)])
+        self.alive = np.concatenate([self.alive, np.zeros(added, dtype=bool)])
+        self.closest = np.concatenate([self.closest, np.full(added, np.inf)])
+        self.ids = np.concatenate([self.ids, np.zeros(added, dtype=np.int64)])
+        free = np.empty(capacity, dtype=np.intp)
+        free[:self.free_count] = self.free[:self.free_count]
+        free[self.free_count:self.free_count + added] = np.arange(capacity - 1, self.capacity - 1, -1)
+        self.free = free
+        self.free_count += added
+        self.capacity = capacity
+
+    def active(self):
+        """
+        Returns the slots of all pedestrians in processing order.
+        :return: integer array
+        """
+        if self.added:
+            self.order = np.concatenate([self.order, np.array(self.added, dtype=np.intp)])
+            self.added.clear()
+        if self.released:
+            self.order = self.order[self.alive[self.order]]
+            released = np.array(self.released, dtype=np.intp)
+            self.free[self.free_count:self.free_count + len(released)] = released
+            self.free_count += len(released)
+            self.released.clear()
+        return self.order
+
+    def add(self, index, speed=1.0):
+        """
+        Puts a pedestrian on the cell with the given flat index, at the end of the processing order.
+        :param index: flat grid index
+        :param speed:
+        :return: slot of the pedestrian
+        """
+        if not self.free_count and self.released:
+            self.active()
+        if not self.free_count:
+            if self.capacity >= self.limit:
+                raise PoolFull("All " + str(self.limit) + " pedestrian slots are taken")
+            self.grow(min(self.limit, max(2 * self.capacity, 1)))
+        self.free_count -= 1
+        slot = int(self.free[self.free_count])
+        self.index[slot] = index
+        self.speed[slot] = speed
+        self.alive[slot] = True
+        self.closest[slot] = np.inf
+        self.ids[slot] = self.next_id
+        self.next_id += 1
+        self.slot_at[index] = slot
+        self.count += 1
+        self.added.append(slot)
+        return slot
+
+    def remove(self, slots):
+        """
+        Takes the pedestrians in the given slots out of the system. Their slots leave the processing order
+        and become free the next time it is built, so removing costs O(len(slots)).
+        :param slots: integer array
+        :return:
+        """
+        if not len(slots):
+            return
+        self.slot_at[self.index[slots]] = -1
+        self.alive[slots] = False
+        self.count -= len(slots)
+        self.released.extend(np.asarray(slots).tolist())
+
+    def move(self, slots, indices):
+        """
+        Moves the pedestrians in the given slots to the cells with the given flat indices.
+        :param slots: integer array
+        :param indices: integer array
+        :return:
+        """
+        self.slot_at[self.index[slots]] = -1
+        self.slot_at[indices] = slots
+        self.index[slots] = indices
+
+    def reorder(self, order):
+        """
+        Replaces the processing order.
+        :param order: all slots returned by active, in their new order
+        :return:
+        """
+        self.active()
+        self.order = order
+
+    def clear(self):
+        self.slot_at[self.index[self.active()]] = -1
+        self.alive[:] = False
+        self.free[:] = np.arange(self.capacity - 1, -1, -1)
+        self.free_count = self.capacity
+        self.count = 0
+        self.order = np.zeros(0, dtype=np.intp)
+
+
+class Source:
+    """
+    Spawns pedestrians on the empty cells of a rectangle.
+    Every step adds rate to a credit and as many whole pedestrians as the credit holds are spawned on free cells
+    chosen at random, pedestrians that find no free cell wait for a later step.
+    :param row: top row of the rectangle
+    :param col: left col of the rectangle
+    :param height:
+    :param width:
+    :param rate: pedestrians per step, may be fractional
+    :param speed: speed of the spawned pedestrians
+    :param total: number of pedestrians after which the source stops, None for no limit
+    :param seed: seed of the cell choice
+    """
+
+    def __init__(self, row, col, height, width, rate, speed=1.0, total=None, seed=0):
+        self.rectangle = (row, col, height, width)
+        self.rate = rate
+        self.speed = speed
+        self.total = total
+        self.rng = np.random.default_rng(seed)
+        self.credit = 0.0
+        self.spawned = 0
+
+    def is_exhausted(self):
+        return self.total is not None and self.spawned >= self.total
+
+    def take_cells(self, state, empty, slots):
+        """
+        Advances the source by one step and chooses the cells to spawn on.
+        :param state: (rows, cols) state code array
+        :param empty: state code of the free cells
+        :param slots: number of free pedestrian slots
+        :return: sorted flat grid indices of the cells to spawn pedestrians on
+        """
+        if self.is_exhausted():
+            return np.zeros(0, dtype=np.intp)
+        self.credit += self.rate
+        count = int(self.credit)
+        if self.total is not None:
+            count = min(count, self.total - self.spawned)
+        row, col, height, width = self.rectangle
+        rows, cols = np.nonzero(state[row:row + height, col:col + width] == empty)
+        free = (rows + row) * state.shape[1] + cols + col
+        count = min(count, len(free), slots)
+        if count < len(free):
+            free = np.sort(self.rng.choice(free, count, replace=False))
+        self.credit -= count
+        self.spawned += count
+        return free
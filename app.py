@@ -1,51 +1,122 @@
 import wx
+import argparse
+import logging
+import numpy as np
 import model as model
-import json
 import os
+import threading
+import time
+from collections import namedtuple
+from scenario import initialize_system
+from replay import FrameReader, FrameWriter, FRAMES_EXTENSION
 
+FRAME_INTERVAL_MS = 30  # How often the canvas looks for a new snapshot
+DEFAULT_STEPS_PER_SECOND = 10
+WILDCARD = "Scenarios and recordings (*.json;*{0})|*.json;*{0}".format(FRAMES_EXTENSION)
 
-def initialize_system(file_name):
+Snapshot = namedtuple('Snapshot', ['step', 'state', 'finished'])
+
+
+class SimulationWorker(threading.Thread):
     """
-    Reads the scenario file and initializes the system.
-    :param file_name:
-    :return:
+    Advances the system on a background thread so a slow step never blocks the GUI.
+    After every step it publishes an immutable Snapshot of the grid state; only the latest
+    snapshot is kept, so the canvas skips frames when the simulation is faster than the display.
+    Only this thread touches the system once it has started.
     """
-    with open(file_name) as scenario:
-        data = json.load(scenario)
-    cols = data['cols']
-    rows = data['rows']
-    system = model.System(cols, rows)
+    def __init__(self, system, mode, steps_per_second=DEFAULT_STEPS_PER_SECOND):
+        super(SimulationWorker, self).__init__(daemon=True)
+        self.system = system
+        self.mode = mode
+        self.steps_per_second = steps_per_second
+        self.step_count = 0
+        self.error = None
+        self.playing = threading.Event()
+        self.stopped = threading.Event()
+        self.wake = threading.Event()
+        self.lock = threading.Lock()
+        self.pending_steps = 0  # Single steps requested while paused
+        self.snapshot = None
 
-    for col, row in data['pedestrians']:
-        system.add_pedestrian_at(coordinates=(col, row))
+    def play(self):
+        self.playing.set()
+        self.wake.set()
 
-    if 'speeds' in data:
-        system.initialize_speeds(data["speeds"])
-    else:
-        system.initialize_speeds()
+    def pause(self):
+        self.playing.clear()
 
-    for col, row in data['obstacles']:
-        system.add_obstacle_at(coordinates=(col, row))
+    def request_step(self):
+        with self.lock:
+            self.pending_steps += 1
+        self.wake.set()
 
-    col, row = data['target']
-    system.add_target_at(coordinates=(col, row))
+    def stop(self):
+        self.playing.clear()
+        self.stopped.set()
+        self.wake.set()
 
-    if 'cell_size' in data:
-        cell_size = data["cell_size"]
-    else:
-        cell_size = 5
+    def take_snapshot(self):
+        """
+        Returns the latest snapshot not taken yet, or None.
+        :return:
+        """
+        with self.lock:
+            snapshot, self.snapshot = self.snapshot, None
+        return snapshot
+
+    def publish(self, finished):
+        state = self.system.state.copy()
+        state.setflags(write=False)
+        with self.lock:
+            self.snapshot = Snapshot(self.step_count, state, finished)
 
-    return system, cell_size
+    def run(self):
+        while not self.stopped.is_set():
+            with self.lock:
+                single_step = self.pending_steps > 0
+                if single_step:
+                    self.pending_steps -= 1
+            if not single_step and not self.playing.is_set():
+                self.wake.wait()
+                self.wake.clear()
+                continue
+
+            start = time.perf_counter()
+            try:
+                self.system.step(self.mode)
+            except Exception as error:
+                self.error = error
+                self.stop()
+                break
+            self.step_count += 1
+            finished = self.system.is_evacuated()
+            if finished:
+                self.pause()
+            self.publish(finished)
+
+            if self.playing.is_set():
+                delay = 1 / self.steps_per_second - (time.perf_counter() - start)
+                if delay > 0:
+                    self.stopped.wait(delay)
 
 
 class Frame(wx.Frame):
     """
     Main window that holds the canvas and button panel.
+    If frames_path is given, every step is recorded there for replay.
     """
-    def __init__(self, parent, system, cell_size):
+    def __init__(self, parent, system, cell_size, frames_path=None):
         wx.Frame.__init__(self, parent)
         self.system = system
         self.cell_size = cell_size
+        self.frame_writer = None
+        if frames_path is not None:
+            try:
+                self.frame_writer = FrameWriter(frames_path, system, cell_size)
+            except OSError as error:
+                wx.MessageBox("The run is not recorded: " + str(error), "Recording failed", wx.OK | wx.ICON_WARNING)
+            else:
+                self.system.step_hooks.append(self.frame_writer)  # Runs on the worker thread
 
         self.SetTitle("Cellular Automaton")
         self.SetSize(self.system.cols * self.cell_size, self.system.rows * self.cell_size + 50)
@@ -58,76 +129,244 @@ class Frame(wx.Frame):
         self.SetSizer(sizer_1)
         self.Layout()
 
+        self.worker = None
+        self.timer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.on_timer, self.timer)
+        self.Bind(wx.EVT_CLOSE, self.on_close)
+        self.timer.Start(FRAME_INTERVAL_MS)
+
+    def get_worker(self, mode):
+        """
+        Returns the simulation worker, starting it with the given mode on first use.
+        The mode cannot change afterwards.
+        :param mode:
+        :return:
+        """
+        if self.worker is None:
+            self.worker = SimulationWorker(self.system, mode, self.button_panel.rate.GetValue())
+            self.worker.start()
+            self.button_panel.lock_mode(mode)
+        return self.worker
+
+    def current_state(self):
+        # Only called before the worker starts, so the system can be read directly
+        return self.system.state
+
+    def on_timer(self, event):
+        """
+        Draws the latest snapshot published by the worker, if there is a new one.
+        :param event:
+        :return:
+        """
+        if self.worker is None:
+            return
+        snapshot = self.worker.take_snapshot()
+        if snapshot is not None:
+            self.canvas_panel.refresh_grid(snapshot.state)
+            if snapshot.finished:
+                self.button_panel.show_paused()
+        if self.worker.error is not None:
+            error, self.worker.error = self.worker.error, None
+            self.button_panel.show_paused()
+            wx.MessageBox(str(error), "Simulation stopped", wx.OK | wx.ICON_ERROR)
+
+    def on_close(self, event):
+        self.timer.Stop()
+        if self.worker is not None:
+            # The frame writer is a step hook of the worker, so the worker must be done before the writer closes
+            self.worker.stop()
+            self.worker.join()
+        if self.frame_writer is not None:
+            self.frame_writer.close()
+        event.Skip()
+
+
+class ReplayFrame(wx.Frame):
+    """
+    Window that shows a recorded run. Frames are read straight from the memory-mapped
+    recording, so seeking to any step is instant and nothing is simulated again.
+    """
+    def __init__(self, parent, reader):
+        wx.Frame.__init__(self, parent)
+        self.reader = reader
+        self.cell_size = reader.cell_size
+        self.step = 0
+
+        self.SetTitle("Cellular Automaton - Replay")
+        self.SetSize(reader.cols * self.cell_size, reader.rows * self.cell_size + 50)
+        self.canvas_panel = Canvas(self)
+        self.replay_panel = ReplayPanel(self)
+        sizer_1 = wx.BoxSizer(wx.VERTICAL)
+        sizer_1.Add(self.canvas_panel, 1, wx.EXPAND | wx.ALL, 0)
+        sizer_1.Add(self.replay_panel, 0, wx.EXPAND | wx.ALL, 1)
+        self.SetSizer(sizer_1)
+        self.Layout()
+
+    def current_state(self):
+        if not len(self.reader):
+            # Nothing recorded yet, show an empty grid
+            return np.zeros((self.reader.rows, self.reader.cols), dtype=np.int8)
+        return self.reader[self.step]
+
+    def show_step(self, step):
+        """
+        Draws the recorded state of the given step.
+        :param step:
+        :return:
+        """
+        if not len(self.reader):
+            return
+        self.step = min(max(step, 0), len(self.reader) - 1)
+        self.canvas_panel.refresh_grid(self.reader[self.step])
+        self.replay_panel.show_step(self.step)
+
+    def reload(self):
+        """
+        Maps frames appended since the recording was opened, e.g. while the run is still going.
+        :return:
+        """
+        self.reader.refresh()
+        self.replay_panel.set_length(len(self.reader))
+        self.show_step(self.step)
+
 
 class Canvas(wx.Panel):
     """
     Panel that is painted at every step to pictorially show most updated state of the system.
+    The grid is drawn into an off-screen buffer; after a step only the cells whose state
+    changed are redrawn there and only their area of the panel is repainted.
     """
     def __init__(self, parent: Frame, id=wx.ID_ANY, pos=wx.DefaultPosition,
                  size=wx.DefaultSize, style=0, name="Canvas"):
         super(Canvas, self).__init__(parent, id, pos, size, style, name)
+        self.SetBackgroundStyle(wx.BG_STYLE_PAINT)  # on_paint paints everything, no need to erase first
         self.Bind(wx.EVT_SIZE, self.on_size)
         self.Bind(wx.EVT_PAINT, self.on_paint)
         self.parent = parent
+        self.background = None  # Bitmap of the cells that do not move: empty cells, obstacles and the target
+        self.buffer = None  # Bitmap of the whole grid as it was last drawn
+        self.drawn_state = None  # Copy of the state array the buffer shows
 
     def on_size(self, event):
         self.Refresh()  # MUST have this, else the rectangle gets rendered corruptly when resizing the window!
         event.Skip()  # seems to reduce the amount of on_size and on_paint events generated when resizing the window
 
+    def cell_rectangles(self, rows, cols):
+        size = self.parent.cell_size
+        return [(col * size, row * size, size, size) for row, col in zip(rows.tolist(), cols.tolist())]
+
+    def init_buffers(self, state):
+        """
+        Draws the background bitmap from scratch and starts the buffer as a copy of it.
+        :param state: state array to draw
+        :return:
+        """
+        rows, cols = state.shape
+        width, height = cols * self.parent.cell_size, rows * self.parent.cell_size
+        self.background = wx.Bitmap(width, height)
+        dc = wx.MemoryDC(self.background)
+        dc.SetBackground(wx.Brush(model.EMPTY))
+        dc.Clear()
+        static_codes = [model.OBSTACLE_CODE, model.TARGET_CODE]
+        if self.parent.cell_size > 5:
+            static_codes.insert(0, model.EMPTY_CODE)
+        for code in static_codes:
+            dc.SetBrush(wx.Brush(model.STATES[code]))
+            dc.DrawRectangleList(self.cell_rectangles(*np.nonzero(state == code)))
+        dc.SelectObject(wx.NullBitmap)
+
+        self.buffer = self.background.GetSubBitmap(wx.Rect(0, 0, width, height))
+        self.drawn_state = np.where(state == model.PEDESTRIAN_CODE, model.EMPTY_CODE, state)
+        self.update_buffer(state)
+
+    def update_buffer(self, state):
+        """
+        Redraws the cells whose state changed since the last call into the buffer.
+        :param state: state array to draw
+        :return: rectangle of the panel covering all changed cells, None if nothing changed
+        """
+        if self.buffer is None or self.drawn_state.shape != state.shape:
+            self.init_buffers(state)
+            return wx.Rect(0, 0, self.buffer.GetWidth(), self.buffer.GetHeight())
+        changed = state != self.drawn_state
+        if np.any(changed & ((state == model.OBSTACLE_CODE) | (self.drawn_state == model.OBSTACLE_CODE) |
+                             (state == model.TARGET_CODE) | (self.drawn_state == model.TARGET_CODE))):
+            # The background itself changed, start over
+            self.init_buffers(state)
+            return wx.Rect(0, 0, self.buffer.GetWidth(), self.buffer.GetHeight())
+        rows, cols = np.nonzero(changed)
+        if not len(rows):
+            return None
+
+        size = self.parent.cell_size
+        dc = wx.MemoryDC(self.buffer)
+        background_dc = wx.MemoryDC(self.background)
+        new_state = state[rows, cols]
+        for code in np.unique(new_state).tolist():
+            selected = new_state == code
+            if code == model.EMPTY_CODE:
+                for x, y, _, _ in self.cell_rectangles(rows[selected], cols[selected]):
+                    dc.Blit(x, y, size, size, background_dc, x, y)
+            else:
+                dc.SetBrush(wx.Brush(model.STATES[code]))
+                dc.DrawRectangleList(self.cell_rectangles(rows[selected], cols[selected]))
+        background_dc.SelectObject(wx.NullBitmap)
+        dc.SelectObject(wx.NullBitmap)
+        self.drawn_state = np.array(state)  # Also copies memory-mapped frames into memory
+        return wx.Rect(int(cols.min()) * size, int(rows.min()) * size,
+                       (int(cols.max()) - int(cols.min()) + 1) * size, (int(rows.max()) - int(rows.min()) + 1) * size)
+
+    def refresh_grid(self, state):
+        """
+        Brings the buffer up to date and repaints only the part of the panel that changed.
+        :param state: state array to draw, a snapshot from the worker
+        :return:
+        """
+        dirty = self.update_buffer(state)
+        if dirty is not None:
+            self.RefreshRect(dirty, eraseBackground=False)
+            self.Update()
+
     def on_paint(self, event):
         """
-        Prints the current state of the system on canvas (Panel).
+        Prints the current state of the system on canvas (Panel) by copying the buffer.
         :param event:
         :return:
         """
         dc = wx.PaintDC(self)
-        dc.Clear()
-        for col in self.parent.system.grid:
-            for cell in col:
-                if cell.state == model.EMPTY and self.parent.cell_size <= 5:
-                    continue
-                dc.SetBrush(wx.Brush(cell.state))
-                dc.DrawRectangle(cell.col * self.parent.cell_size, cell.row * self.parent.cell_size,
-                                 self.parent.cell_size, self.parent.cell_size)
+        if self.buffer is None:
+            self.update_buffer(self.parent.current_state())
+        dc.DrawBitmap(self.buffer, 0, 0)
+        # Fill the part of the panel that the grid does not cover
+        width, height = self.GetClientSize()
+        dc.SetPen(wx.TRANSPARENT_PEN)
+        dc.SetBrush(wx.Brush(self.GetBackgroundColour()))
+        dc.DrawRectangle(self.buffer.GetWidth(), 0, max(0, width - self.buffer.GetWidth()), height)
+        dc.DrawRectangle(0, self.buffer.GetHeight(), width, max(0, height - self.buffer.GetHeight()))
 
     def update_step_dijikstra(self, event):
         """
-        On button click, makes update call for system and prints updated state on canvas.
+        On button click, asks the worker for one Dijkstra step; the canvas shows it once it is done.
         :param event:
         :return:
         """
-        self.parent.button_panel.button_fmm.Disable()
-        self.parent.button_panel.button_eucledian_step.Disable()
-        if not self.parent.system.initialized:
-            self.parent.system.initialized = True
-            self.parent.system.evaluate_dijkstra_cell_utilities()
-        self.parent.system.update_system_dijkstra()
-        self.on_paint(event)
+        self.parent.get_worker(model.DIJKSTRA).request_step()
 
     def update_step_fmm(self, event):
         """
-        On button click, makes update call to system and prints updated state on canvas.
+        On button click, asks the worker for one FMM step; the canvas shows it once it is done.
         :param event:
         :return:
         """
-        self.parent.button_panel.button_dijikstra.Disable()
-        self.parent.button_panel.button_eucledian_step.Disable()
-        self.parent.system.update_system_fmm()
-        self.on_paint(event)
+        self.parent.get_worker(model.FMM).request_step()
 
     def update_step_euclidean(self, event):
         """
-        On button click, makes update call to system and prints updated state on canvas.
+        On button click, asks the worker for one Euclidean step; the canvas shows it once it is done.
         :param event:
         :return:
         """
-        self.parent.button_panel.button_dijikstra.Disable()
-        self.parent.button_panel.button_fmm.Disable()
-        if not self.parent.system.initialized:
-            self.parent.system.initialized = True
-            self.parent.system.evaluate_euclidean_cell_utilities()
-        self.parent.system.update_system_euclidean()
-        self.on_paint(event)
+        self.parent.get_worker(model.EUCLIDEAN).request_step()
 
 
 class ButtonPanel(wx.Panel):
@@ -135,19 +374,102 @@ class ButtonPanel(wx.Panel):
     def __init__(self, parent: Frame, id=wx.ID_ANY, pos=wx.DefaultPosition, size=wx.DefaultSize, style=0,
                  name="ButtonPanel"):
         super(ButtonPanel, self).__init__(parent, id, pos, size, style, name)
+        self.parent = parent
         self.button_dijikstra = wx.Button(self, -1, "Dijikstra_Step")
         self.button_dijikstra.Bind(wx.EVT_BUTTON, parent.canvas_panel.update_step_dijikstra)
         self.button_fmm = wx.Button(self, -1, "FMM_Step")
         self.button_fmm.Bind(wx.EVT_BUTTON, parent.canvas_panel.update_step_fmm)
         self.button_eucledian_step = wx.Button(self, -1, "Euclidean_Step")
         self.button_eucledian_step.Bind(wx.EVT_BUTTON, parent.canvas_panel.update_step_euclidean)
+        self.mode_buttons = {model.DIJKSTRA: self.button_dijikstra, model.FMM: self.button_fmm,
+                             model.EUCLIDEAN: self.button_eucledian_step}
+        self.mode_choice = wx.Choice(self, -1, choices=list(model.MODES))
+        self.mode_choice.SetSelection(0)
+        self.button_play = wx.ToggleButton(self, -1, "Play")
+        self.button_play.Bind(wx.EVT_TOGGLEBUTTON, self.on_play)
+        self.rate = wx.SpinCtrl(self, -1, min=1, max=1000, initial=DEFAULT_STEPS_PER_SECOND)
+        self.rate.SetToolTip("Steps per second")
+        self.rate.Bind(wx.EVT_SPINCTRL, self.on_rate)
         sizer_1 = wx.BoxSizer(wx.HORIZONTAL)
         sizer_1.Add(self.button_dijikstra, 1, wx.EXPAND | wx.ALL, 0)
         sizer_1.Add(self.button_fmm, 1, wx.EXPAND | wx.ALL, 0)
         sizer_1.Add(self.button_eucledian_step, 1, wx.EXPAND | wx.ALL, 0)
+        sizer_1.Add(self.mode_choice, 1, wx.EXPAND | wx.ALL, 0)
+        sizer_1.Add(self.button_play, 1, wx.EXPAND | wx.ALL, 0)
+        sizer_1.Add(self.rate, 1, wx.EXPAND | wx.ALL, 0)
         self.SetSizer(sizer_1)
         self.Layout()
 
+    def lock_mode(self, mode):
+        """
+        Disables every control that would switch to another update mode.
+        :param mode:
+        :return:
+        """
+        self.mode_choice.SetSelection(model.MODES.index(mode))
+        self.mode_choice.Disable()
+        for other, button in self.mode_buttons.items():
+            if other != mode:
+                button.Disable()
+
+    def on_play(self, event):
+        worker = self.parent.get_worker(model.MODES[self.mode_choice.GetSelection()])
+        if self.button_play.GetValue():
+            self.button_play.SetLabel("Pause")
+            worker.play()
+        else:
+            self.show_paused()
+            worker.pause()
+
+    def show_paused(self):
+        self.button_play.SetValue(False)
+        self.button_play.SetLabel("Play")
+
+    def on_rate(self, event):
+        if self.parent.worker is not None:
+            self.parent.worker.steps_per_second = self.rate.GetValue()
+
+
+class ReplayPanel(wx.Panel):
+
+    def __init__(self, parent: ReplayFrame, id=wx.ID_ANY, pos=wx.DefaultPosition, size=wx.DefaultSize, style=0,
+                 name="ReplayPanel"):
+        super(ReplayPanel, self).__init__(parent, id, pos, size, style, name)
+        self.parent = parent
+        self.button_previous = wx.Button(self, -1, "<")
+        self.button_previous.Bind(wx.EVT_BUTTON, lambda event: parent.show_step(parent.step - 1))
+        self.slider = wx.Slider(self, -1, value=0, minValue=0, maxValue=max(1, len(parent.reader) - 1))
+        self.slider.Bind(wx.EVT_SLIDER, lambda event: parent.show_step(self.slider.GetValue()))
+        self.button_next = wx.Button(self, -1, ">")
+        self.button_next.Bind(wx.EVT_BUTTON, lambda event: parent.show_step(parent.step + 1))
+        self.button_reload = wx.Button(self, -1, "Reload")
+        self.button_reload.Bind(wx.EVT_BUTTON, lambda event: parent.reload())
+        self.label = wx.StaticText(self, -1, "")
+        sizer_1 = wx.BoxSizer(wx.HORIZONTAL)
+        sizer_1.Add(self.button_previous, 0, wx.EXPAND | wx.ALL, 0)
+        sizer_1.Add(self.slider, 1, wx.EXPAND | wx.ALL, 0)
+        sizer_1.Add(self.button_next, 0, wx.EXPAND | wx.ALL, 0)
+        sizer_1.Add(self.button_reload, 0, wx.EXPAND | wx.ALL, 0)
+        sizer_1.Add(self.label, 0, wx.ALIGN_CENTER_VERTICAL | wx.ALL, 4)
+        self.SetSizer(sizer_1)
+        self.show_step(0)
+
+    def set_length(self, length):
+        self.slider.SetMax(max(1, length - 1))
+        self.show_step(self.parent.step)
+
+    def show_step(self, step):
+        length = len(self.parent.reader)
+        # The step controls stay disabled until the recording has a frame, Reload looks for new ones
+        for control in (self.button_previous, self.slider, self.button_next):
+            control.Enable(length > 0)
+        self.slider.SetValue(step)
+        if length:
+            self.label.SetLabel("Step {} / {}".format(step, length - 1))
+        else:
+            self.label.SetLabel("No frames recorded yet, press Reload once the run has started")
+        self.Layout()
+
 
 def get_path(wildcard):
     """
@@ -166,10 +488,22 @@ def get_path(wildcard):
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Show a scenario, or replay a recorded run, in the viewer.")
+    parser.add_argument('--record', metavar='FILE', help="record every step of the run to a frames file for replay")
+    parser.add_argument('--log-level', default='WARNING', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help="INFO logs waiting FMM pedestrians, DEBUG also their positions and times")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level, format="%(message)s")
     app = wx.App()
-    file_name = get_path('.json')
-    system, cell_size = initialize_system(file_name)
-    gui = Frame(None, system, cell_size,)
+    file_name = get_path(WILDCARD)
+    if file_name is None:
+        return
+    if file_name.endswith(FRAMES_EXTENSION):
+        gui = ReplayFrame(None, FrameReader(file_name))
+    else:
+        system, cell_size = initialize_system(file_name)
+        gui = Frame(None, system, cell_size, args.record)
     gui.Show()
     app.MainLoop()
 
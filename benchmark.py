@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Times every phase of the model on the bundled scenarios and on generated grids and crowds of increasing size:
+loading a scenario, constructing the System, precomputing each distance field and a step of every update mode.
+
+    python3 benchmark.py --output benchmark.json
+
+The results are written as json: one row per case and phase, plus the scaling exponent of every phase,
+the slope of log(time) over log(cells) for growing grids and over log(pedestrians) for growing crowds.
+An exponent near 1 means linear cost, near 2 quadratic.
+"""
+import argparse
+import glob
+import json
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+
+import model as model
+from scenario import initialize_system
+
+GRID_SIZES = (50, 100, 200, 400)
+CROWD_SIZES = (10, 100, 1000, 10000)
+CROWD_GRID_SIZE = 200
+GRID_PEDESTRIANS = 100
+DOOR_SPACING = 10
+STEPS = 10
+REPEAT = 3
+FIELDS = {
+    'dijkstra_field': model.System.evaluate_dijkstra_cell_utilities,
+    'euclidean_field': model.System.evaluate_euclidean_cell_utilities,
+    'fmm_fields': model.System.evaluate_fmm_fields,
+}
+
+
+def best_time(function, repeat=REPEAT):
+    """
+    Calls function repeat times and returns the shortest wall time.
+    :param function: function without arguments
+    :param repeat:
+    :return: seconds
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def make_system(size, pedestrians, seed=0):
+    """
+    Generates a size x size room with the target in the middle of the right wall, a wall through the middle
+    of the room with a door every DOOR_SPACING rows and the pedestrians spread at random over the left half.
+    :param size: number of rows and cols
+    :param pedestrians: number of pedestrians, at most the number of free cells in the left half
+    :param seed: seed of the random pedestrian placement
+    :return:
+    """
+    system = model.System(size, size)
+    wall = size // 2
+    for row in range(size):
+        if row % DOOR_SPACING != DOOR_SPACING // 2:
+            system.add_obstacle_at((row, wall))
+    system.add_target_at((size // 2, size - 1))
+    free = np.random.default_rng(seed).permutation(size * wall)[:pedestrians]
+    for index in np.sort(free).tolist():
+        system.add_pedestrian_at(divmod(index, wall))
+    system.initialize_speeds()
+    return system
+
+
+def benchmark_case(make, modes, steps=STEPS, repeat=REPEAT):
+    """
+    Times loading the case, constructing an empty System of its size,
+    the distance field precomputes and the steps of every mode on fresh systems.
+    :param make: function without arguments returning a new system, e.g. loading a scenario file
+    :param modes: update modes to time steps of
+    :param steps: number of steps to average the step time over
+    :param repeat: number of repetitions, the best one is reported
+    :return: dictionary of phase name to seconds
+    """
+    system = make()
+    timings = {'load': best_time(make, repeat),
+               'construct': best_time(lambda: model.System(system.cols, system.rows), repeat)}
+    for phase, evaluate in FIELDS.items():
+        systems = [make() for _ in range(repeat)]
+        timings[phase] = best_time(lambda: evaluate(systems.pop()), repeat)
+    for mode in modes:
+        step_times = []
+        for _ in range(repeat):
+            system = make()
+            system.step(mode)  # The first step also precomputes the fields, which is timed above
+            start = time.perf_counter()
+            for _ in range(steps):
+                system.step(mode)
+            step_times.append((time.perf_counter() - start) / steps)
+        timings['step_' + mode] = min(step_times)
+    return timings
+
+
+def get_scaling(rows, kind, size_column):
+    """
+    Fits time = c * size ** exponent to every phase of the rows of the given kind.
+    :param rows: result rows
+    :param kind: 'grid' or 'crowd'
+    :param size_column: column the time scales with, 'cells' or 'pedestrians'
+    :return: list of dictionaries with the phase, the exponent and the (size, seconds) points it was fitted to
+    """
+    scaling = []
+    phases = sorted({row['phase'] for row in rows if row['kind'] == kind})
+    for phase in phases:
+        points = sorted((row[size_column], row['seconds']) for row in rows
+                        if row['kind'] == kind and row['phase'] == phase and row['seconds'] > 0)
+        if len(points) < 2:
+            continue
+        sizes, seconds = np.log(np.array(points, dtype=np.double)).T
+        exponent = np.polyfit(sizes, seconds, 1)[0]
+        scaling.append({'kind': kind, 'phase': phase, 'size': size_column, 'exponent': round(float(exponent), 3),
+                        'points': points})
+    return scaling
+
+
+def run_benchmark(scenarios, modes, grid_sizes=GRID_SIZES, crowd_sizes=CROWD_SIZES, steps=STEPS, repeat=REPEAT,
+                  on_row=None):
+    """
+    Benchmarks the scenario files, a growing grid with GRID_PEDESTRIANS pedestrians
+    and a growing crowd on a CROWD_GRID_SIZE grid.
+    :param scenarios: scenario file names
+    :param modes: update modes to time steps of
+    :param grid_sizes: rows (and cols) of the generated grids
+    :param crowd_sizes: numbers of pedestrians of the generated crowds
+    :param steps:
+    :param repeat:
+    :param on_row: optional function called with every row as soon as it is measured
+    :return: dictionary with the environment, the result rows and the scaling exponents
+    """
+    cases = []
+    for file_name in scenarios:
+        system, _ = initialize_system(file_name)
+        cases.append(('scenario', file_name, system, lambda file_name=file_name: initialize_system(file_name)[0]))
+    for size in grid_sizes:
+        pedestrians = min(GRID_PEDESTRIANS, size * (size // 2))
+        cases.append(('grid', '{0}x{0}'.format(size), make_system(size, pedestrians),
+                      lambda size=size, pedestrians=pedestrians: make_system(size, pedestrians)))
+    for pedestrians in crowd_sizes:
+        cases.append(('crowd', '{} pedestrians'.format(pedestrians), make_system(CROWD_GRID_SIZE, pedestrians),
+                      lambda pedestrians=pedestrians: make_system(CROWD_GRID_SIZE, pedestrians)))
+
+    rows = []
+    for kind, name, system, make in cases:
+        case = {'kind': kind, 'case': name, 'rows': system.rows, 'cols': system.cols,
+                'cells': system.rows * system.cols, 'pedestrians': len(system.agents),
+                'obstacles': int(np.count_nonzero(system.state == model.OBSTACLE_CODE))}
+        timings = benchmark_case(make, modes, steps, repeat)
+        for phase, seconds in timings.items():
+            row = dict(case, phase=phase, seconds=seconds)
+            rows.append(row)
+            if on_row is not None:
+                on_row(row)
+
+    return {
+        'environment': {'python': platform.python_version(), 'numpy': np.__version__,
+                        'machine': platform.machine(), 'processor': platform.processor(),
+                        'steps': steps, 'repeat': repeat},
+        'results': rows,
+        'scaling': get_scaling(rows, 'grid', 'cells') + get_scaling(rows, 'crowd', 'pedestrians'),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark scenario loading, field precomputes and update steps.")
+    parser.add_argument('scenarios', nargs='*', help="scenario json files, by default Test_Scenarios/*.json")
+    parser.add_argument('--modes', nargs='+', choices=model.MODES, default=list(model.MODES))
+    parser.add_argument('--grid-sizes', nargs='*', type=int, default=list(GRID_SIZES))
+    parser.add_argument('--crowd-sizes', nargs='*', type=int, default=list(CROWD_SIZES))
+    parser.add_argument('--steps', type=int, default=STEPS, help="steps to average the step time over")
+    parser.add_argument('--repeat', type=int, default=REPEAT, help="repetitions, the best one is reported")
+    parser.add_argument('--output', help="json file for the results, printed to stdout by default")
+    args = parser.parse_args()
+
+    scenarios = args.scenarios or sorted(glob.glob(os.path.join(os.path.dirname(__file__) or '.',
+                                                                'Test_Scenarios', '*.json')))
+
+    def report(row):
+        print("{:<10} {:<40} {:<16} {:10.6f} s".format(row['kind'], os.path.basename(row['case']), row['phase'],
+                                                        row['seconds']), file=sys.stderr)
+
+    result = run_benchmark(scenarios, args.modes, args.grid_sizes, args.crowd_sizes, args.steps, args.repeat, report)
+    for scaling in result['scaling']:
+        print("{:<6} {:<16} time ~ {}^{:.2f}".format(scaling['kind'], scaling['phase'], scaling['size'],
+                                                      scaling['exponent']), file=sys.stderr)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(result, file, indent=1)
+    else:
+        json.dump(result, sys.stdout, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Saves the full state of a System to a file and restores it, to resume a crashed run or to branch several
+runs from the same mid-run state.
+
+    save_checkpoint(system, 'step500.npz')
+    system = load_checkpoint('step500.npz')
+
+Only the per cell arrays, the agent pool arrays, the computed fields and a small json header with the scalars,
+targets and sources are stored, as one uncompressed .npz file, so saving and loading take time proportional
+to the grid and no Cell objects are ever pickled. A restored system steps exactly as the saved one would have,
+sources included. Step hooks, instrumentation and the field cache belong to a run, not to its state,
+and are not saved.
+"""
+import json
+import os
+import tempfile
+
+import numpy as np
+
+import model as model
+from agents import AgentPool, Source
+from tiles import TileLayout
+
+VERSION = 2
+
+# Per cell arrays of a System, stored under their own names
+CELL_ARRAYS = ('state', 'distance_utility', 'pedestrian_utility', 'visited', 'next_index', 'wait_fmm_penalty',
+               'travel_time', 'initial_predicted_time', 'speed', 'fmm_distance', 'tt')
+# Agent pool arrays, stored as 'agents.' + name
+POOL_ARRAYS = ('index', 'speed', 'alive', 'closest', 'ids')
+
+
+class CheckpointError(Exception):
+    """
+    Raised when a file is not a checkpoint this version can restore.
+    """
+
+
+def get_checkpoint(system):
+    """
+    Collects the state of a system.
+    :param system:
+    :return: dictionary of arrays, 'header' holds the json encoded scalars, targets and sources
+    """
+    pool = system.agents
+    order = pool.active()  # Also frees the slots of removed pedestrians
+    header = {
+        'version': VERSION,
+        'rows': system.rows,
+        'cols': system.cols,
+        'initialized': system.initialized,
+        'r_max': system.r_max,
+        'dx': system.dx,
+        'distance_method': system.distance_method,
+        'step_count': system.step_count,
+        'stalled_steps': system.stalled_steps,
+        'sinks': system.sinks,
+        'targets': [list(target) for target in system.target_coordinates()],
+        'layout': None if system.layout is None else system.layout.to_dict(),
+        'capacity': pool.capacity,
+        'limit': pool.limit,
+        'next_id': pool.next_id,
+        'sources': [{'rectangle': list(source.rectangle), 'rate': source.rate, 'speed': source.speed,
+                     'total': source.total, 'credit': source.credit, 'spawned': source.spawned,
+                     'rng': source.rng.bit_generator.state} for source in system.sources],
+    }
+    arrays = {name: getattr(system, name) for name in CELL_ARRAYS}
+    if system.dijkstra_distance is not None:
+        arrays['dijkstra_distance'] = system.dijkstra_distance
+    arrays.update({'agents.' + name: getattr(pool, name) for name in POOL_ARRAYS})
+    arrays['agents.free'] = pool.free[:pool.free_count]
+    arrays['agents.order'] = order
+    arrays['header'] = np.frombuffer(json.dumps(header).encode(), dtype=np.uint8)
+    return arrays
+
+
+def restore_checkpoint(arrays):
+    """
+    Builds a system from the state collected by get_checkpoint.
+    :param arrays: dictionary of arrays, or the opened .npz file
+    :return: model.System
+    """
+    if 'header' not in arrays:
+        raise CheckpointError("Not a checkpoint: it has no header")
+    header = json.loads(bytes(arrays['header']).decode())
+    if header.get('version') != VERSION:
+        raise CheckpointError("Unsupported checkpoint version " + str(header.get('version')))
+
+    system = model.System(header['cols'], header['rows'])
+    for name in CELL_ARRAYS:
+        setattr(system, name, np.array(arrays[name]))
+    system.dijkstra_distance = np.array(arrays['dijkstra_distance']) if 'dijkstra_distance' in arrays else None
+    for key in ('initialized', 'r_max', 'dx', 'distance_method', 'step_count', 'stalled_steps', 'sinks'):
+        setattr(system, key, header[key])
+    for row, col in header['targets']:
+        system.target_cells[(row, col)] = system.grid[row][col]
+    if header['layout'] is not None:
+        system.layout = TileLayout.from_dict(header['layout'])
+        system.links = system.layout.get_links(system.rows, system.cols)
+
+    pool = AgentPool(header['rows'] * header['cols'], header['limit'])
+    pool.grow(header['capacity'])
+    for name in POOL_ARRAYS:
+        getattr(pool, name)[:] = arrays['agents.' + name]
+    free = arrays['agents.free']
+    pool.free[:len(free)] = free
+    pool.free_count = len(free)
+    pool.order = np.array(arrays['agents.order'], dtype=np.intp)
+    pool.count = len(pool.order)
+    pool.next_id = header['next_id']
+    slots = np.flatnonzero(pool.alive)
+    pool.slot_at[pool.index[slots]] = slots
+    system.agents = pool
+
+    for entry in header['sources']:
+        source = Source(*entry['rectangle'], rate=entry['rate'], speed=entry['speed'], total=entry['total'])
+        source.credit = entry['credit']
+        source.spawned = entry['spawned']
+        source.rng.bit_generator.state = entry['rng']
+        system.sources.append(source)
+    return system
+
+
+def save_checkpoint(system, path):
+    """
+    Writes the state of a system to a checkpoint file. The file is replaced at once,
+    so a crash while saving leaves the previous checkpoint intact. A failed save, e.g. on a full disk,
+    removes its temporary file before the error is raised.
+    :param system:
+    :param path: file name, conventionally ending in .npz
+    :return:
+    """
+    handle, temporary = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    try:
+        with os.fdopen(handle, 'wb') as file:
+            np.savez(file, **get_checkpoint(system))
+        os.replace(temporary, path)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+
+
+def load_checkpoint(path):
+    """
+    Reads a system from a checkpoint file written by save_checkpoint.
+    :param path:
+    :return: model.System
+    """
+    with np.load(path, allow_pickle=False) as arrays:
+        return restore_checkpoint(arrays)
+
+
+class Checkpointer:
+    """
+    Step hook that saves a checkpoint of the system every given number of steps.
+    :param path: checkpoint file, overwritten every time
+    :param every: steps between checkpoints
+    """
+
+    def __init__(self, path, every):
+        self.path = path
+        self.every = every
+
+    def __call__(self, system):
+        if self.every > 0 and system.step_count % self.every == 0:
+            save_checkpoint(system, self.path)
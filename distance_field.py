@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Shortest path distance fields over a boolean walkable mask.
+Cells are connected to their 8 neighbours, straight steps cost 1 and diagonal steps sqrt(2).
+Both methods give the same field, unreachable and non walkable cells are np.inf.
+"""
+import heapq
+import math
+
+import numpy as np
+
+HEAP = 'heap'
+SWEEP = 'sweep'
+AUTO = 'auto'
+METHODS = (AUTO, HEAP, SWEEP)
+# AUTO gives up on the line sweeps after this many passes, winding plans such as mazes need many more
+MAX_SWEEP_PASSES = 4
+
+SQRT2 = math.sqrt(2)
+
+# (row, col) offsets of the 8 neighbours of a cell, in the same order as model.NEIGHBOUR_OFFSETS
+NEIGHBOUR_OFFSETS = ((1, 0), (1, 1), (1, -1), (-1, 0), (-1, 1), (-1, -1), (0, 1), (0, -1))
+
+
+def get_source_mask(shape, sources):
+    """
+    Returns a boolean mask of the source cells.
+    :param shape: (rows, cols) of the grid
+    :param sources: boolean mask or iterable of (row, col) coordinates
+    :return:
+    """
+    if isinstance(sources, np.ndarray) and sources.dtype == bool:
+        return sources
+    mask = np.zeros(shape, dtype=bool)
+    for row, col in sources:
+        mask[row, col] = True
+    return mask
+
+
+def distance_field(walkable, sources, method=AUTO, links=None):
+    """
+    Computes the shortest path distance of every cell to the nearest source.
+    All sources are seeded at once, so several targets cost a single pass.
+    :param walkable: (rows, cols) boolean array, False for obstacles
+    :param sources: boolean mask or iterable of (row, col) coordinates of cells with distance 0
+    :param method: HEAP for flat index Dijkstra, SWEEP for vectorised line sweeps, AUTO for line sweeps
+        that switch to HEAP after MAX_SWEEP_PASSES passes
+    :param links: flat integer array with the cell every cell stands for (see tiles.TileLayout.get_links),
+        a step onto a cell is a step onto the cell it stands for. Only HEAP follows links, so any method gives HEAP
+    :return: (rows, cols) float array
+    """
+    walkable = np.asarray(walkable, dtype=bool)
+    sources = get_source_mask(walkable.shape, sources) & walkable
+    if method == HEAP or (method in METHODS and links is not None):
+        return heap_distance(walkable, sources, links)
+    elif method == SWEEP:
+        return sweep_distance(walkable, sources)
+    elif method == AUTO:
+        distance = sweep_distance(walkable, sources, MAX_SWEEP_PASSES)
+        return heap_distance(walkable, sources) if distance is None else distance
+    raise ValueError("Unknown distance field method: " + str(method))
+
+
+def heap_distance(walkable, sources, links=None):
+    """
+    Dijkstra on flat indices of the grid padded with a non walkable border,
+    so neighbours are fixed index offsets and need no bounds checks.
+    :param walkable:
+    :param sources:
+    :param links: see distance_field
+    :return:
+    """
+    rows, cols = walkable.shape
+    width = cols + 2
+    padded = np.zeros((rows + 2, width), dtype=bool)
+    padded[1:-1, 1:-1] = walkable
+    open_cells = padded.ravel().tolist()
+    steps = [(d_row * width + d_col, math.sqrt(d_row ** 2 + d_col ** 2)) for d_row, d_col in NEIGHBOUR_OFFSETS]
+    padded_links = None
+    if links is not None:
+        # The same links between the cells of the padded grid
+        link_rows, link_cols = np.divmod(np.asarray(links).reshape(rows, cols), cols)
+        padded_links = np.arange(padded.size).reshape(rows + 2, width)
+        padded_links[1:-1, 1:-1] = (link_rows + 1) * width + link_cols + 1
+        padded_links = padded_links.ravel().tolist()
+
+    distance = [math.inf] * padded.size
+    source_rows, source_cols = np.nonzero(sources)
+    queue = [(0.0, index) for index in ((source_rows + 1) * width + source_cols + 1).tolist()]
+    for _, index in queue:
+        distance[index] = 0.0
+    heapq.heapify(queue)
+
+    while queue:
+        current, index = heapq.heappop(queue)
+        if current > distance[index]:
+            continue
+        for step, cost in steps:
+            neighbour = index + step
+            if padded_links is not None:
+                neighbour = padded_links[neighbour]
+            new_distance = current + cost
+            if open_cells[neighbour] and new_distance < distance[neighbour]:
+                distance[neighbour] = new_distance
+                heapq.heappush(queue, (new_distance, neighbour))
+
+    return np.array(distance).reshape(rows + 2, width)[1:-1, 1:-1].copy()
+
+
+def sweep_distance(walkable, sources, max_passes=None):
+    """
+    Relaxes whole rows from the row above and below, then whole columns from the column left and right,
+    and repeats until nothing changes. Every line update is a handful of vectorised operations,
+    the number of repetitions only grows with how often the shortest paths change direction.
+    :param walkable:
+    :param sources:
+    :param max_passes: give up after this many passes, None to repeat until done
+    :return: (rows, cols) float array, None if it gave up
+    """
+    distance = np.where(sources, 0.0, np.inf)
+    blocked = ~walkable
+    changed = True
+    passes = 0
+    while changed:
+        if max_passes is not None and passes >= max_passes:
+            return None
+        passes += 1
+        changed = False
+        for field, walls in ((distance, blocked), (distance.T, blocked.T)):
+            lines = field.shape[0]
+            for order, previous in ((range(1, lines), -1), (range(lines - 2, -1, -1), 1)):
+                for i in order:
+                    changed |= relax_line(field[i], field[i + previous], walls[i])
+    return distance
+
+
+def relax_line(line, previous, walls):
+    """
+    Lowers the distances of one line using its already relaxed neighbouring line, in place.
+    :param line:
+    :param previous:
+    :param walls:
+    :return: True if any distance changed
+    """
+    candidate = previous + 1.0
+    np.minimum(candidate[1:], previous[:-1] + SQRT2, out=candidate[1:])
+    np.minimum(candidate[:-1], previous[1:] + SQRT2, out=candidate[:-1])
+    candidate[walls] = np.inf
+    improved = candidate < line
+    if improved.any():
+        line[improved] = candidate[improved]
+        return True
+    return False
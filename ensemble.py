@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Runs many replicas of one scenario together, advanced by one batched System step.
+
+    python3 ensemble.py Test_Scenarios/RiMEA_final_test6.json --replicas 200 --mode fmm --speed-std 0.2 --random-start
+
+The replicas are stacked along the rows of one System, separated by rows of obstacles that are wider than
+the reach of the pedestrian repulsion and of the FMM scheduling window. So no pedestrian sees, blocks
+or waits for a pedestrian of another replica, and every replica moves exactly as it would on its own.
+Replica r occupies rows r * height to r * height + rows of the stacked grid, state.reshape(replicas, height, cols)
+puts the replica axis first. The distance fields are computed once on the scenario's grid and copied into
+every replica, and a step costs numpy work over all pedestrians of all replicas instead of a Python loop per replica.
+"""
+import argparse
+import json
+import sys
+import time
+
+import numpy as np
+
+import model as model
+from agents import Source
+from runner import STALL_LIMIT
+from scenario import initialize_system
+
+MIN_SPEED = 0.1  # Randomised speeds are clipped to at least this
+MAX_STEPS = 10000
+
+
+class Ensemble:
+    """
+    Replicas of a system, with randomised speeds and start positions.
+    :param system: the scenario. Its pedestrians, their speeds, targets, sources and sinks are replicated
+                   and its fields are computed on it
+    :param replicas: number of replicas
+    :param seed: seed of the randomisation
+    :param speed_std: standard deviation of the normal noise added to every pedestrian's speed
+    :param random_start: place the pedestrians of every replica on random free cells of start_area
+    :param start_area: (row, col, height, width), by default the bounding box of the scenario's pedestrians
+    """
+
+    def __init__(self, system, replicas, seed=0, speed_std=0.0, random_start=False, start_area=None):
+        self.base = system
+        self.replicas = replicas
+        self.pad = max(system.r_max, 2)
+        self.height = system.rows + self.pad
+        self.mode = None
+        rng = np.random.default_rng(seed)
+
+        self.system = model.System(system.cols, replicas * self.height)
+        self.system.r_max = system.r_max
+        self.system.dx = system.dx
+        self.system.sinks = system.sinks
+        state = np.full((replicas, self.height, system.cols), model.OBSTACLE_CODE, dtype=np.int8)
+        state[:, :system.rows] = np.where(system.state == model.OBSTACLE_CODE, model.OBSTACLE_CODE, model.EMPTY_CODE)
+        self.system.add_obstacles(state.reshape(self.system.state.shape) == model.OBSTACLE_CODE)
+        if system.links is not None:
+            # Every replica links its cells the way the scenario's grid does, within the replica
+            links = np.arange(self.system.state.size).reshape(replicas, self.height * system.cols)
+            links[:, :system.state.size] = system.links + np.arange(replicas)[:, None] * self.height * system.cols
+            self.system.links = links.reshape(-1)
+        for replica in range(replicas):
+            for row, col in system.target_coordinates():
+                self.system.add_target_at((replica * self.height + row, col))
+
+        rows, cols, speeds = system.pedestrian_fmm_arrays()
+        if start_area is None and len(rows):
+            start_area = (rows.min(), cols.min(), rows.max() - rows.min() + 1, cols.max() - cols.min() + 1)
+        free = None
+        if random_start and len(rows):
+            row, col, height, width = start_area
+            area = np.zeros(system.state.shape, dtype=bool)
+            area[row:row + height, col:col + width] = True
+            free = np.flatnonzero(area & (system.state != model.OBSTACLE_CODE) & (system.state != model.TARGET_CODE))
+            if len(free) < len(rows):
+                raise ValueError("The start area has " + str(len(free)) + " free cells for "
+                                 + str(len(rows)) + " pedestrians")
+
+        self.sources = []
+        for replica in range(replicas):
+            offset = replica * self.height
+            index = rows * system.cols + cols
+            if free is not None:
+                index = np.sort(rng.choice(free, len(rows), replace=False))
+            replica_speeds = speeds
+            if speed_std > 0:
+                replica_speeds = np.maximum(speeds + rng.normal(0.0, speed_std, len(speeds)), MIN_SPEED)
+            for flat, speed in zip((index + offset * system.cols).tolist(), replica_speeds.tolist()):
+                self.system.add_pedestrian_at(divmod(flat, system.cols), speed)
+            self.sources.append([Source(source.rectangle[0] + offset, *source.rectangle[1:], rate=source.rate,
+                                        speed=source.speed, total=source.total, seed=int(rng.integers(2 ** 32)))
+                                 for source in system.sources])
+        self.system.sources = [source for sources in self.sources for source in sources]
+
+        self.evacuation_time = np.full(replicas, -1, dtype=np.intp)  # Step each replica evacuated at, -1 if not yet
+        self.update_evacuated()
+
+    def tile(self, field):
+        """
+        Copies a field of the scenario's grid into every replica, the rows in between get np.inf.
+        Every replica holds its own copy: a tiled field takes replicas * height * cols * 8 bytes,
+        e.g. about 160 MB for 1000 replicas of a 100x200 scenario, and FMM tiles two fields. A broadcast view
+        cannot be used instead, the steps index the fields with flat cells of the stacked grid.
+        :param field: (rows, cols) array
+        :return: (replicas * height, cols) array
+        """
+        stacked = np.full((self.replicas, self.height, self.base.cols), np.inf)
+        stacked[:, :self.base.rows] = field
+        return stacked.reshape(-1, self.base.cols)
+
+    def prepare(self, mode):
+        """
+        Computes the fields of the mode once on the scenario's grid and copies them into every replica.
+        :param mode:
+        :return:
+        """
+        base = self.base
+        if mode == model.DIJKSTRA:
+            base.evaluate_dijkstra_cell_utilities()
+            self.system.distance_utility = self.tile(base.distance_utility)
+        elif mode == model.EUCLIDEAN:
+            base.evaluate_euclidean_cell_utilities()
+            self.system.distance_utility = self.tile(base.distance_utility)
+        elif mode == model.FMM:
+            base.evaluate_fmm_fields()
+            self.system.fmm_distance = self.tile(base.fmm_distance)
+            self.system.tt = self.tile(base.tt)
+            self.system.initialize_predicted_times()
+        else:
+            raise ValueError("Unknown update mode: " + str(mode))
+        self.system.initialized = True
+        self.mode = mode
+
+    def step(self, mode):
+        """
+        Advances all replicas by one step of the given mode.
+        :param mode:
+        :return:
+        """
+        if mode != self.mode:
+            self.prepare(mode)
+        self.system.step(mode)
+        self.update_evacuated()
+
+    def replica_of(self, rows):
+        """
+        Returns the replica and the row within it of every given row of the stacked grid.
+        :param rows:
+        :return: replicas, local rows
+        """
+        return np.divmod(rows, self.height)
+
+    def update_evacuated(self):
+        """
+        Marks the replicas that are evacuated in the sense of System.is_evacuated with the current step.
+        :return:
+        """
+        rows, cols = self.system.pedestrian_coordinates()
+        replicas, rows = self.replica_of(rows)
+        near = self.base.is_near_target(rows, cols)
+        done = np.bincount(replicas[~near], minlength=self.replicas) == 0
+        done &= np.array([all(source.is_exhausted() for source in sources) for sources in self.sources], dtype=bool)
+        self.evacuation_time[done & (self.evacuation_time < 0)] = self.system.step_count
+
+    def is_evacuated(self):
+        return bool(np.all(self.evacuation_time >= 0))
+
+    def run(self, mode, max_steps=MAX_STEPS, stall_limit=STALL_LIMIT):
+        """
+        Steps all replicas until every one is evacuated, no replica makes progress any more
+        or max_steps steps have been made.
+        :param mode:
+        :param max_steps:
+        :param stall_limit: steps in a row without progress that stop the run, see System.is_gridlocked
+        :return: wall time in seconds
+        """
+        start = time.perf_counter()
+        steps = 0
+        while steps < max_steps and not self.is_evacuated():
+            self.step(mode)
+            steps += 1
+            if stall_limit and self.system.is_gridlocked(stall_limit):
+                break
+        return time.perf_counter() - start
+
+    def results(self):
+        """
+        Returns the statistics of every replica, as runner.run_system does for a single run.
+        :return: list of dictionaries
+        """
+        rows, cols = self.system.pedestrian_coordinates()
+        replicas, _ = self.replica_of(rows)
+        remaining = np.bincount(replicas, minlength=self.replicas)
+        max_travel_time = np.zeros(self.replicas)
+        np.maximum.at(max_travel_time, replicas, self.system.travel_time[rows, cols])
+        return [{'replica': replica, 'evacuated': bool(self.evacuation_time[replica] >= 0),
+                 'evacuation_time': int(self.evacuation_time[replica]) if self.evacuation_time[replica] >= 0 else None,
+                 'max_travel_time': float(max_travel_time[replica]), 'remaining': int(remaining[replica])}
+                for replica in range(self.replicas)]
+
+
+def summarize(results):
+    """
+    Mean, standard deviation, minimum and maximum of the evacuation times of the evacuated replicas.
+    :param results: Ensemble.results()
+    :return: dictionary
+    """
+    times = np.array([result['evacuation_time'] for result in results if result['evacuated']], dtype=np.double)
+    summary = {'replicas': len(results), 'evacuated': len(times)}
+    if len(times):
+        summary.update({'mean': float(times.mean()), 'std': float(times.std()), 'min': float(times.min()),
+                        'max': float(times.max())})
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run many randomised replicas of a scenario in one batched run.")
+    parser.add_argument('scenario', help="path to a scenario json file")
+    parser.add_argument('--replicas', type=int, default=100)
+    parser.add_argument('--mode', choices=model.MODES, default=model.DIJKSTRA)
+    parser.add_argument('--max-steps', type=int, default=MAX_STEPS)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--speed-std', type=float, default=0.0, help="standard deviation of the speed noise")
+    parser.add_argument('--random-start', action='store_true',
+                        help="start every replica's pedestrians on random cells of their bounding box")
+    parser.add_argument('--output', help="json file for the per-replica results")
+    args = parser.parse_args()
+
+    system, _ = initialize_system(args.scenario)
+    start = time.perf_counter()
+    ensemble = Ensemble(system, args.replicas, args.seed, args.speed_std, args.random_start)
+    setup_time = time.perf_counter() - start
+    wall_time = ensemble.run(args.mode, args.max_steps)
+    results = ensemble.results()
+    summary = summarize(results)
+    print("Replicas:          ", summary['replicas'], "(" + str(summary['evacuated']) + " evacuated)",
+          file=sys.stderr)
+    if summary['evacuated']:
+        print("Evacuation time:   ", "{mean:.1f} +- {std:.1f} steps ({min:.0f} to {max:.0f})".format(**summary),
+              file=sys.stderr)
+    print("Setup time:        ", "{:.3f} s".format(setup_time), file=sys.stderr)
+    print("Wall time:         ", "{:.3f} s".format(wall_time), file=sys.stderr)
+    print("Replica steps / s: ", "{:.1f}".format(args.replicas * ensemble.system.step_count / wall_time
+                                                 if wall_time > 0 else float('inf')), file=sys.stderr)
+    output = {'scenario': args.scenario, 'mode': args.mode, 'summary': summary, 'results': results}
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(output, file, indent=1)
+    else:
+        json.dump(output, sys.stdout, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+On-disk cache of precomputed fields (Dijkstra distances, FMM distances and travel times).
+Fields are stored as .npy files named after a hash of the scenario geometry they were computed from,
+and memory-mapped back read only, so runs on an unchanged venue skip the precompute.
+"""
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+DEFAULT_MAX_BYTES = 1 << 30
+
+
+def geometry_key(kind, obstacles, targets, dx=None, speed=None):
+    """
+    Returns a key that changes whenever anything a field depends on changes.
+    :param kind: name of the field, e.g. 'dijkstra' or 'fmm_distance'
+    :param obstacles: (rows, cols) boolean array of obstacle cells
+    :param targets: iterable of (row, col) target coordinates
+    :param dx: grid spacing, for fields that depend on it
+    :param speed: (rows, cols) speed array, for fields that depend on it
+    :return: hex digest
+    """
+    digest = hashlib.sha256()
+    digest.update(kind.encode())
+    digest.update(np.asarray(obstacles.shape, dtype=np.int64).tobytes())
+    digest.update(np.packbits(obstacles).tobytes())
+    digest.update(np.asarray(sorted(tuple(target) for target in targets), dtype=np.int64).tobytes())
+    if dx is not None:
+        digest.update(repr(float(dx)).encode())
+    if speed is not None:
+        speed = np.ascontiguousarray(speed, dtype=np.double)
+        digest.update(np.asarray(speed.shape, dtype=np.int64).tobytes())
+        digest.update(speed.tobytes())
+    return digest.hexdigest()
+
+
+class FieldCache:
+    """
+    Directory of cached fields with least recently used eviction once it grows beyond max_bytes.
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.npy')
+
+    def get(self, key):
+        """
+        Returns the cached field memory-mapped read only, or None if it is not cached.
+        :param key:
+        :return:
+        """
+        path = self.path(key)
+        try:
+            field = np.load(path, mmap_mode='r')
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+        os.utime(path)  # Marks the entry as recently used
+        return field
+
+    def put(self, key, field):
+        """
+        Stores the field under the given key and evicts old entries if the cache got too big.
+        :param key:
+        :param field:
+        :return: the stored field, memory-mapped read only
+        """
+        handle, temporary = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(handle, 'wb') as file:
+            np.save(file, np.ascontiguousarray(field))
+        os.replace(temporary, self.path(key))  # Readers never see a half written file
+        self.evict(keep=key)
+        return np.load(self.path(key), mmap_mode='r')
+
+    def get_or_compute(self, key, compute):
+        """
+        Returns the cached field for key, computing and storing it first if needed.
+        :param key:
+        :param compute: function without arguments returning the field
+        :return:
+        """
+        field = self.get(key)
+        if field is None:
+            field = self.put(key, compute())
+        return field
+
+    def size(self):
+        return sum(os.path.getsize(path) for path in self.entries())
+
+    def entries(self):
+        return [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith('.npy')]
+
+    def evict(self, keep=None):
+        """
+        Deletes least recently used entries until the cache fits into max_bytes.
+        :param keep: key that must not be deleted
+        :return:
+        """
+        entries = []
+        for path in self.entries():
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        keep = None if keep is None else self.path(keep)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        for path in self.entries():
+            os.remove(path)
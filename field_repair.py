@@ -0,0 +1,450 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Incremental repair of distance fields after obstacles are added or removed at runtime.
+Only the cells whose values depend on the changed cells are recomputed, so closing a door costs time
+proportional to the part of the venue behind it, not to the whole map.
+
+Distance fields (see distance_field) are repaired exactly on the 8-neighbour graph. Blocking a cell invalidates
+the cells whose every shortest path went through it and runs Dijkstra again on just those; opening a cell runs
+Dijkstra from it for as long as distances improve. Unreachable cells are np.inf.
+
+FMM fields are marched again in a window around the changed cells exactly as skfmm marches, with the values around
+the window held fixed, and the window grows while the cells near its edge change by more than FMM_TOLERANCE.
+Repaired cells agree with a full skfmm march up to rounding. As in skfmm's output, cells nothing reaches are 0.
+Frozen cells (the ones next to the zero contour around the targets) are never changed.
+
+Every repair runs in Python, cell by cell, while a full recompute is vectorised or runs in C. Pass a limit,
+and a repair that would touch more cells raises RegionTooLarge, so the caller can recompute the whole field.
+
+Grids whose cells stand for cells elsewhere on the grid (links, see tiles.TileLayout.get_links) have neighbours
+skfmm does not know about. march_field marches such a grid whole, the same way, and the distance repairs follow
+the links as well.
+"""
+import heapq
+import math
+
+import numpy as np
+
+from distance_field import NEIGHBOUR_OFFSETS
+
+TOLERANCE = 1e-9
+FMM_TOLERANCE = 1e-6  # Smallest change of an FMM value next to the edge of the repair window that makes it grow
+MARGIN = 4  # Cells the first FMM repair window reaches beyond the changed cells, doubled every time it grows
+
+STEPS = tuple((d_row, d_col, math.sqrt(d_row ** 2 + d_col ** 2)) for d_row, d_col in NEIGHBOUR_OFFSETS)
+AXIS_STEPS = ((0, -1, 1), (0, 1, 1), (-1, 0, 1), (1, 0, 1))
+
+
+class RegionTooLarge(Exception):
+    """
+    Raised when a repair would touch more cells than its limit; the field is left partly repaired.
+    """
+
+
+def check_limit(region, limit):
+    if limit is not None and len(region) > limit:
+        raise RegionTooLarge(str(len(region)) + " cells exceed the repair limit of " + str(limit))
+
+
+def get_neighbours(index, shape, steps=STEPS, links=None):
+    """
+    Yields the flat index and step cost of every neighbour of a cell that lies inside the grid.
+    :param index: flat index of the cell
+    :param shape: (rows, cols) of the grid
+    :param steps: (row offset, col offset, cost) of the neighbours
+    :param links: list with the flat index of the cell every cell stands for, None if every cell is itself
+    :return:
+    """
+    rows, cols = shape
+    row, col = divmod(index, cols)
+    for d_row, d_col, cost in steps:
+        n_row, n_col = row + d_row, col + d_col
+        if 0 <= n_row < rows and 0 <= n_col < cols:
+            yield get_cell(n_row * cols + n_col, links), cost
+
+
+def get_cell(index, links):
+    return index if links is None else links[index]
+
+
+def block_distance(distance, walkable, cells, limit=None, links=None):
+    """
+    Repairs a distance_field result after cells became non walkable.
+    Blocking only makes distances longer, so every cell that still has a neighbour on one of its shortest paths
+    keeps its distance, the others are invalidated and computed again from their valid neighbours.
+    :param distance: (rows, cols) float array, updated in place
+    :param walkable: (rows, cols) boolean array that already excludes the blocked cells
+    :param cells: flat indices of the blocked cells
+    :param limit: maximum number of cells to repair, see RegionTooLarge
+    :param links: see get_neighbours
+    :return: set of flat indices of the cells that were computed again
+    """
+    shape = distance.shape
+    flat = distance.reshape(-1)
+    open_cells = walkable.reshape(-1)
+
+    def has_support(index, value):
+        return any(open_cells[neighbour] and neighbour not in invalid
+                   and abs(flat[neighbour] + cost - value) <= TOLERANCE
+                   for neighbour, cost in get_neighbours(index, shape, links=links))
+
+    invalid = set(cells)
+    queue = [(float(flat[index]), index) for index in invalid if math.isfinite(flat[index])]
+    heapq.heapify(queue)
+    # Cells are visited by increasing distance, so a cell whose last supporting neighbour gets invalidated
+    # is checked again when that neighbour is visited
+    while queue:
+        current, index = heapq.heappop(queue)
+        for neighbour, cost in get_neighbours(index, shape, links=links):
+            if neighbour in invalid or not open_cells[neighbour]:
+                continue
+            value = float(flat[neighbour])
+            if abs(current + cost - value) > TOLERANCE:
+                continue  # Not a shortest path to the neighbour
+            if not has_support(neighbour, value):
+                invalid.add(neighbour)
+                check_limit(invalid, limit)
+                heapq.heappush(queue, (value, neighbour))
+
+    for index in invalid:
+        flat[index] = math.inf
+    queue = []
+    for index in invalid:
+        if open_cells[index]:
+            best = min((flat[neighbour] + cost for neighbour, cost in get_neighbours(index, shape, links=links)
+                        if open_cells[neighbour] and neighbour not in invalid), default=math.inf)
+            if best < math.inf:
+                flat[index] = best
+                queue.append((float(best), index))
+    heapq.heapify(queue)
+    while queue:
+        current, index = heapq.heappop(queue)
+        if current > flat[index]:
+            continue
+        for neighbour, cost in get_neighbours(index, shape, links=links):
+            if neighbour in invalid and open_cells[neighbour] and current + cost < flat[neighbour]:
+                flat[neighbour] = current + cost
+                heapq.heappush(queue, (current + cost, neighbour))
+    return invalid
+
+
+def open_distance(distance, walkable, cells, limit=None, links=None):
+    """
+    Repairs a distance_field result after cells became walkable.
+    Opening only makes distances shorter, so Dijkstra runs from the opened cells for as long as distances improve.
+    :param distance: (rows, cols) float array, updated in place
+    :param walkable: (rows, cols) boolean array that already includes the opened cells
+    :param cells: flat indices of the opened cells
+    :param limit: maximum number of cells to repair, see RegionTooLarge
+    :param links: see get_neighbours
+    :return: set of flat indices of the cells whose distance changed
+    """
+    shape = distance.shape
+    flat = distance.reshape(-1)
+    open_cells = walkable.reshape(-1)
+    changed = set()
+    queue = []
+    for index in cells:
+        flat[index] = min((flat[neighbour] + cost for neighbour, cost in get_neighbours(index, shape, links=links)
+                           if open_cells[neighbour]), default=math.inf)
+        changed.add(index)
+        if flat[index] < math.inf:
+            queue.append((float(flat[index]), index))
+    heapq.heapify(queue)
+    while queue:
+        current, index = heapq.heappop(queue)
+        if current > flat[index]:
+            continue
+        for neighbour, cost in get_neighbours(index, shape, links=links):
+            if open_cells[neighbour] and current + cost < flat[neighbour] - TOLERANCE:
+                flat[neighbour] = current + cost
+                changed.add(neighbour)
+                check_limit(changed, limit)
+                heapq.heappush(queue, (current + cost, neighbour))
+    return changed
+
+
+def eikonal_update(index, shape, value, scale, rhs, targets=None, links=None):
+    """
+    Solves |grad T| = 1 / speed at a cell from its frozen axis neighbours with skfmm's second order update.
+    Along each axis the neighbour nearest the zero contour counts, with a second order difference if the cell
+    beyond it is frozen as well and no further from the contour. If that has no solution skfmm's distance marcher
+    takes the first order one, or the minimum of its quadratic, and its travel time marcher the best single axis.
+    :param index: flat index of the cell
+    :param shape: (rows, cols) of the grid
+    :param value: function returning the signed value of a frozen cell, math.inf for any other cell
+    :param scale: 1 / dx ** 2
+    :param rhs: 1 / speed ** 2 at the cell
+    :param targets: for a travel time field, the set of flat indices inside the zero contour,
+                    where the travel time marcher flips the sign of a second order cell; None for a distance field
+    :param links: see get_neighbours
+    :return: math.inf if no neighbour is frozen
+    """
+    rows, cols = shape
+    row, col = divmod(index, cols)
+    # Coefficients (a, b, c) of a * T ** 2 + b * T + c = rhs per axis, second and first order,
+    # summed in skfmm's order of operations so an unchanged neighbourhood gives the same bits
+    second_order = []
+    first_order = []
+    for d_row, d_col in ((1, 0), (0, 1)):
+        value_1 = value_2 = math.inf
+        for sign in (-1, 1):
+            n_row, n_col = row + sign * d_row, col + sign * d_col
+            if not (0 <= n_row < rows and 0 <= n_col < cols):
+                continue
+            near_index = get_cell(n_row * cols + n_col, links)
+            near = value(near_index)
+            if abs(near) < abs(value_1):
+                # Like skfmm, a second order cell found in the other direction is kept
+                value_1 = near
+                f_row, f_col = n_row + sign * d_row, n_col + sign * d_col
+                if 0 <= f_row < rows and 0 <= f_col < cols:
+                    far_index = get_cell(f_row * cols + f_col, links)
+                    far = value(far_index)
+                    if far != math.inf and ((far <= value_1 and value_1 >= 0) or (far >= value_1 and value_1 <= 0)):
+                        value_2 = far
+                        if targets is not None and (far_index in targets or near_index in targets):
+                            value_2 = -value_2
+        if value_1 == math.inf:
+            continue
+        first_order.append((scale, scale * 2 * value_1, scale * value_1 ** 2))
+        if value_2 != math.inf:
+            centre = (1 / 3) * (4 * value_1 - value_2)
+            second_order.append((scale * 2.25, scale * 2 * 2.25 * centre, scale * 2.25 * centre ** 2))
+        else:
+            second_order.append(first_order[-1])
+    if not first_order:
+        return math.inf
+    solution = solve_quadratic(second_order, rhs)
+    if solution is not None:
+        return solution
+    if targets is not None:
+        return min((solve_quadratic([term], rhs) for term in second_order if solve_quadratic([term], rhs) is not None),
+                   default=math.inf)
+    solution = solve_quadratic(first_order, rhs)
+    if solution is not None:
+        return solution
+    a, b, _ = sum_terms(first_order)
+    return -b / (2 * a)
+
+
+def sum_terms(terms):
+    a = b = c = 0.0
+    for term_a, term_b, term_c in terms:
+        a += term_a
+        b -= term_b
+        c += term_c
+    return a, b, c
+
+
+def solve_quadratic(terms, rhs):
+    """
+    Returns the larger root of sum(a * T ** 2 - b * T + c) = rhs over the given (a, b, c) terms, None if there is none.
+    :param terms:
+    :param rhs:
+    :return:
+    """
+    a, b, c = sum_terms(terms)
+    c -= rhs
+    discriminant = b ** 2 - 4 * a * c
+    if discriminant < 0:
+        return None
+    return (-b + math.sqrt(discriminant)) / 2 / a
+
+
+def get_rhs(speed):
+    """
+    Returns a function giving 1 / speed ** 2 at a flat index, for a scalar speed or a (rows, cols) speed array.
+    :param speed:
+    :return:
+    """
+    if np.ndim(speed) == 0:
+        rhs = 1 / float(speed) ** 2
+        return lambda index: rhs
+    flat_speed = np.asarray(speed).reshape(-1)
+    return lambda index: 1 / float(flat_speed[index]) ** 2
+
+
+def repair_travel_time(time, walkable, frozen, cells, speed=1.0, dx=1.0, limit=None, targets=None):
+    """
+    Repairs an FMM distance or travel time field after cells became walkable or non walkable.
+    The window of the changed cells plus MARGIN cells on every side is marched again, see march_window,
+    with the cells around it held at their values. If a cell within two cells of a side of the window changed
+    by more than FMM_TOLERANCE, the cells beyond that side could change as well, so that side moves out
+    by twice the last margin and the window is marched again, until the change dies out inside it.
+    :param time: (rows, cols) float array, updated in place, 0 where the march did not reach
+    :param walkable: (rows, cols) boolean array that already has the changed cells' new state
+    :param frozen: set of flat indices that are never changed, the cells next to the zero contour
+    :param cells: flat indices of the changed cells
+    :param speed: scalar or (rows, cols) array, as given to skfmm.travel_time
+    :param dx: grid spacing
+    :param limit: maximum number of cells in the window, see RegionTooLarge
+    :param targets: set of flat indices inside the zero contour for a skfmm.travel_time field, see eikonal_update
+    :return: (rows slice, cols slice) of the window that was marched
+    """
+    shape = time.shape
+    flat = time.reshape(-1)
+    open_cells = walkable.reshape(-1)
+    rhs = get_rhs(speed)
+    rows, cols = np.divmod(np.asarray(cells, dtype=np.intp), shape[1])
+    top, bottom = max(int(rows.min()) - MARGIN, 0), min(int(rows.max()) + MARGIN + 1, shape[0])
+    left, right = max(int(cols.min()) - MARGIN, 0), min(int(cols.max()) + MARGIN + 1, shape[1])
+    margin = MARGIN
+    while True:
+        window = (np.arange(top, bottom)[:, None] * shape[1] + np.arange(left, right)).reshape(-1)
+        check_limit(window, limit)
+        region = {index for index in window.tolist() if open_cells[index] and index not in frozen}
+        fixed = [index for index in get_window_ring(top, bottom, left, right, shape)
+                 if open_cells[index] and index not in frozen]
+        # Cells around the window only read the cells of the window up to two cells from its edge
+        window_rows, window_cols = np.divmod(window, shape[1])
+        sides = [(window_rows < top + 2) & (top > 0), (window_rows >= bottom - 2) & (bottom < shape[0]),
+                 (window_cols < left + 2) & (left > 0), (window_cols >= right - 2) & (right < shape[1])]
+        before = flat[window].copy()
+        march_window(flat, open_cells, region, fixed, frozen, shape, 1 / dx / dx, rhs, targets)
+        changed = np.abs(flat[window] - before) > FMM_TOLERANCE
+        grow = [bool(np.any(changed & side)) for side in sides]
+        if not any(grow):
+            return slice(top, bottom), slice(left, right)
+        # Only the sides the change reached grow
+        margin *= 2
+        top = max(top - margin, 0) if grow[0] else top
+        bottom = min(bottom + margin, shape[0]) if grow[1] else bottom
+        left = max(left - margin, 0) if grow[2] else left
+        right = min(right + margin, shape[1]) if grow[3] else right
+
+
+def get_window_ring(top, bottom, left, right, shape):
+    """
+    Yields the flat index of every cell of the grid within two cells of the window but outside it.
+    :param top: first row of the window
+    :param bottom: row after the last one of the window
+    :param left: first col of the window
+    :param right: col after the last one of the window
+    :param shape: (rows, cols) of the grid
+    :return:
+    """
+    rows, cols = shape
+    for row in range(max(top - 2, 0), min(bottom + 2, rows)):
+        for col in range(max(left - 2, 0), min(right + 2, cols)):
+            if not (top <= row < bottom and left <= col < right):
+                yield row * cols + col
+
+
+def march_window(flat, open_cells, region, fixed, frozen, shape, scale=1.0, rhs=lambda index: 1.0, targets=None,
+                 links=None):
+    """
+    Marches the cells of a region again exactly as skfmm marches a whole grid, so an unchanged neighbourhood gives
+    the same values bit for bit. The fixed cells around the region keep their values and are frozen when the march
+    reaches their value, as they were in skfmm's march. Cells are frozen by increasing value, and a cell next to
+    a newly frozen one, or two cells away along an axis, gets the update from its frozen neighbours at that moment,
+    even if an earlier update was lower. Cells of the region the march does not reach are set to 0.
+    :param flat: flat view of the field, updated in place
+    :param open_cells: flat boolean array, False for obstacles
+    :param region: set of flat indices to march
+    :param fixed: flat indices of the cells around the region whose values are held
+    :param frozen: set of flat indices frozen from the start, the cells next to the zero contour
+    :param shape: (rows, cols) of the grid
+    :param scale: 1 / dx ** 2
+    :param rhs: function giving 1 / speed ** 2 at a flat index
+    :param targets: see eikonal_update
+    :param links: see get_neighbours
+    :return:
+    """
+    rows, cols = shape
+    done = set(frozen)
+    tentative = {}
+
+    def value(index):
+        if index not in done or not open_cells[index]:
+            return math.inf
+        return float(flat[index])
+
+    def update(index):
+        result = eikonal_update(index, shape, value, scale, rhs(index), targets, links)
+        if result != 0 and result != math.inf:
+            tentative[index] = result
+            heapq.heappush(queue, (abs(result), index))
+
+    queue = [(abs(float(flat[index])), index) for index in fixed if flat[index] != 0]
+    for index in sorted(region):
+        if any(neighbour in done for neighbour, _ in get_neighbours(index, shape, AXIS_STEPS, links)):
+            update(index)
+    heapq.heapify(queue)
+    while queue:
+        current = queue[0][0]
+        batch = []
+        # Like skfmm, every cell of the same value is frozen before any neighbour is updated
+        while queue and queue[0][0] == current:
+            _, index = heapq.heappop(queue)
+            if index in done or (index in region and abs(tentative[index]) != current):
+                continue
+            if index in region:
+                flat[index] = tentative[index]
+            done.add(index)
+            batch.append(index)
+        for index in batch:
+            row, col = divmod(index, cols)
+            for d_row, d_col, _ in AXIS_STEPS:
+                n_row, n_col = row + d_row, col + d_col
+                if not (0 <= n_row < rows and 0 <= n_col < cols):
+                    continue
+                neighbour = get_cell(n_row * cols + n_col, links)
+                if neighbour in region and neighbour not in done:
+                    update(neighbour)
+                # The cell beyond a frozen neighbour gets a second order update, if it is in the narrow band
+                f_row, f_col = n_row + d_row, n_col + d_col
+                if neighbour in done and 0 <= f_row < rows and 0 <= f_col < cols:
+                    far = get_cell(f_row * cols + f_col, links)
+                    if far in region and far not in done and far in tentative:
+                        update(far)
+    for index in region - done:
+        flat[index] = 0
+
+
+def march_field(walkable, sources, links=None, speed=None, dx=1.0):
+    """
+    Marches a whole grid as skfmm.distance, or skfmm.travel_time if a speed is given, with the zero contour
+    around the source cells, for grids with links. The cells next to the contour start with skfmm's values
+    and march_window does the rest, so the result agrees with skfmm on a grid without links up to rounding.
+    :param walkable: (rows, cols) boolean array, False for obstacles
+    :param sources: (rows, cols) boolean array of the cells inside the zero contour, the targets
+    :param links: flat integer array with the cell every cell stands for, see get_neighbours
+    :param speed: None for a distance field, else scalar or (rows, cols) array as given to skfmm.travel_time
+    :param dx: grid spacing
+    :return: (rows, cols) float array, 0 where the march did not reach
+    """
+    shape = walkable.shape
+    open_cells = walkable.reshape(-1)
+    inside = sources.reshape(-1)
+    links = None if links is None else np.asarray(links).tolist()
+    flat = np.zeros(walkable.size)
+    frozen = set()
+    # As skfmm, with phi 1 outside the contour and -1 inside: along every axis that crosses the contour
+    # the cell is half a cell away from it
+    for index in np.flatnonzero(open_cells).tolist():
+        phi = -1.0 if inside[index] else 1.0
+        total = 0.0
+        for steps in (AXIS_STEPS[2:], AXIS_STEPS[:2]):
+            distance = 0.0
+            for neighbour, _ in get_neighbours(index, shape, steps, links):
+                n_phi = -1.0 if inside[neighbour] else 1.0
+                if open_cells[neighbour] and phi * n_phi < 0:
+                    distance = min(distance, dx * phi / (phi - n_phi)) if distance else dx * phi / (phi - n_phi)
+            if distance > 0:
+                total += 1 / distance / distance
+        if total:
+            flat[index] = math.copysign(math.sqrt(1 / total), phi)
+            frozen.add(index)
+    targets = None
+    if speed is not None:
+        flat_speed = np.broadcast_to(speed, shape).reshape(-1)
+        for index in frozen:
+            flat[index] = abs(flat[index] / flat_speed[index])
+        targets = set(np.flatnonzero(inside).tolist())
+    # Targets inside a block of targets are never left, they stay 0
+    region = set(np.flatnonzero(open_cells & ~inside).tolist()) - frozen
+    march_window(flat, open_cells, region, [], frozen, shape, 1 / dx / dx, get_rhs(1.0 if speed is None else speed),
+                 targets, links)
+    return flat.reshape(shape)
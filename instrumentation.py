@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Per-step phase timings and counters of the System update loop.
+
+    system.instrumentation = StepInstrumentation()
+    system.step(model.DIJKSTRA)
+    system.instrumentation.last()  # {'step': 1, 'mode': 'dijkstra', 'times': {...}, 'counters': {...}}
+
+The update loop calls lap(phase) at the end of every phase, which adds the time since the previous lap to that phase.
+With instrumentation off (System.instrumentation is None, the default) the loop only checks that attribute.
+"""
+import collections
+import time
+
+
+class StepInstrumentation:
+    """
+    Collects the phase timings and counters of every step, and their totals over all steps.
+    :param keep: number of most recent step records to keep, None keeps all of them
+    """
+
+    def __init__(self, keep=None):
+        self.records = collections.deque(maxlen=keep)
+        self.total_times = collections.Counter()
+        self.total_counters = collections.Counter()
+        self.steps = 0
+        self.current = None
+        self.clock = 0.0
+
+    def begin_step(self, step, mode):
+        self.current = {'step': step, 'mode': mode, 'times': collections.Counter(),
+                        'counters': collections.Counter()}
+        self.clock = time.perf_counter()
+
+    def lap(self, phase):
+        """
+        Adds the time since the previous lap (or the start of the step) to the given phase.
+        :param phase:
+        :return:
+        """
+        now = time.perf_counter()
+        if self.current is not None:
+            self.current['times'][phase] += now - self.clock
+        self.clock = now
+
+    def count(self, name, amount=1):
+        if self.current is not None:
+            self.current['counters'][name] += int(amount)
+
+    def end_step(self):
+        record, self.current = self.current, None
+        if record is None:
+            return
+        record['times'] = dict(record['times'])
+        record['counters'] = dict(record['counters'])
+        self.records.append(record)
+        self.total_times.update(record['times'])
+        self.total_counters.update(record['counters'])
+        self.steps += 1
+
+    def last(self):
+        """
+        Returns the record of the last finished step, or None.
+        :return:
+        """
+        return self.records[-1] if self.records else None
+
+    def totals(self):
+        """
+        Returns the timings and counters summed over every step recorded so far.
+        :return:
+        """
+        return {'steps': self.steps, 'times': dict(self.total_times), 'counters': dict(self.total_counters)}
+
+    def reset(self):
+        self.records.clear()
+        self.total_times.clear()
+        self.total_counters.clear()
+        self.steps = 0
+        self.current = None
@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Online density, speed and flow measurements, as used for RiMEA tests and fundamental diagrams.
+
+    measurements = Measurements([MeasurementArea('corridor', 1, 80, 18, 20)], [CrossSection('exit', 1, 150, 18, 150)])
+    system.step_hooks.append(measurements)
+    ...
+    measurements.summary()
+
+Every step only updates running sums, so memory does not grow with the length of the run and no trajectories are kept.
+Densities are in pedestrians per square metre and speeds in metres per step_time seconds, with cells of dx metres.
+A pedestrian's speed is the distance between its cell centres before and after the step.
+"""
+import collections
+import math
+
+import numpy as np
+
+DENSITY_BIN = 0.25  # Width of the density bins of the fundamental diagram in pedestrians per square metre
+
+
+class RunningStats:
+    """
+    Count, mean, variance, minimum and maximum of a stream of values, without storing the values.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0  # Sum of squared differences from the mean
+        self.minimum = math.inf
+        self.maximum = -math.inf
+
+    def add(self, values):
+        """
+        Adds a batch of values, merging its mean and variance with Chan's parallel update.
+        :param values: number or array
+        :return:
+        """
+        values = np.asarray(values, dtype=np.double).reshape(-1)
+        count = len(values)
+        if count == 0:
+            return
+        mean = float(values.mean())
+        m2 = float(((values - mean) ** 2).sum())
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta * delta * self.count * count / total
+        self.count = total
+        self.minimum = min(self.minimum, float(values.min()))
+        self.maximum = max(self.maximum, float(values.max()))
+
+    def variance(self):
+        return self.m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    def summary(self):
+        if self.count == 0:
+            return {'count': 0}
+        return {'count': self.count, 'mean': self.mean, 'std': math.sqrt(self.variance()),
+                'min': self.minimum, 'max': self.maximum}
+
+
+class MeasurementArea:
+    """
+    Rectangle of cells whose density and mean speed are measured every step.
+    The fundamental diagram bins the steps by density and keeps the mean speed and specific flow
+    (density times speed) of every bin.
+    :param name:
+    :param row: top row
+    :param col: left col
+    :param height:
+    :param width:
+    """
+
+    def __init__(self, name, row, col, height, width):
+        self.name = name
+        self.rectangle = (row, col, height, width)
+        self.density = RunningStats()
+        self.speed = RunningStats()  # Mean speed in the area, over the steps it held pedestrians
+        self.pedestrian_speed = RunningStats()  # Speed of every pedestrian in the area, over all steps
+        self.diagram = collections.defaultdict(lambda: (RunningStats(), RunningStats()))
+
+    def contains(self, rows, cols):
+        row, col, height, width = self.rectangle
+        return (rows >= row) & (rows < row + height) & (cols >= col) & (cols < col + width)
+
+    def update(self, rows, cols, speeds, dx):
+        """
+        Adds one step.
+        :param rows: rows of all pedestrians after the step
+        :param cols: cols of all pedestrians after the step
+        :param speeds: speed of every pedestrian in the step, nan where it is not known
+        :param dx: cell size in metres
+        :return:
+        """
+        inside = self.contains(rows, cols)
+        _, _, height, width = self.rectangle
+        density = np.count_nonzero(inside) / (height * width * dx * dx)
+        self.density.add(density)
+        speeds = speeds[inside]
+        speeds = speeds[~np.isnan(speeds)]
+        if len(speeds):
+            speed = float(speeds.mean())
+            self.speed.add(speed)
+            self.pedestrian_speed.add(speeds)
+            bin_speed, bin_flow = self.diagram[int(density // DENSITY_BIN)]
+            bin_speed.add(speed)
+            bin_flow.add(density * speed)
+
+    def summary(self):
+        diagram = [{'density': (number + 0.5) * DENSITY_BIN, 'steps': speed.count, 'speed': speed.mean,
+                    'specific_flow': flow.mean} for number, (speed, flow) in sorted(self.diagram.items())]
+        return {'name': self.name, 'rectangle': list(self.rectangle), 'density': self.density.summary(),
+                'speed': self.speed.summary(), 'pedestrian_speed': self.pedestrian_speed.summary(),
+                'fundamental_diagram': diagram}
+
+
+class CrossSection:
+    """
+    Line between two cell centres that counts the pedestrians crossing it. Crossings count as forward towards
+    higher cols for a line drawn from top to bottom, and towards lower rows for a line drawn from left to right.
+    :param name:
+    :param start_row:
+    :param start_col:
+    :param end_row:
+    :param end_col:
+    """
+
+    def __init__(self, name, start_row, start_col, end_row, end_col):
+        self.name = name
+        self.line = (start_row, start_col, end_row, end_col)
+        self.forward = 0
+        self.backward = 0
+        self.steps = 0
+        self.flow = RunningStats()  # Net crossings per step
+
+    def length(self, dx):
+        start_row, start_col, end_row, end_col = self.line
+        return math.hypot(end_row - start_row, end_col - start_col) * dx
+
+    def update(self, old_rows, old_cols, rows, cols):
+        """
+        Adds one step.
+        :param old_rows: rows of the pedestrians before the step
+        :param old_cols: cols of the pedestrians before the step
+        :param rows: rows of the same pedestrians after the step
+        :param cols: cols of the same pedestrians after the step
+        :return:
+        """
+        start_row, start_col, end_row, end_col = self.line
+        line_row, line_col = end_row - start_row, end_col - start_col
+
+        def side(row, col):
+            return line_row * (col - start_col) - line_col * (row - start_row)
+
+        # Cells on the line count as behind it, so stepping onto the line and off it again is one crossing or none
+        was_ahead = side(old_rows, old_cols) > 0
+        is_ahead = side(rows, cols) > 0
+        # The line's ends must not both be on the same side of the move either
+        move_row, move_col = rows - old_rows, cols - old_cols
+        start_side = move_row * (start_col - old_cols) - move_col * (start_row - old_rows)
+        end_side = move_row * (end_col - old_cols) - move_col * (end_row - old_rows)
+        crossing = (was_ahead != is_ahead) & (start_side * end_side <= 0)
+        forward = int(np.count_nonzero(crossing & is_ahead))
+        backward = int(np.count_nonzero(crossing)) - forward
+        self.forward += forward
+        self.backward += backward
+        self.steps += 1
+        self.flow.add(forward - backward)
+
+    def summary(self, dx, step_time):
+        crossings = self.forward - self.backward
+        flow = crossings / (self.steps * step_time) if self.steps else 0.0
+        return {'name': self.name, 'line': list(self.line), 'forward': self.forward, 'backward': self.backward,
+                'flow': flow, 'specific_flow': flow / self.length(dx) if self.length(dx) else 0.0,
+                'per_step': self.flow.summary()}
+
+
+class Measurements:
+    """
+    Step hook updating measurement areas and cross-sections after every step.
+    Pedestrians are followed by their agent pool slot, a pedestrian that entered or left during a step
+    has no speed in that step and crosses nothing.
+    :param areas: list of MeasurementArea
+    :param sections: list of CrossSection
+    :param step_time: seconds per step, speeds and flows are per step_time seconds
+    """
+
+    def __init__(self, areas=(), sections=(), step_time=1.0):
+        self.areas = list(areas)
+        self.sections = list(sections)
+        self.step_time = step_time
+        self.dx = None
+        self.steps = 0
+        self.last_index = None  # Flat cell of every slot after the previous step, -1 for free slots
+        self.last_slots = np.zeros(0, dtype=np.intp)
+
+    def __call__(self, system):
+        self.update(system)
+
+    def fit(self, pool):
+        """
+        Extends last_index to every slot of the pool, which grows with the number of pedestrians.
+        :param pool: agents.AgentPool
+        :return:
+        """
+        if self.last_index is None:
+            self.last_index = np.full(pool.capacity, -1, dtype=np.intp)
+        elif len(self.last_index) < pool.capacity:
+            missing = np.full(pool.capacity - len(self.last_index), -1, dtype=np.intp)
+            self.last_index = np.concatenate([self.last_index, missing])
+
+    def track(self, system):
+        """
+        Remembers where the pedestrians are, without measuring. Call it before the first step,
+        otherwise the first step only gives densities.
+        :param system:
+        :return:
+        """
+        pool = system.agents
+        self.fit(pool)
+        slots = pool.active()
+        self.last_index[self.last_slots] = -1
+        self.last_index[slots] = pool.index[slots]
+        self.last_slots = slots
+
+    def update(self, system):
+        """
+        Measures the step the system just made.
+        :param system:
+        :return:
+        """
+        pool = system.agents
+        slots = pool.active()
+        self.fit(pool)
+        self.dx = system.dx
+        index = pool.index[slots]
+        old_index = self.last_index[slots]
+        known = old_index >= 0
+        rows, cols = np.divmod(index, system.cols)
+        old_rows, old_cols = np.divmod(old_index[known], system.cols)
+
+        speeds = np.full(len(slots), np.nan)
+        speeds[known] = np.hypot(rows[known] - old_rows, cols[known] - old_cols) * self.dx / self.step_time
+        for area in self.areas:
+            area.update(rows, cols, speeds, self.dx)
+        for section in self.sections:
+            section.update(old_rows, old_cols, rows[known], cols[known])
+
+        self.track(system)
+        self.steps += 1
+
+    def summary(self):
+        """
+        Returns the statistics of every area and cross-section so far.
+        :return: dictionary
+        """
+        dx = 1.0 if self.dx is None else self.dx
+        return {'steps': self.steps, 'dx': dx, 'step_time': self.step_time,
+                'areas': [area.summary() for area in self.areas],
+                'cross_sections': [section.summary(dx, self.step_time) for section in self.sections]}
@@ -1,39 +1,56 @@
 #!/usr/bin/env python
 # coding: utf-8
-import heapq
+import functools
+import logging
 import math
 import sys
 import numpy as np
 import skfmm
 
+import agents
+import distance_field
+import field_cache
+import field_repair
+
+logger = logging.getLogger(__name__)
+
 EMPTY = 'WHITE'
 PEDESTRIAN = 'RED'
 TARGET = 'YELLOW'
 OBSTACLE = 'BLUE'
 R_MAX = 2
+# Obstacle changes that affect more than this fraction of the grid recompute the fields instead of repairing them
+REPAIR_FRACTION = 0.01
+
+# The grid stores states as small integer codes, STATES maps a code back to its colour name
+STATES = (EMPTY, PEDESTRIAN, TARGET, OBSTACLE)
+EMPTY_CODE, PEDESTRIAN_CODE, TARGET_CODE, OBSTACLE_CODE = range(len(STATES))
+STATE_CODES = {state: code for code, state in enumerate(STATES)}
+
+# Update modes a System can be stepped with
+DIJKSTRA = 'dijkstra'
+FMM = 'fmm'
+EUCLIDEAN = 'euclidean'
+MODES = (DIJKSTRA, FMM, EUCLIDEAN)
+
+# (row, col) offsets of the 8 neighbours of a cell, in the order they are always visited
+NEIGHBOUR_OFFSETS = ((1, 0), (1, 1), (1, -1), (-1, 0), (-1, 1), (-1, -1), (0, 1), (0, -1))
+# The same offsets in row-major order, FMM mode breaks ties between neighbours in this order
+FMM_OFFSETS = ((-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1))
 
 
 class Cell:
     """
     Cell represents a unit that a object (PEDESTRIAN, TARGET, OBSTACLE) can occupy in a grid.
+    The cell itself holds no data, it is a view on one position of the arrays owned by its System,
+    so cells can be created on demand and thrown away without losing state.
     """
+    __slots__ = ('system', 'row', 'col')
 
-    def __init__(self, parent, col, row, state):
+    def __init__(self, parent, col, row):
         self.system = parent
-        self.visited = False
-        self.state = state
         self.row = row
         self.col = col
-        self.next_cell = None
-        # More the utility of a cell, less preferred it is for the next move
-        self.distance_utility = float(sys.maxsize)  # Utility representing distance from target
-        self.pedestrian_utility = 0.0  # Utility representing penalty depending on distance from a pedestrian
-
-        self.adjacent_cells = []
-
-        self.wait_fmm_penalty = 1
-        self.travel_time = 0
-        self.initial_predicted_time = 0
 
     def __eq__(self, other):
         if isinstance(other, self.__class__):
@@ -41,12 +58,89 @@ class Cell:
         else:
             return False
 
+    def __hash__(self):
+        return hash((self.row, self.col))
+
     def __lt__(self, other):
         return self.distance_utility < other.distance_utility
 
     def __str__(self):
         return "|(" + str(self.row) + "," + str(self.col) + ")|"
 
+    @property
+    def state(self):
+        return STATES[self.system.state[self.row, self.col]]
+
+    @state.setter
+    def state(self, state):
+        self.system.state[self.row, self.col] = STATE_CODES[state]
+
+    @property
+    def visited(self):
+        return bool(self.system.visited[self.row, self.col])
+
+    @visited.setter
+    def visited(self, visited):
+        self.system.visited[self.row, self.col] = visited
+
+    # More the utility of a cell, less preferred it is for the next move
+    @property
+    def distance_utility(self):
+        """Utility representing distance from target"""
+        return float(self.system.distance_utility[self.row, self.col])
+
+    @distance_utility.setter
+    def distance_utility(self, utility):
+        self.system.distance_utility[self.row, self.col] = utility
+
+    @property
+    def pedestrian_utility(self):
+        """Utility representing penalty depending on distance from a pedestrian"""
+        return float(self.system.pedestrian_utility[self.row, self.col])
+
+    @pedestrian_utility.setter
+    def pedestrian_utility(self, utility):
+        self.system.pedestrian_utility[self.row, self.col] = utility
+
+    @property
+    def wait_fmm_penalty(self):
+        return float(self.system.wait_fmm_penalty[self.row, self.col])
+
+    @wait_fmm_penalty.setter
+    def wait_fmm_penalty(self, penalty):
+        self.system.wait_fmm_penalty[self.row, self.col] = penalty
+
+    @property
+    def travel_time(self):
+        return float(self.system.travel_time[self.row, self.col])
+
+    @travel_time.setter
+    def travel_time(self, time):
+        self.system.travel_time[self.row, self.col] = time
+
+    @property
+    def initial_predicted_time(self):
+        return float(self.system.initial_predicted_time[self.row, self.col])
+
+    @initial_predicted_time.setter
+    def initial_predicted_time(self, time):
+        self.system.initial_predicted_time[self.row, self.col] = time
+
+    @property
+    def next_cell(self):
+        index = self.system.next_index[self.row, self.col]
+        if index < 0:
+            return None
+        return self.system.cell_at(divmod(int(index), self.system.cols))
+
+    @next_cell.setter
+    def next_cell(self, cell):
+        self.system.next_index[self.row, self.col] = -1 if cell is None else cell.row * self.system.cols + cell.col
+
+    @property
+    def adjacent_cells(self):
+        return self.get_adjacent()
+
     def set_distance_utility(self, utility: float):
         self.distance_utility = utility
 
@@ -64,36 +158,17 @@ class Cell:
         Returns a list of all adjacent cells
         :return:
         """
-        rows = self.system.rows
-        cols = self.system.cols
-        row = self.row
-        col = self.col
-        adjacent_cell = []
-        if row + 1 < rows:
-            adjacent_cell.append(self.system.grid[row + 1][col])
-            if col + 1 < cols:
-                adjacent_cell.append(self.system.grid[row + 1][col + 1])
-            if col - 1 >= 0:
-                adjacent_cell.append(self.system.grid[row + 1][col - 1])
-        if row - 1 >= 0:
-            adjacent_cell.append(self.system.grid[row - 1][col])
-            if col + 1 < cols:
-                adjacent_cell.append(self.system.grid[row - 1][col + 1])
-            if col - 1 >= 0:
-                adjacent_cell.append(self.system.grid[row - 1][col - 1])
-        if col + 1 < cols:
-            adjacent_cell.append(self.system.grid[row][col + 1])
-        if col - 1 >= 0:
-            adjacent_cell.append(self.system.grid[row][col - 1])
-
-        return adjacent_cell
+        rows, cols = self.system.rows, self.system.cols
+        return [Cell(self.system, self.col + d_col, self.row + d_row) for d_row, d_col in NEIGHBOUR_OFFSETS
+                if 0 <= self.row + d_row < rows and 0 <= self.col + d_col < cols]
 
     def get_adjacent_minus_obstacles(self):
         """
         Returns a list all adjacent cells that are not occupied by obstacles
         :return:
         """
-        return [cell for cell in self.adjacent_cells if cell not in self.system.obstacles]
+        state = self.system.state
+        return [cell for cell in self.get_adjacent() if state[cell.row, cell.col] != OBSTACLE_CODE]
 
     def get_pedestrian_grid(self, r_max):
         """
@@ -101,12 +176,62 @@ class Cell:
         :param r_max:
         :return:
         """
-        ped_grid_cells = []
-        for row in self.system.grid[max(0, self.row - r_max): min(self.system.rows, self.row + r_max + 1)]:
-            for cell in row[max(0, self.col - r_max):min(self.system.cols, self.col + r_max + 1)]:
-                if cell not in self.system.obstacles:
-                    ped_grid_cells.append(cell)
-        return ped_grid_cells
+        row_start, col_start = max(0, self.row - r_max), max(0, self.col - r_max)
+        window = self.system.state[row_start: min(self.system.rows, self.row + r_max + 1),
+                                   col_start: min(self.system.cols, self.col + r_max + 1)]
+        rows, cols = np.nonzero(window != OBSTACLE_CODE)
+        return [Cell(self.system, col_start + col, row_start + row) for row, col in zip(rows.tolist(), cols.tolist())]
+
+
+class GridRow:
+    """
+    One row of the grid, hands out Cell views so that system.grid[row][col] keeps working.
+    """
+    __slots__ = ('system', 'row')
+
+    def __init__(self, system, row):
+        self.system = system
+        self.row = row
+
+    def __len__(self):
+        return self.system.cols
+
+    def __getitem__(self, col):
+        if isinstance(col, slice):
+            return [Cell(self.system, i, self.row) for i in range(*col.indices(self.system.cols))]
+        if col < 0:
+            col += self.system.cols
+        if not 0 <= col < self.system.cols:
+            raise IndexError("column index out of range")
+        return Cell(self.system, col, self.row)
+
+    def __iter__(self):
+        return (Cell(self.system, col, self.row) for col in range(self.system.cols))
+
+
+class Grid:
+    """
+    Read only list-of-lists compatible view on the arrays of a System.
+    """
+    __slots__ = ('system',)
+
+    def __init__(self, system):
+        self.system = system
+
+    def __len__(self):
+        return self.system.rows
+
+    def __getitem__(self, row):
+        if isinstance(row, slice):
+            return [GridRow(self.system, i) for i in range(*row.indices(self.system.rows))]
+        if row < 0:
+            row += self.system.rows
+        if not 0 <= row < self.system.rows:
+            raise IndexError("row index out of range")
+        return GridRow(self.system, row)
+
+    def __iter__(self):
+        return (GridRow(self.system, row) for row in range(self.system.rows))
 
 
 class System:
@@ -121,20 +246,117 @@ class System:
         self.initialized = False
         self.rows = rows
         self.cols = cols
-        self.grid = [[Cell(self, i, j, EMPTY) for i in range(cols)] for j in range(rows)]
-        self.pedestrian = []  # List of cells occupied by pedestrians
-        self.target: Cell = None
-        self.obstacles = []  # List of cells occupied by obstacles
+        # Struct of arrays holding the per cell data, Cell objects are only views on these
+        self.state = np.full((rows, cols), EMPTY_CODE, dtype=np.int8)
+        self.distance_utility = np.full((rows, cols), float(sys.maxsize))
+        self.pedestrian_utility = np.zeros((rows, cols))
+        self.visited = np.zeros((rows, cols), dtype=bool)
+        self.next_index = np.full((rows, cols), -1, dtype=np.intp)  # Flat index of the next cell, -1 for none
+        self.wait_fmm_penalty = np.ones((rows, cols))
+        self.travel_time = np.zeros((rows, cols))
+        self.initial_predicted_time = np.zeros((rows, cols))
+        self.grid = Grid(self)
+        self.r_max = R_MAX  # Range of the pedestrian repulsion in cells
+        self.distance_method = distance_field.AUTO
+        self.field_cache = None  # Optional field_cache.FieldCache to reuse precomputed fields across runs
+        self.dijkstra_distance = None  # Dijkstra field behind distance_utility (np.inf if unreachable), for repairs
+        self.step_count = 0
+        self.step_progress = 0  # Arrivals, spawns and pedestrians closer to a target than ever before in this step
+        self.stalled_steps = 0  # Steps in a row without progress that no source could end, see is_gridlocked
+        self.step_hooks = []  # Functions called with the system after every step, e.g. a TrajectoryRecorder
+        self.instrumentation = None  # Optional instrumentation.StepInstrumentation collecting per-phase timings
+        # Occupancy index: the state array answers "is there a pedestrian/obstacle at (row, col)" in O(1),
+        # the agent pool holds the pedestrians with their speeds in processing order and finds them by cell in O(1).
+        # Obstacles have no order that matters, the state array is their only index (see obstacle_cells)
+        self.agents = agents.AgentPool(rows * cols)
+        self.sources = []  # agents.Source objects spawning pedestrians at the start of every step
+        self.sinks = False  # Pedestrians reaching a target leave the system in every mode, not only in Dijkstra mode
+        self.target_cells = {}  # Cells of the targets, a pedestrian evacuates on reaching any of them
+        self.layout = None  # tiles.TileLayout if the grid holds the packed parts of a sparse venue
+        # Flat index of the cell every cell stands for, on a packed grid whose parts meet (tiles.TileLayout.get_links).
+        # Every neighbour is looked up through it, None if every cell is itself
+        self.links = None
 
         self.fmm_distance = np.array([])
         self.tt = np.array([])
-        self.pedestrian_fmm = []
         self.dx = 0.4
-        self.speed = np.array(np.ones_like(self.grid), dtype=np.double)
+        self.speed = np.ones((rows, cols), dtype=np.double)
+
+    @property
+    def pedestrian(self):
+        """
+        List of cells occupied by pedestrians
+        """
+        rows, cols = self.pedestrian_coordinates()
+        return [Cell(self, col, row) for row, col in zip(rows.tolist(), cols.tolist())]
+
+    @pedestrian.setter
+    def pedestrian(self, cells):
+        self.clear_pedestrians()
+        for cell in cells:
+            self.add_pedestrian_at((cell.row, cell.col))
+
+    @property
+    def pedestrian_fmm(self):
+        """
+        List of ([row, col], speed) of the pedestrians used by FMM mode
+        """
+        rows, cols, speeds = self.pedestrian_fmm_arrays()
+        return [([row, col], speed) for row, col, speed in zip(rows.tolist(), cols.tolist(), speeds.tolist())]
+
+    @pedestrian_fmm.setter
+    def pedestrian_fmm(self, pedestrians):
+        self.clear_pedestrians()
+        for (row, col), speed in pedestrians:
+            self.add_pedestrian_at((row, col), speed)
 
-        for col in self.grid:
-            for cell in col:
-                cell.adjacent_cells = cell.get_adjacent()
+    @property
+    def target(self):
+        """
+        The target added last, or None. Use targets when there can be more than one
+        """
+        return next(reversed(self.target_cells.values()), None)
+
+    @property
+    def targets(self):
+        """
+        List of cells that are targets
+        """
+        return list(self.target_cells.values())
+
+    def target_coordinates(self):
+        """
+        Returns the (row, col) of every target
+        :return:
+        """
+        return list(self.target_cells)
+
+    @property
+    def obstacle_cells(self):
+        """
+        Cells occupied by obstacles keyed by (row, col), in row-major order
+        """
+        rows, cols = np.nonzero(self.state == OBSTACLE_CODE)
+        return {(row, col): Cell(self, col, row) for row, col in zip(rows.tolist(), cols.tolist())}
+
+    @property
+    def obstacles(self):
+        """
+        List of cells occupied by obstacles
+        """
+        return list(self.obstacle_cells.values())
+
+    @obstacles.setter
+    def obstacles(self, cells):
+        self.state[self.state == OBSTACLE_CODE] = EMPTY_CODE
+        for cell in cells:
+            self.add_obstacle_at((cell.row, cell.col))
+
+    def is_pedestrian_at(self, coordinates: tuple):
+        return self.state[coordinates[0], coordinates[1]] == PEDESTRIAN_CODE
+
+    def is_obstacle_at(self, coordinates: tuple):
+        return self.state[coordinates[0], coordinates[1]] == OBSTACLE_CODE
 
     def __str__(self):
         for row in self.grid:
@@ -142,6 +364,14 @@ class System:
             for cell in row:
                 print(str(cell))
 
+    def cell_at(self, coordinates: tuple):
+        """
+        Returns the cell view for the given (row, col) coordinates
+        :param coordinates:
+        :return:
+        """
+        return Cell(self, coordinates[1], coordinates[0])
+
     def print_distance_utilities(self):
         """
         Helper method to print distance utilities.
@@ -184,14 +414,19 @@ class System:
             print()
         print()
 
-    def add_pedestrian_at(self, coordinates: tuple):
+    def add_pedestrian_at(self, coordinates: tuple, speed=1):
         """
         Updates state of the cell to PEDESTRIAN
         :param coordinates:
+        :param speed:
         :return:
         """
         cell: Cell = self.grid[coordinates[0]][coordinates[1]]
-        self.pedestrian.append(cell)
+        index = cell.row * self.cols + cell.col
+        if self.agents.slot_at[index] < 0:
+            self.agents.add(index, speed)
+        else:
+            self.agents.speed[self.agents.slot_at[index]] = speed
         cell.state = PEDESTRIAN
 
         # Initializing times for FMM implementation to calculate speed of pedestrians
@@ -207,11 +442,10 @@ class System:
         :param init_time:
         :return:
         """
-        self.add_pedestrian_at(coordinates)
+        self.add_pedestrian_at(coordinates, speed)
         cell = self.grid[coordinates[0]][coordinates[1]]
         cell.travel_time = travel_time
         cell.initial_predicted_time = init_time
-        self.pedestrian_fmm.append(([coordinates[0], coordinates[1]], speed))
 
     def initialize_speeds(self, speeds=None):
         """
@@ -221,10 +455,10 @@ class System:
         """
         if speeds is None:
             speeds = []
-        while len(speeds) < len(self.pedestrian):
+        slots = self.agents.active()
+        while len(speeds) < len(slots):
             speeds.append(1)
-        for pedestrian, speed in zip(self.pedestrian, speeds):
-            self.pedestrian_fmm.append(([pedestrian.row, pedestrian.col], speed))
+        self.agents.speed[slots] = speeds[:len(slots)]
 
     def remove_pedestrian_at(self, coordinates: tuple):
         """
@@ -233,7 +467,10 @@ class System:
         :return:
         """
         cell: Cell = self.grid[coordinates[0]][coordinates[1]]
-        self.pedestrian.remove(cell)
+        slot = self.agents.slot_at[cell.row * self.cols + cell.col]
+        if slot < 0:
+            raise ValueError("No pedestrian at " + str(cell))
+        self.agents.remove(np.array([slot]))
         cell.state = EMPTY
 
         cell.travel_time = 0
@@ -246,208 +483,788 @@ class System:
         :param speed:
         :return:
         """
+        key = (coordinates[0], coordinates[1])
+        slot = self.agents.slot_at[key[0] * self.cols + key[1]]
+        if slot < 0 or self.agents.speed[slot] != speed:
+            raise ValueError("No pedestrian with speed " + str(speed) + " at " + str(key))
         self.remove_pedestrian_at(coordinates)
-        self.pedestrian_fmm.remove(([coordinates[0], coordinates[1]], speed))
+
+    def clear_pedestrians(self):
+        """
+        Removes every pedestrian from the grid.
+        :return:
+        """
+        rows, cols = self.pedestrian_coordinates()
+        self.state[rows, cols] = EMPTY_CODE
+        self.travel_time[rows, cols] = 0
+        self.initial_predicted_time[rows, cols] = 0
+        self.agents.clear()
+
+    def spawn_pedestrians(self):
+        """
+        Lets every source spawn its pedestrians for this step on free cells of its rectangle.
+        With FMM fields computed, their initial predicted time is set as in initialize_predicted_times.
+        :return:
+        """
+        flat_state = self.state.reshape(-1)
+        for source in self.sources:
+            cells = source.take_cells(self.state, EMPTY_CODE, self.agents.vacancies())
+            for index in cells.tolist():
+                self.agents.add(index, source.speed)
+            flat_state[cells] = PEDESTRIAN_CODE
+            self.travel_time.reshape(-1)[cells] = 0
+            predicted = 0
+            if self.fmm_distance.size > 0:
+                predicted = self.get_predicted_times(cells, source.speed)
+            self.initial_predicted_time.reshape(-1)[cells] = predicted
+            self.step_progress += len(cells)
+            if self.instrumentation is not None:
+                self.instrumentation.count('spawned', len(cells))
 
     def add_target_at(self, coordinates: tuple):
         """
-        Updates state of the cell at given coordinates to TARGET
+        Updates state of the cell at given coordinates to TARGET.
+        Can be called once per exit, pedestrians head for the nearest one.
         :param coordinates:
         :return:
         """
         cell: Cell = self.grid[coordinates[0]][coordinates[1]]
-        self.target = cell
+        self.target_cells[(cell.row, cell.col)] = cell
         cell.state = TARGET
         return cell
 
     def add_obstacle_at(self, coordinates: tuple):
         """
-        Updates state of the cell at given coordinates to OBSTACLE
+        Updates state of the cell at given coordinates to OBSTACLE.
+        A pedestrian or a target cannot be covered, remove them first.
         :param coordinates:
         :return:
         """
         cell: Cell = self.grid[coordinates[0]][coordinates[1]]
-        self.obstacles.append(cell)
+        if cell.state in (PEDESTRIAN, TARGET):
+            raise ValueError("Cannot place an obstacle on " + str(cell))
+        was_obstacle = cell.state == OBSTACLE
         cell.state = OBSTACLE
+        if not was_obstacle:
+            self.repair_fields([cell.row * self.cols + cell.col], blocked=True)
+
+    def add_obstacles(self, mask):
+        """
+        Updates state of every cell where mask is True to OBSTACLE at once, the bulk version of add_obstacle_at.
+        :param mask: (rows, cols) boolean array
+        :return:
+        """
+        mask = np.asarray(mask, dtype=bool)
+        if mask.shape != self.state.shape:
+            raise ValueError("Obstacle mask of shape " + str(mask.shape) + " does not fit a grid of shape "
+                             + str(self.state.shape))
+        covered = np.flatnonzero(mask & ((self.state == PEDESTRIAN_CODE) | (self.state == TARGET_CODE)))
+        if len(covered):
+            raise ValueError("Cannot place obstacles on " + str(len(covered)) + " pedestrian or target cells, first at "
+                             + str(divmod(int(covered[0]), self.cols)))
+        added = np.flatnonzero(mask & (self.state != OBSTACLE_CODE)).tolist() if self.has_fields() else []
+        self.state[mask] = OBSTACLE_CODE
+        self.repair_fields(added, blocked=True)
+
+    def remove_obstacle_at(self, coordinates: tuple):
+        """
+        Updates state of the obstacle cell at given coordinates to EMPTY
+        :param coordinates:
+        :return:
+        """
+        cell: Cell = self.grid[coordinates[0]][coordinates[1]]
+        if cell.state != OBSTACLE:
+            raise ValueError("No obstacle at " + str(cell))
+        cell.state = EMPTY
+        self.repair_fields([cell.row * self.cols + cell.col], blocked=False)
+
+    def has_fields(self):
+        """
+        Returns True if a Dijkstra or FMM field has been computed, these depend on the obstacles.
+        :return:
+        """
+        return self.dijkstra_distance is not None or self.fmm_distance.size > 0
+
+    def repair_fields(self, cells, blocked):
+        """
+        Brings the computed Dijkstra and FMM fields up to date after obstacles were added (blocked)
+        or removed at the given cells, which must already have their new state.
+        Only the Dijkstra cells that depend on the changed ones and a window of the FMM fields around them
+        are computed again (see field_repair), unless that is more than REPAIR_FRACTION of the grid,
+        then the whole field is. Repaired FMM fields agree with a full skfmm march up to rounding.
+        On a grid with links the FMM fields are always computed again.
+        :param cells: flat indices of the changed cells
+        :param blocked: True if obstacles were added, False if they were removed
+        :return:
+        """
+        if not len(cells) or not self.has_fields():
+            return
+        walkable = self.state != OBSTACLE_CODE
+        limit = max(1, int(self.state.size * REPAIR_FRACTION))
+        links = None if self.links is None else self.links.tolist()
+
+        if self.dijkstra_distance is not None:
+            if not self.dijkstra_distance.flags.writeable:
+                self.dijkstra_distance = np.array(self.dijkstra_distance)  # Memory-mapped from the field cache
+            repair = field_repair.block_distance if blocked else field_repair.open_distance
+            try:
+                changed = np.fromiter(repair(self.dijkstra_distance, walkable, cells, limit, links), dtype=np.intp)
+            except field_repair.RegionTooLarge:
+                self.evaluate_dijkstra_cell_utilities()
+            else:
+                distance = self.dijkstra_distance.reshape(-1)[changed]
+                self.visited.reshape(-1)[changed] = np.isfinite(distance)
+                self.distance_utility.reshape(-1)[changed] = np.where(np.isfinite(distance), distance,
+                                                                      float(sys.maxsize))
+
+        if self.fmm_distance.size > 0 and self.links is not None:
+            self.evaluate_fmm_fields()  # Repair windows are rectangles of the grid, they do not follow links
+        elif self.fmm_distance.size > 0:
+            # The cells around the targets are set up by skfmm from the zero contour, repairs keep them as they are
+            frozen = set()
+            for row, col in self.target_coordinates():
+                for d_row, d_col in ((0, 0), (0, -1), (0, 1), (-1, 0), (1, 0)):
+                    if 0 <= row + d_row < self.rows and 0 <= col + d_col < self.cols:
+                        frozen.add((row + d_row) * self.cols + col + d_col)
+            if frozen.intersection(cells):
+                self.evaluate_fmm_fields()  # Obstacles next to a target change the zero contour itself
+                return
+            if not self.fmm_distance.flags.writeable:
+                self.fmm_distance = np.array(self.fmm_distance)
+            if not self.tt.flags.writeable:
+                self.tt = np.array(self.tt)
+            speed = self.get_uniform_speed()
+            try:
+                window = field_repair.repair_travel_time(self.fmm_distance, walkable, frozen, cells, limit=limit)
+                if speed is None:
+                    targets = set(np.flatnonzero(self.state == TARGET_CODE).tolist())
+                    field_repair.repair_travel_time(self.tt, walkable, frozen, cells, self.speed, self.dx, limit,
+                                                    targets)
+            except field_repair.RegionTooLarge:
+                self.evaluate_fmm_fields()
+            else:
+                if blocked:
+                    self.fmm_distance.reshape(-1)[cells] = sys.maxsize
+                    self.tt.reshape(-1)[cells] = 0
+                if speed is not None:
+                    self.tt[window] = self.scale_travel_time(self.fmm_distance[window], walkable[window], speed)
+
+    def is_evacuated(self):
+        """
+        Returns True once every pedestrian has left the grid or is standing next to a target
+        and no source will spawn any more pedestrians.
+        (Euclidean and FMM modes stop pedestrians next to the target instead of removing them, unless sinks is set)
+        :return:
+        """
+        if not all(source.is_exhausted() for source in self.sources):
+            return False
+        return bool(np.all(self.is_near_target(*self.pedestrian_coordinates())))
+
+    def is_near_target(self, rows, cols):
+        """
+        Returns for every given cell whether it is a target or one of its 8 neighbours.
+        On a grid with links the cells are compared on the venue, a target may lie in the part across a cut.
+        :param rows:
+        :param cols:
+        :return: boolean array
+        """
+        targets = np.array(self.target_coordinates(), dtype=np.intp).reshape(-1, 2)
+        if self.links is not None and self.layout is not None:
+            rows, cols = self.layout.to_original(rows, cols)
+            targets = np.column_stack(self.layout.to_original(targets[:, 0], targets[:, 1]))
+        return np.any((np.abs(rows[:, None] - targets[:, 0]) <= 1) & (np.abs(cols[:, None] - targets[:, 1]) <= 1),
+                      axis=1)
+
+    def count_closer_pedestrians(self, distance):
+        """
+        Counts the pedestrians that are closer to a target than they ever were, and remembers their distance.
+        Moves that only go back and forth between cells a pedestrian has been on before are no progress.
+        :param distance: (rows, cols) distance field of the update mode
+        :return:
+        """
+        slots = self.agents.active()
+        reached = distance.reshape(-1)[self.agents.index[slots]]
+        closer = reached < self.agents.closest[slots]
+        self.agents.closest[slots[closer]] = reached[closer]
+        return int(np.count_nonzero(closer))
+
+    def can_spawn(self):
+        """
+        Returns True if a source that is not exhausted has a free cell in its rectangle.
+        :return:
+        """
+        for source in self.sources:
+            row, col, height, width = source.rectangle
+            if not source.is_exhausted() and np.any(self.state[row:row + height, col:col + width] == EMPTY_CODE):
+                return True
+        return False
+
+    def is_gridlocked(self, steps=1):
+        """
+        Returns True once the given number of steps in a row made no progress: no pedestrian arrived, was spawned
+        or got closer to a target than it has ever been, and no source has room to spawn one.
+        Every pedestrian can get closer only finitely often, so a run that cannot evacuate is always caught,
+        also when pedestrians keep stepping aside and back in front of a blocked exit.
+        :param steps:
+        :return:
+        """
+        return self.stalled_steps >= steps
+
+    def get_gridlock_report(self):
+        """
+        Describes the pedestrians of a system that stopped making progress.
+        :return: dictionary with the step, the number of stalled steps, the pedestrians next to a target
+                 and the (row, col) of every pedestrian that is stuck elsewhere, on the venue of a packed grid
+        """
+        rows, cols = self.pedestrian_coordinates()
+        near = self.is_near_target(rows, cols)
+        stuck_rows, stuck_cols = rows[~near], cols[~near]
+        if self.layout is not None:
+            stuck_rows, stuck_cols = self.layout.to_original(stuck_rows, stuck_cols)
+        return {'step': self.step_count, 'stalled_steps': self.stalled_steps, 'pedestrians': len(rows),
+                'at_target': int(np.count_nonzero(near)),
+                'stuck': np.column_stack([stuck_rows, stuck_cols]).tolist()}
+
+    def step(self, mode):
+        """
+        Advances the system by one step of the given update mode,
+        evaluating the distance utilities the mode needs on the first call.
+        :param mode: one of DIJKSTRA, FMM or EUCLIDEAN
+        :return:
+        """
+        probe = self.instrumentation
+        if probe is not None:
+            probe.begin_step(self.step_count + 1, mode)
+        self.step_progress = 0
+        if self.sources:
+            self.spawn_pedestrians()
+            if probe is not None:
+                probe.lap('spawning')
+        if mode == DIJKSTRA:
+            if not self.initialized:
+                self.initialized = True
+                self.evaluate_dijkstra_cell_utilities()
+                if probe is not None:
+                    probe.lap('fields')
+            self.update_system_dijkstra()
+        elif mode == EUCLIDEAN:
+            if not self.initialized:
+                self.initialized = True
+                self.evaluate_euclidean_cell_utilities()
+                if probe is not None:
+                    probe.lap('fields')
+            self.update_system_euclidean()
+        elif mode == FMM:
+            self.update_system_fmm()
+        else:
+            raise ValueError("Unknown update mode: " + str(mode))
+        self.step_count += 1
+        self.step_progress += self.count_closer_pedestrians(self.fmm_distance if mode == FMM else self.distance_utility)
+        if self.step_progress or self.can_spawn():
+            self.stalled_steps = 0
+        else:
+            self.stalled_steps += 1
+        for hook in self.step_hooks:
+            hook(self)
+        if probe is not None:
+            probe.lap('hooks')
+            probe.end_step()
 
     def evaluate_euclidean_cell_utilities(self):
         """
-        Calculates euclidean distance of every cell in the system grid from target
+        Calculates euclidean distance of every cell in the system grid from the nearest target
         and assigns the value to cell's distance utility
         :return:
         """
-        for row in self.grid:
-            for cell in row:
-                cell.distance_utility = get_euclidean_distance(cell, self.target)
+        rows, cols = np.indices((self.rows, self.cols))
+        targets = self.target_coordinates()
+        if self.layout is not None:
+            # Straight lines are measured on the venue, the parts of a packed grid are moved against each other.
+            # The obstacles around a part stand for the void around it on the venue
+            rows, cols = self.layout.to_original(rows, cols, margin=1)
+            targets = zip(*self.layout.to_original(*np.array(targets, dtype=np.intp).reshape(-1, 2).T))
+        distance = np.full((self.rows, self.cols), np.inf)
+        for row, col in targets:
+            np.minimum(distance, np.sqrt((rows - row) ** 2 + (cols - col) ** 2), out=distance)
+        if self.layout is not None:
+            # Beyond the edge of the venue there are no cells to move to at all
+            venue_rows, venue_cols = self.layout.shape
+            distance[(rows < 0) | (rows >= venue_rows) | (cols < 0) | (cols >= venue_cols)] = np.inf
+        self.distance_utility = distance
+        self.dijkstra_distance = None  # distance_utility no longer holds the Dijkstra field
+
+    def pedestrian_coordinates(self):
+        """
+        Returns the rows and cols of all pedestrians as two integer arrays, in the order of self.pedestrian
+        :return:
+        """
+        return np.divmod(self.agents.index[self.agents.active()], self.cols)
+
+    def get_neighbour_cells(self, rows, cols, offsets):
+        """
+        Returns the cells at the given offsets from every given cell, following self.links.
+        :param rows: cell rows
+        :param cols: cell cols
+        :param offsets: (n, 2) array of (row, col) offsets
+        :return: (cells, n) array of flat grid indices, 0 outside the grid, and (cells, n) boolean array,
+                 False outside the grid
+        """
+        n_rows = rows[:, None] + offsets[:, 0]
+        n_cols = cols[:, None] + offsets[:, 1]
+        inside = (n_rows >= 0) & (n_rows < self.rows) & (n_cols >= 0) & (n_cols < self.cols)
+        neighbours = np.where(inside, n_rows * self.cols + n_cols, 0)
+        if self.links is not None:
+            neighbours = self.links[neighbours]
+        return neighbours, inside
+
+    def get_padded_links(self, pad):
+        """
+        Returns self.links for the grid padded by pad cells on every side, as flat indices of the padded grid.
+        :param pad:
+        :return: flat integer array, None without links
+        """
+        if self.links is None:
+            return None
+        width = self.cols + 2 * pad
+        link_rows, link_cols = np.divmod(self.links.reshape(self.rows, self.cols), self.cols)
+        padded = np.arange((self.rows + 2 * pad) * width).reshape(self.rows + 2 * pad, width)
+        padded[pad:-pad, pad:-pad] = (link_rows + pad) * width + link_cols + pad
+        return padded.reshape(-1)
+
+    def select_next_cells(self, rows, cols, cost, blocked, stay_on=None, ties_to_last=False):
+        """
+        Batched move selection for all pedestrians at once.
+        Every pedestrian looks at the cost of its 8 neighbours and moves to the cheapest one
+        if it is cheaper than its own cell (or as cheap, when ties_to_last is set).
+        Neighbours that are blocked or already reserved in this step are never chosen.
+        Conflicts are resolved in rounds with priority in the order of self.pedestrian:
+        a pedestrian keeps its choice once every pedestrian before it that could also take
+        that cell has decided, the others choose again without the reserved cells.
+        :param rows: pedestrian rows
+        :param cols: pedestrian cols
+        :param cost: (rows, cols) array, lower is better
+        :param blocked: (rows, cols) boolean array of cells no pedestrian may move to
+        :param stay_on: state code, pedestrians whose best neighbour has this state do not move
+        :param ties_to_last: among equally cheap neighbours take the last one instead of the first
+        :return: flat grid indices of the next cell of every pedestrian
+        """
+        probe = self.instrumentation
+        offsets = np.array(NEIGHBOUR_OFFSETS)
+        flat_cost = cost.reshape(-1)
+        flat_state = self.state.reshape(-1)
+        reserved = blocked.reshape(-1).copy()
+
+        current = rows * self.cols + cols
+        next_index = current.copy()
+        undecided = np.arange(len(rows))
+        while len(undecided):
+            neighbours, inside = self.get_neighbour_cells(rows[undecided], cols[undecided], offsets)
+            n_cost = np.where(inside & ~reserved[neighbours], flat_cost[neighbours], np.inf)
+
+            own_cost = flat_cost[current[undecided], None]
+            acceptable = n_cost <= own_cost if ties_to_last else n_cost < own_cost
+            acceptable &= np.isfinite(n_cost)
+            if ties_to_last:
+                best = n_cost.shape[1] - 1 - np.argmin(n_cost[:, ::-1], axis=1)
+            else:
+                best = np.argmin(n_cost, axis=1)
+            moving = acceptable[np.arange(len(undecided)), best]
+            choice = neighbours[np.arange(len(undecided)), best]
+            if stay_on is not None:
+                moving &= flat_state[choice] != stay_on
+            if probe is not None:
+                probe.lap('selection')
+
+            # A pedestrian gets its cell only if no pedestrian before it, that is still choosing,
+            # would accept that cell too. This gives the same result as moving them one after another.
+            claim_cells = neighbours[acceptable]
+            claim_peds = np.broadcast_to(undecided[:, None], acceptable.shape)[acceptable]
+            order = np.lexsort((claim_peds, claim_cells))
+            claim_cells, claim_peds = claim_cells[order], claim_peds[order]
+            first = np.ones(len(claim_cells), dtype=bool)
+            first[1:] = claim_cells[1:] != claim_cells[:-1]
+            claim_cells, claim_peds = claim_cells[first], claim_peds[first]
+
+            movers = undecided[moving]
+            choice = choice[moving]
+            won = claim_peds[np.searchsorted(claim_cells, choice)] == movers
+            next_index[movers[won]] = choice[won]
+            reserved[choice[won]] = True
+            # Pedestrians that stay are decided as well, the rest choose again
+            undecided = movers[~won]
+            if probe is not None:
+                probe.lap('conflicts')
+                probe.count('rounds')
+                probe.count('conflicts', len(undecided))
+        return next_index
+
+    def move_pedestrians(self, rows, cols, next_index, remove_at_target=False):
+        """
+        Writes the moves chosen by select_next_cells to the grid and the agent pool.
+        :param rows: pedestrian rows, in the order of self.pedestrian
+        :param cols: pedestrian cols
+        :param next_index: flat grid index of the next cell of every pedestrian
+        :param remove_at_target: pedestrians stepping on a target leave the system
+        :return:
+        """
+        current = rows * self.cols + cols
+        self.next_index.reshape(-1)[current] = next_index
+        flat_state = self.state.reshape(-1)
+        staying = np.ones(len(current), dtype=bool)
+        if remove_at_target:
+            staying = flat_state[next_index] != TARGET_CODE
+        flat_state[current] = EMPTY_CODE
+        flat_state[next_index[staying]] = PEDESTRIAN_CODE
+        moved = next_index != current
+        self.step_progress += len(staying) - np.count_nonzero(staying)
+        slots = self.agents.active()
+        self.agents.move(slots[moved], next_index[moved])
+        self.agents.remove(slots[~staying])
+        probe = self.instrumentation
+        if probe is not None:
+            probe.lap('writes')
+            probe.count('moves', np.count_nonzero(moved))
+            probe.count('waits', len(moved) - np.count_nonzero(moved))
+            probe.count('arrivals', len(staying) - np.count_nonzero(staying))
 
     def update_system_euclidean(self):
         """
-        Iteratively computes and assigns next position for each pedestrian cell.
+        Computes and assigns next position for all pedestrian cells in one batch.
         This only factors in euclidean distance to compute next position to get close to the target,
         but avoids occupying same position as another pedestrian, obstacle or target.
         (This does not guarantee that the pedestrian will reach the target )
         :return:
         """
-        next_cells = []
-        for cell in self.pedestrian:
-            next_cell = cell
-            for adjacent in [x for x in cell.adjacent_cells if
-                             x != self.target and x not in next_cells + self.pedestrian]:
-                if adjacent.distance_utility < next_cell.distance_utility:
-                    next_cell = adjacent
-            if next_cell.state == OBSTACLE:
-                next_cell = cell
-            next_cells.append(next_cell)
-            cell.set_next(next_cell)
-
-        for cell in self.pedestrian:
-            cell.state = EMPTY
-            cell.next_cell.state = PEDESTRIAN
-        self.pedestrian = next_cells
+        rows, cols = self.pedestrian_coordinates()
+        blocked = self.state == PEDESTRIAN_CODE
+        if not self.sinks:
+            blocked |= self.state == TARGET_CODE
+        next_index = self.select_next_cells(rows, cols, self.distance_utility, blocked, stay_on=OBSTACLE_CODE)
+        self.move_pedestrians(rows, cols, next_index, remove_at_target=self.sinks)
 
     def get_next_pedestrian_cells(self):
         """
         Helper method to compute next position.
-        Iteratively computes next position for each pedestrian cell.
+        Computes next position for all pedestrian cells in one batch.
         This factors in shortest path to the target to compute next position;
         this factors in pedestrian interaction to compute next position
         and avoids occupying same position as another pedestrian, obstacle or target.
         (This guarantees that pedestrian will reach the target)
-        :return:
+        :return: pedestrian rows, cols and the flat grid index of their next cells
         """
-        for ped in self.pedestrian:
-            add_pedestrian_utilities(ped)
-
-        next_cells = []
-        for ped in self.pedestrian:
-            next_cell = ped
-            for neighbour in [cell for cell in ped.get_adjacent_minus_obstacles() if
-                              cell not in next_cells + self.pedestrian]:
-                if neighbour.distance_utility + neighbour.pedestrian_utility \
-                        <= next_cell.distance_utility + next_cell.pedestrian_utility \
-                        and neighbour.state != PEDESTRIAN:
-                    next_cell = neighbour
-                    next_cells.append(next_cell)
-            ped.set_next(next_cell)
-        for ped in self.pedestrian:
-            reset_pedestrian_utilities(ped)
+        rows, cols = self.pedestrian_coordinates()
+        self.pedestrian_utility = get_pedestrian_utilities(rows, cols, self.state, self.r_max, self.links)
+        if self.instrumentation is not None:
+            self.instrumentation.lap('utilities')
+        blocked = (self.state == PEDESTRIAN_CODE) | (self.state == OBSTACLE_CODE)
+        next_index = self.select_next_cells(rows, cols, self.distance_utility + self.pedestrian_utility, blocked,
+                                            ties_to_last=True)
+        self.next_index.reshape(-1)[rows * self.cols + cols] = next_index
+        return rows, cols, next_index
 
     def update_system_dijkstra(self):
         """
-        Updates pedestrian positions to next cells computed by get_next_pedestrian_cells()
+        Updates pedestrian positions to next cells computed by get_next_pedestrian_cells().
+        Pedestrians that reach a target are removed from the system.
         :return:
         """
-        new_peds = []
-        self.get_next_pedestrian_cells()
-        for ped in self.pedestrian:
-            if ped.next_cell == self.target:
-                continue
-            ped.state = EMPTY
-            ped.next_cell.state = PEDESTRIAN
-            new_peds.append(ped.next_cell)
-        self.pedestrian = new_peds
+        rows, cols, next_index = self.get_next_pedestrian_cells()
+        self.move_pedestrians(rows, cols, next_index, remove_at_target=True)
 
     def evaluate_dijkstra_cell_utilities(self):
         """
         Evaluates and initialises distance utilities for every
         cell using shortest path algorithm (dijikstra).
+        All targets are sources of a single pass, so every cell gets the distance to its nearest target.
+        Cells that cannot reach any target keep a utility of sys.maxsize.
+        Can be called again whenever the obstacles or the targets change.
+        A grid with links is never cached, see evaluate_fmm_fields.
         :return:
         """
-        self.target.set_distance_utility(0)
-        unvisited_queue = [(self.target.get_utility(), self.target)]
+        walkable = self.state != OBSTACLE_CODE
+        targets = self.target_coordinates()
 
-        while len(unvisited_queue):
-            unvisited = heapq.heappop(unvisited_queue)
-            current_cell = unvisited[1]
-            current_cell.set_visited()
-            for next_cell in current_cell.get_adjacent_minus_obstacles():
-                if next_cell.visited:
-                    continue
-                new_dist = current_cell.get_utility() + get_euclidean_distance(current_cell, next_cell)
-                if new_dist < next_cell.get_utility():
-                    next_cell.set_distance_utility(new_dist)
-                    heapq.heappush(unvisited_queue, (next_cell.get_utility(), next_cell))
+        def compute():
+            return distance_field.distance_field(walkable, targets, self.distance_method, self.links)
 
-    def update_system_fmm(self):
+        if self.field_cache is None or self.links is not None:
+            distance = compute()
+        else:
+            distance = self.field_cache.get_or_compute(field_cache.geometry_key('dijkstra', ~walkable, targets), compute)
+        self.dijkstra_distance = distance
+        self.visited = np.isfinite(distance)
+        self.distance_utility = np.where(self.visited, distance, float(sys.maxsize))
+
+    def evaluate_fmm_fields(self):
         """
+        Computes the FMM distance (with obstacles set to sys.maxsize) and travel time fields,
+        or loads them from self.field_cache if the same geometry was computed before.
+        Every target is inside the zero contour, so one pass gives the field of the nearest target.
+        With a uniform self.speed the travel time is the distance scaled by dx / speed, which is how skfmm
+        computes it as well, so it takes no second FMM pass.
+        skfmm does not know about self.links, a grid with links is marched in Python (field_repair.march_field)
+        and never cached, the cache keys only describe the grid.
+        :return:
+        """
+        obstacles = self.state == OBSTACLE_CODE
+        targets = self.target_coordinates()
+        t_grid = np.ones((self.rows, self.cols), dtype=np.double)
+        t_grid[self.state == TARGET_CODE] = -1
+        phi = np.ma.MaskedArray(t_grid, obstacles)
+
+        def compute_distance():
+            if self.links is not None:
+                distance = field_repair.march_field(~obstacles, self.state == TARGET_CODE, self.links)
+            else:
+                distance = np.ma.getdata(skfmm.distance(phi)).copy()
+            distance[obstacles] = sys.maxsize
+            return distance
+
+        def compute_travel_time():
+            if self.links is not None:
+                return field_repair.march_field(~obstacles, self.state == TARGET_CODE, self.links, self.speed, self.dx)
+            return np.ma.getdata(skfmm.travel_time(phi, self.speed, self.dx))
 
+        speed = self.get_uniform_speed()
+        if self.field_cache is None or self.links is not None:
+            self.fmm_distance = compute_distance()
+            if speed is None:
+                self.tt = compute_travel_time()
+        else:
+            self.fmm_distance = self.field_cache.get_or_compute(
+                field_cache.geometry_key('fmm_distance', obstacles, targets), compute_distance)
+            if speed is None:
+                self.tt = self.field_cache.get_or_compute(
+                    field_cache.geometry_key('fmm_travel_time', obstacles, targets, self.dx, self.speed),
+                    compute_travel_time)
+        if speed is not None:
+            self.tt = self.scale_travel_time(self.fmm_distance, ~obstacles, speed)
+
+    def get_uniform_speed(self):
+        """
+        Returns the speed of the travel time field if it is the same in every cell, else None.
         :return:
         """
-        ped = [((p[0][0], p[0][1]), p[1]) for p in self.pedestrian_fmm]
-        for p in ped:
-            path, tt, time = self.calc_fmm(p, self.grid[p[0][0]][p[0][1]].wait_fmm_penalty)
-            if self.grid[path[0][0]][path[0][1]].state == PEDESTRIAN:
-                # Can be thought of as the level of patience
-                self.grid[p[0][0]][p[0][1]].wait_fmm_penalty += 0.001
-                print(p, "--> Wait")
-                continue
-            if self.grid[path[0][0]][path[0][1]] == self.target:
-                continue
-            init_time = self.grid[p[0][0]][p[0][1]].initial_predicted_time
-            speed = p[1]
-            time += self.grid[p[0][0]][p[0][1]].travel_time
-            self.remove_pedestrian_fmm_at((p[0][0], p[0][1]), speed)
-            self.add_pedestrian_fmm(path[0], speed, time, init_time)
+        speed = float(self.speed.flat[0])
+        return speed if np.all(self.speed == speed) else None
 
-        for i in self.pedestrian:
-            print((i.row, i.col), '--->', 'Travel Time: ', i.travel_time, ', Predicted Time: ',
-                  i.initial_predicted_time)
+    def scale_travel_time(self, distance, walkable, speed):
+        """
+        Turns an FMM distance field in cells into the travel time field of a uniform speed, in seconds.
+        The eikonal equation is linear in the slowness, so this matches skfmm.travel_time up to rounding,
+        target cells included (skfmm gives their distance to the zero contour negative and their travel time positive).
+        :param distance: FMM distance field, or some of its cells
+        :param walkable: boolean array of the same shape, the other cells get 0 as from skfmm
+        :param speed:
+        :return: array of the same shape
+        """
+        return np.where(walkable, np.abs(distance) * (self.dx / speed), 0.0)
 
-    def calc_fmm(self, ped, wait=1):
+    def get_predicted_times(self, cells, speeds):
         """
+        Returns the initial predicted times of pedestrians of the given speeds on the given cells.
+        A pedestrian of speed v needs exactly 1 / v times as long as one of speed 1 on the same field,
+        so all speeds share the one FMM distance field and no field is computed per speed.
+        :param cells: flat grid indices
+        :param speeds: scalar or array with one speed per cell
+        :return: array
+        """
+        return self.fmm_distance.reshape(-1)[cells] / speeds
 
-        :param ped:
-        :param wait:
+    def initialize_predicted_times(self):
+        """
+        Sets the initial predicted time of every pedestrian to its FMM distance divided by its speed.
         :return:
         """
-        p, speed = ped
-        if self.fmm_distance.size == 0:
-            t_grid = np.array(np.ones_like(self.grid), dtype=np.double)
-            mask = np.array(0 * np.ones_like(self.grid), dtype=bool)
-            t_grid[self.target.row, self.target.col] = -1
-            for i in self.obstacles:
-                mask[i.row][i.col] = True
-            phi = np.ma.MaskedArray(t_grid, mask)
-            self.fmm_distance = skfmm.distance(phi)
-            self.grid[p[0]][p[1]].initial_predicted_time = self.fmm_distance[p[0]][p[1]] / self.speed[p[0]][p[1]]
-            self.tt = skfmm.travel_time(phi, self.speed, self.dx)
-            for z in self.pedestrian_fmm:
-                self.grid[z[0][0]][z[0][1]].initial_predicted_time = self.fmm_distance[z[0][0]][z[0][1]] / z[1]
-        for i in self.obstacles:
-            self.fmm_distance[i.row][i.col] = sys.maxsize
-        d = np.copy(self.fmm_distance)
-        t = np.copy(self.tt)
-        for j in self.pedestrian:
-            d[j.row, j.col] *= ((wait * (1 + (1 / (d[j.row, j.col]) * 10))) + 1 / d[j.row, j.col])
-        return self.calc_fmm_path(d, t, p, speed)
-
-    def calc_fmm_path(self, distance, t, p, speed):
-        """
-
-        :param distance:
-        :param t:
-        :param p:
-        :param speed:
+        if not len(self.agents):
+            return
+        slots = self.agents.active()
+        cells = self.agents.index[slots]
+        self.initial_predicted_time.reshape(-1)[cells] = self.get_predicted_times(cells, self.agents.speed[slots])
+
+    def pedestrian_fmm_arrays(self):
+        """
+        Returns the rows, cols and speeds of self.pedestrian_fmm as arrays
+        :return:
+        """
+        slots = self.agents.active()
+        rows, cols = np.divmod(self.agents.index[slots], self.cols)
+        return rows, cols, self.agents.speed[slots]
+
+    def select_fmm_cells(self, distance, rows, cols, waits):
+        """
+        Chooses the next cell of each given pedestrian from its 3x3 stencil only.
+        Neighbours occupied by a pedestrian have their distance raised by the crowd penalty,
+        which grows with the waiting pedestrian's patience (wait).
+        Ties go to the first neighbour in row-major order.
+        :param distance: (rows, cols) FMM distance field, only read
+        :param rows: pedestrian rows
+        :param cols: pedestrian cols
+        :param waits: wait penalties of the pedestrians
+        :return: flat grid index of the chosen cell and length of the step to it
+        """
+        offsets = np.array(FMM_OFFSETS)
+        neighbours, inside = self.get_neighbour_cells(rows, cols, offsets)
+
+        d = distance.reshape(-1)[neighbours]
+        occupied = self.state.reshape(-1)[neighbours] == PEDESTRIAN_CODE
+        wait = waits[:, None]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            d = np.where(occupied, d * ((wait * (1 + (1 / d) * 10)) + 1 / d), d)
+        d[~inside] = np.inf
+
+        best = np.argmin(d, axis=1)
+        step_lengths = np.sqrt((offsets ** 2).sum(axis=1))
+        return neighbours[np.arange(len(rows)), best], step_lengths[best]
+
+    def update_system_fmm(self):
+        """
+        Moves every pedestrian one cell down the FMM distance field.
+        A pedestrian whose best cell is taken waits and becomes a little more patient,
+        a pedestrian next to a target stays there, or leaves the system if sinks is set.
+        All pedestrians that cannot influence each other are moved together as one batch:
+        a pedestrian is processed once no pedestrian before it in self.pedestrian_fmm that is
+        within two cells of it is still waiting to be processed,
+        which gives the same result as processing them one after another.
         :return:
         """
-        path = []
-        p_adj_cell = self.grid[p[0]][p[1]].get_adjacent()
-        p_adj = [(i.row, i.col) for i in p_adj_cell]
-        p_copy = p_adj
+        probe = self.instrumentation
+        if self.fmm_distance.size == 0:
+            self.evaluate_fmm_fields()
+            self.initialize_predicted_times()
+            if probe is not None:
+                probe.lap('fields')
+        rows, cols, speeds = self.pedestrian_fmm_arrays()
+        flat_state = self.state.reshape(-1)
+        flat_wait = self.wait_fmm_penalty.reshape(-1)
+        flat_travel_time = self.travel_time.reshape(-1)
+        flat_predicted_time = self.initial_predicted_time.reshape(-1)
+        window = np.array([(d_row, d_col) for d_row in range(-2, 3) for d_col in range(-2, 3)])
+
+        current = rows * self.cols + cols
+        moved = np.zeros(len(current), dtype=bool)
+        arrived = np.zeros(len(current), dtype=bool)
+        # Pedestrians that certainly wait this step are handled at once and left out of the scheduling below
+        choice, _ = self.select_fmm_cells(self.fmm_distance, rows, cols, flat_wait[current])
+        frozen = self.get_frozen_pedestrians(rows, cols, flat_state[choice] == PEDESTRIAN_CODE)
+        flat_wait[current[frozen]] += 0.001
+        if logger.isEnabledFor(logging.INFO):
+            for ped in np.flatnonzero(frozen).tolist():
+                logger.info("%s --> Wait", ((int(rows[ped]), int(cols[ped])), speeds[ped]))
+        if probe is not None:
+            probe.lap('active_set')
+            probe.count('frozen', np.count_nonzero(frozen))
+            probe.count('waits', np.count_nonzero(frozen))
+        undecided = np.flatnonzero(~frozen)
+        width = self.cols + 4
+        # Lowest undecided pedestrian within two cells of every cell, on a grid padded by two cells
+        lowest = np.full((self.rows + 4) * width, len(current), dtype=np.intp)
+        offsets = (window[:, 0] + 2) * width + window[:, 1] + 2
+        padded_links = self.get_padded_links(2)
+        while len(undecided):
+            # A pedestrian is ready when it is the lowest undecided pedestrian within two cells of its own cell
+            own = rows[undecided] * width + cols[undecided]
+            near = (own[:, None] + offsets).ravel()
+            if padded_links is not None:
+                near = padded_links[near]
+            np.minimum.at(lowest, near, np.repeat(undecided, len(window)))
+            is_ready = lowest[own + 2 * width + 2] == undecided
+            lowest[near] = len(current)
+            ready = undecided[is_ready]
+            undecided = undecided[~is_ready]
+            if probe is not None:
+                probe.lap('scheduling')
+                probe.count('rounds')
 
-        p_adj = np.asarray(p_adj)
-        row_idx = p_adj[:, 0]
-        col_idx = p_adj[:, 1]
-        d = distance[row_idx, col_idx]
+            choice, step_length = self.select_fmm_cells(self.fmm_distance, rows[ready], cols[ready],
+                                                        flat_wait[current[ready]])
+            waiting = flat_state[choice] == PEDESTRIAN_CODE
+            # Can be thought of as the level of patience
+            flat_wait[current[ready[waiting]]] += 0.001
+            if logger.isEnabledFor(logging.INFO):
+                for ped in ready[waiting].tolist():
+                    logger.info("%s --> Wait", ((int(rows[ped]), int(cols[ped])), speeds[ped]))
+            if probe is not None:
+                probe.lap('selection')
+                probe.count('waits', np.count_nonzero(waiting))
+                probe.count('at_target', np.count_nonzero(flat_state[choice] == TARGET_CODE))
 
-        idx = np.where(distance == np.amin(d))
-        idx = tuple(zip(idx[0], idx[1]))
-        tt = t[idx[0]]
-        idx = [i for i in idx if i in p_copy]
+            at_target = flat_state[choice] == TARGET_CODE
+            if self.sinks:
+                leaving = current[ready[~waiting & at_target]]
+                flat_travel_time[leaving] = 0
+                flat_predicted_time[leaving] = 0
+                flat_state[leaving] = EMPTY_CODE
+                arrived[ready[~waiting & at_target]] = True
+            moving = ~waiting & ~at_target
+            ready, choice, step_length = ready[moving], choice[moving], step_length[moving]
+            old = current[ready]
+            flat_travel_time[choice] = step_length / speeds[ready] + flat_travel_time[old]
+            flat_predicted_time[choice] = flat_predicted_time[old]
+            flat_travel_time[old] = 0
+            flat_predicted_time[old] = 0
+            flat_state[old] = EMPTY_CODE
+            flat_state[choice] = PEDESTRIAN_CODE
+            current[ready] = choice
+            moved[ready] = True
+            if probe is not None:
+                probe.lap('writes')
+                probe.count('moves', len(ready))
+        self.update_pedestrian_fmm_order(current, moved, arrived)
+        self.step_progress += np.count_nonzero(arrived)
+        if probe is not None:
+            probe.lap('writes')
+            probe.count('arrivals', np.count_nonzero(arrived))
+
+        if logger.isEnabledFor(logging.DEBUG):
+            for i in self.pedestrian:
+                logger.debug("%s ---> Travel Time: %s, Predicted Time: %s", (i.row, i.col), i.travel_time,
+                             i.initial_predicted_time)
+
+    def get_frozen_pedestrians(self, rows, cols, waiting):
+        """
+        Finds the pedestrians that certainly wait in this FMM step. A pedestrian whose best cell is taken
+        at the start of the step still waits when its turn comes, unless a pedestrian before it within two cells
+        moved first, since only those can change its 3x3 stencil. Such a pedestrian may move, so it is thawed,
+        and so are the waiting pedestrians behind it within two cells of it, and so on.
+        The pedestrians that stay frozen do not change the grid, so nobody needs to wait for them either.
+        Found again every step from all pedestrians, their growing wait penalties can change last step's answer.
+        :param rows: pedestrian rows, in processing order
+        :param cols: pedestrian cols
+        :param waiting: True for every pedestrian whose best cell is taken at the start of the step
+        :return: boolean array, True for the frozen pedestrians
+        """
+        frozen = waiting.copy()
+        if not frozen.any():
+            return frozen
+        # Position in the processing order of the pedestrian in every slot, cells without one (slot -1) read the last
+        position = np.full(self.agents.capacity + 1, -1, dtype=np.intp)
+        position[self.agents.active()] = np.arange(len(rows))
+        window = np.array([(d_row, d_col) for d_row in range(-2, 3) for d_col in range(-2, 3)])
+        thawed = np.flatnonzero(~frozen)
+        while len(thawed):
+            cells, inside = self.get_neighbour_cells(rows[thawed], cols[thawed], window)
+            near = position[self.agents.slot_at[cells]]
+            near = near[inside & (near > thawed[:, None])]
+            thawed = np.unique(near[frozen[near]])
+            frozen[thawed] = False
+        return frozen
 
-        path.append(idx[0])
-        time = (get_euclidean_distance(self.grid[p[0]][p[1]], self.grid[path[0][0]][path[0][1]])) / speed
-        return path, tt, time
+    def update_pedestrian_fmm_order(self, current, moved, arrived):
+        """
+        Writes the moves of an FMM step to the agent pool.
+        Pedestrians that moved go to the end of the processing order, keeping their order,
+        as removing and adding them one by one used to do.
+        :param current: flat grid index of every pedestrian after the step
+        :param moved: True for every pedestrian that moved
+        :param arrived: True for every pedestrian that left the system at a target
+        :return:
+        """
+        slots = self.agents.active()
+        # Removed first, another pedestrian may have moved onto the cell an arrived one left
+        self.agents.remove(slots[arrived])
+        self.agents.move(slots[moved], current[moved])
+        self.agents.reorder(np.concatenate([slots[~moved & ~arrived], slots[moved]]))
 
 
 def get_euclidean_distance(x: Cell, y: Cell):
@@ -460,25 +1277,48 @@ def get_euclidean_distance(x: Cell, y: Cell):
     return math.sqrt((x.row - y.row) ** 2 + (x.col - y.col) ** 2)
 
 
-def add_pedestrian_utilities(pedestrian: Cell):
+@functools.lru_cache(maxsize=None)
+def get_repulsion_kernel(r_max):
     """
-    Computes and adds pedestrian utilities to grid of cells surrounding pedestrian
-    at most R_MAX distance away.
-    :param pedestrian:
-    :return:
+    Returns the offsets and weights of the pedestrian repulsion exp(1 / (d^2 - r_max^2))
+    for every cell less than r_max away from a pedestrian. Computed once per r_max.
+    :param r_max:
+    :return: (row offsets, col offsets, weights) as read only arrays
     """
-    for cell in pedestrian.get_pedestrian_grid(R_MAX):
-        distance = get_euclidean_distance(pedestrian, cell)
-        if distance < R_MAX:
-            cell.pedestrian_utility += math.exp(1 / (distance ** 2 - R_MAX ** 2))
+    d_rows, d_cols, weights = [], [], []
+    for d_row in range(-r_max, r_max + 1):
+        for d_col in range(-r_max, r_max + 1):
+            distance = math.sqrt(d_row ** 2 + d_col ** 2)
+            if distance < r_max:
+                d_rows.append(d_row)
+                d_cols.append(d_col)
+                weights.append(math.exp(1 / (distance ** 2 - r_max ** 2)))
+    kernel = (np.array(d_rows, dtype=np.intp), np.array(d_cols, dtype=np.intp), np.array(weights))
+    for array in kernel:
+        array.setflags(write=False)
+    return kernel
 
 
-def reset_pedestrian_utilities(pedestrian: Cell):
+def get_pedestrian_utilities(rows, cols, state, r_max=R_MAX, links=None):
     """
-    Sets pedestrian utilities for the grid of cells surrounding pedestrian
-    at most R_MAX distance away to 0.
-    :param pedestrian:
-    :return:
+    Computes the pedestrian utility field by scatter adding the repulsion kernel around every pedestrian.
+    Obstacle cells get no utility.
+    :param rows: pedestrian rows
+    :param cols: pedestrian cols
+    :param state: (rows, cols) array of state codes
+    :param r_max:
+    :param links: see System.links, the kernel lands on the cells the covered cells stand for
+    :return: (rows, cols) array of pedestrian utilities
     """
-    for cell in pedestrian.get_pedestrian_grid(R_MAX):
-        cell.pedestrian_utility = 0
+    grid_rows, grid_cols = state.shape
+    d_rows, d_cols, weights = get_repulsion_kernel(r_max)
+    k_rows = rows[:, None] + d_rows
+    k_cols = cols[:, None] + d_cols
+    inside = (k_rows >= 0) & (k_rows < grid_rows) & (k_cols >= 0) & (k_cols < grid_cols)
+    cells = (k_rows * grid_cols + k_cols)[inside]
+    if links is not None:
+        cells = links[cells]
+    utilities = np.bincount(cells, np.broadcast_to(weights, inside.shape)[inside], minlength=state.size)
+    utilities = utilities.reshape(state.shape)
+    utilities[state == OBSTACLE_CODE] = 0
+    return utilities
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Streams pedestrian trajectories to a compact binary file.
+
+The file starts with MAGIC, the length of a json header and the header itself, which lists the columns
+and their dtypes. After that come chunks: the number of rows as uint32 followed by every column
+stored contiguously. Chunks are only ever appended, so memory use is bounded by the chunk size
+and a crashed run leaves every chunk written before the crash readable.
+"""
+import json
+import struct
+
+import numpy as np
+
+MAGIC = b'MLCMSTRJ'
+VERSION = 2
+DEFAULT_CHUNK_ROWS = 1 << 16
+
+COLUMNS = (
+    ('step', np.dtype('<u4')),
+    ('pedestrian', np.dtype('<u4')),  # Id of the pedestrian in the agent pool, the same in every step
+    ('row', np.dtype('<i4')),
+    ('col', np.dtype('<i4')),
+    ('travel_time', np.dtype('<f4')),
+    ('initial_predicted_time', np.dtype('<f4')),
+)
+
+
+class TrajectoryRecorder:
+    """
+    Step hook that appends the position and FMM times of every pedestrian to a trajectory file.
+    Use it as system.step_hooks.append(recorder) and close it when the run is over.
+    """
+
+    def __init__(self, path, chunk_rows=DEFAULT_CHUNK_ROWS):
+        self.path = path
+        self.chunk_rows = chunk_rows
+        self.buffer = {name: [] for name, _ in COLUMNS}
+        self.buffered_rows = 0
+        self.file = open(path, 'wb')
+        header = json.dumps({'version': VERSION, 'columns': [[name, dtype.str] for name, dtype in COLUMNS]}).encode()
+        self.file.write(MAGIC + struct.pack('<I', len(header)) + header)
+
+    def __call__(self, system):
+        self.record(system)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def record(self, system):
+        """
+        Buffers the current pedestrians of the system and writes a chunk once enough rows are buffered.
+        :param system:
+        :return:
+        """
+        rows, cols = system.pedestrian_coordinates()
+        count = len(rows)
+        values = {
+            'step': np.full(count, system.step_count),
+            'pedestrian': system.agents.ids[system.agents.active()],
+            'row': rows,
+            'col': cols,
+            'travel_time': system.travel_time[rows, cols],
+            'initial_predicted_time': system.initial_predicted_time[rows, cols],
+        }
+        for name, dtype in COLUMNS:
+            self.buffer[name].append(values[name].astype(dtype))
+        self.buffered_rows += count
+        if self.buffered_rows >= self.chunk_rows:
+            self.flush()
+
+    def flush(self):
+        """
+        Appends the buffered rows to the file as one chunk.
+        :return:
+        """
+        if not self.buffered_rows:
+            return
+        self.file.write(struct.pack('<I', self.buffered_rows))
+        for name, _ in COLUMNS:
+            np.concatenate(self.buffer[name]).tofile(self.file)
+            self.buffer[name] = []
+        self.buffered_rows = 0
+        self.file.flush()
+
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+
+def iter_chunks(path):
+    """
+    Yields the chunks of a trajectory file as dictionaries of column arrays.
+    :param path:
+    :return:
+    """
+    with open(path, 'rb') as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(path + " is not a trajectory file")
+        header_length, = struct.unpack('<I', file.read(4))
+        header = json.loads(file.read(header_length))
+        columns = [(name, np.dtype(dtype)) for name, dtype in header['columns']]
+        while True:
+            count = file.read(4)
+            if len(count) < 4:
+                return
+            count, = struct.unpack('<I', count)
+            chunk = {name: np.fromfile(file, dtype=dtype, count=count) for name, dtype in columns}
+            if any(len(column) < count for column in chunk.values()):
+                return  # Chunk cut short by a crash
+            yield chunk
+
+
+def read_trajectories(path):
+    """
+    Reads a whole trajectory file.
+    :param path:
+    :return: dictionary of column arrays
+    """
+    chunks = list(iter_chunks(path))
+    if not chunks:
+        return {name: np.empty(0, dtype=dtype) for name, dtype in COLUMNS}
+    return {name: np.concatenate([chunk[name] for chunk in chunks]) for name in chunks[0]}
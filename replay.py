@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Recording of the grid state of every step as fixed-size frames, for replay without re-simulating.
+
+A frames file is a HEADER_SIZE byte header (MAGIC, version, rows, cols, cell size) followed by one
+rows * cols int8 frame of state codes per step. Since all frames have the same size, frame i starts at
+HEADER_SIZE + i * rows * cols and the whole file can be memory-mapped, however large it is.
+"""
+import os
+import struct
+
+import numpy as np
+
+MAGIC = b'MLCMSFRM'
+VERSION = 1
+HEADER = struct.Struct('<8sHIII')
+HEADER_SIZE = 64
+FRAMES_EXTENSION = '.frames'
+
+
+class FrameWriter:
+    """
+    Step hook that appends the grid state of the system to a frames file after every step.
+    The state at the time the writer is created is stored as frame 0.
+    """
+
+    def __init__(self, path, system, cell_size):
+        self.path = path
+        self.file = open(path, 'wb')
+        header = HEADER.pack(MAGIC, VERSION, system.rows, system.cols, cell_size)
+        self.file.write(header.ljust(HEADER_SIZE, b'\0'))
+        self.frames = 0
+        self.record(system)
+
+    def __call__(self, system):
+        self.record(system)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def record(self, system):
+        self.file.write(np.ascontiguousarray(system.state, dtype=np.int8).tobytes())
+        self.file.flush()
+        self.frames += 1
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+
+class FrameReader:
+    """
+    Memory-mapped, read only view of a frames file. Frames are only read from disk when they are accessed.
+    A file without a frame yet, e.g. of a run that just started, has length 0 until refresh finds frames.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as file:
+            magic, version, self.rows, self.cols, self.cell_size = HEADER.unpack(file.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError(path + " is not a frames file")
+        if version != VERSION:
+            raise ValueError("Unsupported frames file version " + str(version))
+        self.frames = None
+        self.refresh()
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __getitem__(self, step):
+        if not len(self.frames):
+            raise IndexError(self.path + " has no frames yet")
+        return self.frames[step]
+
+    def refresh(self):
+        """
+        Maps the frames written so far, call it again to see frames appended since.
+        :return:
+        """
+        frame_size = self.rows * self.cols
+        count = (os.path.getsize(self.path) - HEADER_SIZE) // frame_size
+        if count <= 0:
+            # np.memmap cannot map zero bytes
+            self.frames = np.empty((0, self.rows, self.cols), dtype=np.int8)
+            return
+        self.frames = np.memmap(self.path, dtype=np.int8, mode='r', offset=HEADER_SIZE,
+                                shape=(count, self.rows, self.cols))
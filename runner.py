@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Runs a scenario without the GUI until every pedestrian has evacuated or a step limit is hit.
+
+    python3 runner.py Test_Scenarios/scenario_final_task3.json --mode dijkstra --max-steps 1000
+"""
+import argparse
+import json
+import logging
+import time
+
+import model as model
+from checkpoint import Checkpointer, load_checkpoint, save_checkpoint
+from field_cache import FieldCache
+from instrumentation import StepInstrumentation
+from measurement import Measurements
+from recorder import TrajectoryRecorder
+from scenario import get_measurements, initialize_system
+
+MAX_STEPS = 10000
+STALL_LIMIT = 10  # Steps in a row without progress after which a run counts as gridlocked
+
+
+def run_system(system, mode, max_steps=MAX_STEPS, stall_limit=STALL_LIMIT):
+    """
+    Steps the system with the given mode until it is evacuated, gridlocked or max_steps steps have been made.
+    :param system:
+    :param mode:
+    :param max_steps:
+    :param stall_limit: steps in a row without progress that stop the run, see System.is_gridlocked, 0 never stops
+    :return: dictionary with the number of steps, wall time and steps per second,
+             and the report of System.get_gridlock_report as 'gridlock' if the run stopped on a gridlock
+    """
+    steps = 0
+    start = time.perf_counter()
+    gridlocked = False
+    while steps < max_steps and not system.is_evacuated():
+        system.step(mode)
+        steps += 1
+        if stall_limit and system.is_gridlocked(stall_limit):
+            gridlocked = True
+            break
+    wall_time = time.perf_counter() - start
+    evacuated = system.is_evacuated()
+    rows, cols = system.pedestrian_coordinates()
+    return {
+        'mode': mode,
+        'steps': steps,
+        'evacuated': evacuated,
+        'evacuation_time': steps if evacuated else None,
+        'max_travel_time': float(system.travel_time[rows, cols].max()) if len(rows) else 0.0,
+        'remaining': len(rows),
+        'wall_time': wall_time,
+        'steps_per_second': steps / wall_time if wall_time > 0 else float('inf'),
+        'gridlocked': gridlocked,
+        'gridlock': system.get_gridlock_report() if gridlocked else None,
+    }
+
+
+def apply_parameters(system, parameters):
+    """
+    Overrides model constants of a freshly loaded system.
+    :param system:
+    :param parameters: dictionary with any of 'r_max', 'dx' and 'speed' (one speed for every pedestrian)
+    :return:
+    """
+    unknown = set(parameters) - {'r_max', 'dx', 'speed'}
+    if unknown:
+        raise ValueError("Unknown parameters: " + ", ".join(sorted(unknown)))
+    if parameters.get('r_max') is not None:
+        system.r_max = int(parameters['r_max'])
+    if parameters.get('dx') is not None:
+        system.dx = float(parameters['dx'])
+    if parameters.get('speed') is not None:
+        system.initialize_speeds([float(parameters['speed'])] * len(system.agents))
+
+
+def run_scenario(file_name, mode, max_steps=MAX_STEPS, cache=None, parameters=None, record=None, profile=False,
+                 stall_limit=STALL_LIMIT, checkpoint=None, checkpoint_every=0, resume=None):
+    """
+    Loads the scenario file and runs it headless with the given mode.
+    :param file_name:
+    :param mode:
+    :param max_steps:
+    :param cache: optional field_cache.FieldCache for the precomputed fields
+    :param parameters: optional model constants to override, see apply_parameters
+    :param record: optional file name to stream the trajectories of the run to
+    :param profile: collect per-phase timings and counters, returned as result['profile']
+    :param stall_limit: see run_system
+    :param checkpoint: optional file name to save the state of the system to at the end of the run
+    :param checkpoint_every: also save it every this many steps, 0 for only at the end
+    :param resume: optional checkpoint file to continue from instead of the start of the scenario,
+                   its measurements then start from the resumed step
+    :return: dictionary with the run statistics, see run_system,
+             and the summary of the scenario's measurement areas and cross-sections as result['measurements']
+    """
+    start = time.perf_counter()
+    if resume is None:
+        system, _ = initialize_system(file_name)
+    else:
+        system = load_checkpoint(resume)
+        with open(file_name) as scenario:
+            measurements = get_measurements(json.load(scenario), system.layout)
+        if measurements is not None:
+            measurements.track(system)
+            system.step_hooks.append(measurements)
+    system.field_cache = cache
+    apply_parameters(system, parameters or {})
+    if profile:
+        system.instrumentation = StepInstrumentation(keep=1)
+    load_time = time.perf_counter() - start
+    if checkpoint is not None and checkpoint_every > 0:
+        system.step_hooks.append(Checkpointer(checkpoint, checkpoint_every))
+    if record is None:
+        result = run_system(system, mode, max_steps, stall_limit)
+    else:
+        with TrajectoryRecorder(record) as recorder:
+            recorder.record(system)
+            system.step_hooks.append(recorder)
+            result = run_system(system, mode, max_steps, stall_limit)
+    if checkpoint is not None:
+        save_checkpoint(system, checkpoint)
+    result['scenario'] = file_name
+    result['load_time'] = load_time
+    if profile:
+        result['profile'] = system.instrumentation.totals()
+    for hook in system.step_hooks:
+        if isinstance(hook, Measurements):
+            result['measurements'] = hook.summary()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a Cellular Automaton scenario without the GUI.")
+    parser.add_argument('scenario', help="path to a scenario json file")
+    parser.add_argument('--mode', choices=model.MODES, default=model.DIJKSTRA)
+    parser.add_argument('--max-steps', type=int, default=MAX_STEPS)
+    parser.add_argument('--cache', metavar='DIR', help="directory to cache precomputed distance fields in")
+    parser.add_argument('--record', metavar='FILE', help="file to stream the pedestrian trajectories to")
+    parser.add_argument('--profile', action='store_true', help="report the time spent in every phase of a step")
+    parser.add_argument('--stall-limit', type=int, default=STALL_LIMIT,
+                        help="stop after this many steps in a row in which nothing moved, 0 never stops")
+    parser.add_argument('--checkpoint', metavar='FILE', help="file to save the state of the system to when the run ends")
+    parser.add_argument('--checkpoint-every', type=int, default=0, metavar='STEPS',
+                        help="also save the checkpoint every this many steps")
+    parser.add_argument('--resume', metavar='FILE', help="continue from a checkpoint of the scenario")
+    parser.add_argument('--measurements', metavar='FILE',
+                        help="json file for the statistics of the scenario's measurement areas and cross-sections")
+    parser.add_argument('--log-level', default='WARNING', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help="INFO logs waiting FMM pedestrians, DEBUG also their positions and times")
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level, format="%(message)s")
+
+    cache = FieldCache(args.cache) if args.cache else None
+    result = run_scenario(args.scenario, args.mode, args.max_steps, cache, record=args.record, profile=args.profile,
+                          stall_limit=args.stall_limit, checkpoint=args.checkpoint,
+                          checkpoint_every=args.checkpoint_every, resume=args.resume)
+    print("Scenario:         ", result['scenario'])
+    print("Mode:             ", result['mode'])
+    print("Evacuated:        ", result['evacuated'], "(" + str(result['remaining']) + " pedestrians left)")
+    print("Steps:            ", result['steps'])
+    print("Wall time:        ", "{:.3f} s".format(result['wall_time']))
+    print("Steps per second: ", "{:.1f}".format(result['steps_per_second']))
+    if result['gridlocked']:
+        gridlock = result['gridlock']
+        print("Gridlocked:        no progress for", gridlock['stalled_steps'], "steps,",
+              len(gridlock['stuck']), "pedestrians stuck away from a target:", gridlock['stuck'][:10])
+    if args.profile:
+        profile = result['profile']
+        for phase, seconds in sorted(profile['times'].items(), key=lambda item: -item[1]):
+            print("  {:<16}".format(phase), "{:.3f} s".format(seconds))
+        for counter, value in sorted(profile['counters'].items()):
+            print("  {:<16}".format(counter), value)
+    if 'measurements' in result:
+        measurements = result['measurements']
+        for area in measurements['areas']:
+            print("  {:<16}".format(area['name']), "density {:.3f} 1/m^2, speed {:.3f} m/step".format(
+                area['density'].get('mean', 0.0), area['speed'].get('mean', 0.0)))
+        for section in measurements['cross_sections']:
+            print("  {:<16}".format(section['name']), "flow {:.3f} 1/step, {} forward, {} backward".format(
+                section['flow'], section['forward'], section['backward']))
+        if args.measurements:
+            with open(args.measurements, 'w') as file:
+                json.dump(measurements, file, indent=1)
+
+
+if __name__ == '__main__':
+    main()
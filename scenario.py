@@ -0,0 +1,267 @@
+import argparse
+import json
+import os
+
+import numpy as np
+
+import model as model
+import tiles as tiles
+from agents import Source
+from measurement import CrossSection, MeasurementArea, Measurements
+
+MASK_THRESHOLD = 128  # Pixels of a PNG mask darker than this are obstacles
+
+
+def initialize_system(file_name):
+    """
+    Reads the scenario file and initializes the system.
+    Obstacles can be given in any combination of these keys, see get_obstacle_mask:
+    "obstacles" (list of [row, col]), "obstacle_rectangles" (list of [row, col, height, width]),
+    "obstacle_runs" (list of [row, col, length] runs along a row) and
+    "obstacle_mask" (.npy or .png file, relative to the scenario file).
+    Exits are given as "target": [row, col], or as "targets": a list of them.
+    "sources" lists rectangles spawning pedestrians, see get_sources, and "sinks": true
+    makes pedestrians leave the system at a target in every mode.
+    "measurement_areas" and "cross_sections" add a measurement.Measurements step hook, see get_measurements.
+    A scenario with "tile_size" is a sparse venue, see tiles.get_tile_map: only its walkable tiles are allocated
+    and the system holds their packed parts, all coordinates of the file stay venue coordinates.
+    :param file_name:
+    :return:
+    """
+    with open(file_name) as scenario:
+        data = json.load(scenario)
+    if 'tile_size' in data:
+        system, _ = tiles.get_tile_map(data).pack()
+        return finish_system(system, data)
+    mask = load_mask(data, os.path.dirname(file_name))
+    rows, cols = get_grid_shape(data, mask)
+    system = model.System(cols, rows)
+
+    for col, row in data.get('pedestrians', []):
+        system.add_pedestrian_at(coordinates=(col, row))
+
+    if 'speeds' in data:
+        system.initialize_speeds(data["speeds"])
+    else:
+        system.initialize_speeds()
+
+    system.add_obstacles(get_obstacle_mask(data, rows, cols, mask))
+
+    targets = data['targets'] if 'targets' in data else [data['target']]
+    for col, row in targets:
+        system.add_target_at(coordinates=(col, row))
+    return finish_system(system, data)
+
+
+def finish_system(system, data):
+    """
+    Adds the sources, sinks and measurements of a scenario to its system.
+    :param system:
+    :param data: scenario dictionary
+    :return: system, cell size
+    """
+    system.sources = get_sources(data, system.layout)
+    system.sinks = bool(data.get('sinks', False))
+    measurements = get_measurements(data, system.layout)
+    if measurements is not None:
+        measurements.track(system)
+        system.step_hooks.append(measurements)
+
+    if 'cell_size' in data:
+        cell_size = data["cell_size"]
+    else:
+        cell_size = 5
+
+    return system, cell_size
+
+
+def get_grid_shape(data, mask=None):
+    """
+    Returns the grid size of a scenario, "rows" and "cols" if given, else the shape of its obstacle mask.
+    :param data: scenario dictionary
+    :param mask: obstacle mask loaded by load_mask, or None
+    :return: (rows, cols)
+    """
+    missing = [key for key in ('rows', 'cols') if key not in data]
+    if missing and mask is None:
+        raise ValueError("Scenario has no " + " or ".join(repr(key) for key in missing)
+                         + " and no 'obstacle_mask' to take the grid size from")
+    rows = data['rows'] if 'rows' in data else mask.shape[0]
+    cols = data['cols'] if 'cols' in data else mask.shape[1]
+    return rows, cols
+
+
+def load_mask(data, directory):
+    """
+    Loads the obstacle mask file named by data["obstacle_mask"], if there is one.
+    A .npy file is memory-mapped and every non zero cell is an obstacle,
+    in a .png file every pixel darker than MASK_THRESHOLD is (this needs Pillow).
+    :param data: scenario dictionary
+    :param directory: directory the mask path is relative to
+    :return: (rows, cols) boolean array or None
+    """
+    if 'obstacle_mask' not in data:
+        return None
+    path = os.path.join(directory, data['obstacle_mask'])
+    if path.endswith('.npy'):
+        return np.load(path, mmap_mode='r') != 0
+    if path.endswith('.png'):
+        try:
+            from PIL import Image
+        except ImportError:
+            raise ImportError("Reading PNG obstacle masks needs Pillow (pip install Pillow), or use a .npy mask")
+        with Image.open(path) as image:
+            return np.asarray(image.convert('L')) < MASK_THRESHOLD
+    raise ValueError("Obstacle mask must be a .npy or .png file: " + path)
+
+
+def get_obstacle_mask(data, rows, cols, mask=None):
+    """
+    Combines all obstacle encodings of a scenario into one boolean array.
+    :param data: scenario dictionary
+    :param rows:
+    :param cols:
+    :param mask: obstacle mask loaded by load_mask
+    :return: (rows, cols) boolean array
+    """
+    if mask is None:
+        obstacles = np.zeros((rows, cols), dtype=bool)
+    elif mask.shape != (rows, cols):
+        raise ValueError("Obstacle mask has shape " + str(mask.shape) + " but the scenario has "
+                         + str((rows, cols)))
+    else:
+        obstacles = np.array(mask)
+
+    cells = np.asarray(data.get('obstacles', []), dtype=np.intp).reshape(-1, 2)
+    outside = np.any(cells < 0, axis=1) | (cells[:, 0] >= rows) | (cells[:, 1] >= cols)
+    check_entries("Obstacle", cells, outside, rows, cols)
+    obstacles[cells[:, 0], cells[:, 1]] = True
+
+    rectangles = np.asarray(data.get('obstacle_rectangles', []), dtype=np.intp).reshape(-1, 4)
+    outside = (np.any(rectangles < 0, axis=1) | (rectangles[:, 0] + rectangles[:, 2] > rows)
+               | (rectangles[:, 1] + rectangles[:, 3] > cols))
+    check_entries("Obstacle rectangle", rectangles, outside, rows, cols)
+    for row, col, height, width in rectangles.tolist():
+        obstacles[row:row + height, col:col + width] = True
+
+    runs = np.asarray(data.get('obstacle_runs', []), dtype=np.intp).reshape(-1, 3)
+    outside = np.any(runs < 0, axis=1) | (runs[:, 0] >= rows) | (runs[:, 1] + runs[:, 2] > cols)
+    check_entries("Obstacle run", runs, outside, rows, cols)
+    starts = runs[:, 0] * cols + runs[:, 1]
+    lengths = runs[:, 2]
+    # Flat index of every cell of every run: the start of its run plus its position in the run
+    positions = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    obstacles.reshape(-1)[np.repeat(starts, lengths) + positions] = True
+    return obstacles
+
+
+def check_entries(name, entries, bad, rows, cols):
+    """
+    Raises a ValueError naming the first entry of a scenario list that does not lie within the grid.
+    :param name: what the entries are, for the message
+    :param entries: integer array with one entry per row
+    :param bad: boolean array, True for the entries outside the grid
+    :param rows:
+    :param cols:
+    :return:
+    """
+    if np.any(bad):
+        raise ValueError(name + " " + str(entries[np.argmax(bad)].tolist()) + " does not lie within the grid of "
+                         + str(rows) + " rows and " + str(cols) + " cols")
+
+
+def get_sources(data, layout=None):
+    """
+    Creates the pedestrian sources of a scenario. Each entry of data["sources"] has
+    "rectangle": [row, col, height, width] and "rate" in pedestrians per step,
+    optionally "speed" (default 1), "total" (default no limit) and "seed" (default the position in the list).
+    :param data: scenario dictionary
+    :param layout: tiles.TileLayout of a sparse venue, its rectangles are translated to the packed grid
+    :return: list of agents.Source
+    """
+    return [Source(*to_packed_rectangle(layout, source['rectangle']), rate=source['rate'],
+                   speed=source.get('speed', 1), total=source.get('total'), seed=source.get('seed', number))
+            for number, source in enumerate(data.get('sources', []))]
+
+
+def to_packed_rectangle(layout, rectangle):
+    return rectangle if layout is None else layout.to_packed_rectangle(*rectangle)
+
+
+def get_measurements(data, layout=None):
+    """
+    Creates the measurements of a scenario. Each entry of data["measurement_areas"] has a "name" and
+    "rectangle": [row, col, height, width], each entry of data["cross_sections"] a "name" and
+    "line": [start row, start col, end row, end col]. "step_time" gives the seconds per step (default 1).
+    :param data: scenario dictionary
+    :param layout: tiles.TileLayout of a sparse venue, areas and lines must each lie within one of its parts
+    :return: measurement.Measurements, or None if the scenario measures nothing
+    """
+    areas = [MeasurementArea(area['name'], *to_packed_rectangle(layout, area['rectangle']))
+             for area in data.get('measurement_areas', [])]
+    sections = []
+    for section in data.get('cross_sections', []):
+        start_row, start_col, end_row, end_col = section['line']
+        if layout is not None:
+            top, left = min(start_row, end_row), min(start_col, end_col)
+            row, col, _, _ = layout.to_packed_rectangle(top, left, abs(end_row - start_row) + 1,
+                                                        abs(end_col - start_col) + 1)
+            start_row, start_col, end_row, end_col = (start_row + row - top, start_col + col - left,
+                                                      end_row + row - top, end_col + col - left)
+        sections.append(CrossSection(section['name'], start_row, start_col, end_row, end_col))
+    if not areas and not sections:
+        return None
+    return Measurements(areas, sections, data.get('step_time', 1.0))
+
+
+def get_obstacle_runs(obstacles):
+    """
+    Run-length encodes an obstacle mask row by row.
+    :param obstacles: (rows, cols) boolean array
+    :return: list of [row, col, length]
+    """
+    padded = np.zeros((obstacles.shape[0], obstacles.shape[1] + 2), dtype=np.int8)
+    padded[:, 1:-1] = obstacles
+    edges = np.diff(padded, axis=1)
+    start_rows, start_cols = np.nonzero(edges == 1)
+    _, end_cols = np.nonzero(edges == -1)  # Row-major order pairs every end with its start
+    return np.column_stack([start_rows, start_cols, end_cols - start_cols]).tolist()
+
+
+def compact_scenario(file_name, output, mask_file=None):
+    """
+    Rewrites a scenario with its obstacles as runs, or as a .npy mask if mask_file is given.
+    :param file_name: scenario to convert
+    :param output: file name of the converted scenario
+    :param mask_file: optional .npy file name for the mask, relative to the output file
+    :return:
+    """
+    with open(file_name) as scenario:
+        data = json.load(scenario)
+    mask = load_mask(data, os.path.dirname(file_name))
+    rows, cols = get_grid_shape(data, mask)
+    obstacles = get_obstacle_mask(data, rows, cols, mask)
+    for key in ('obstacles', 'obstacle_rectangles', 'obstacle_runs', 'obstacle_mask'):
+        data.pop(key, None)
+    # The grid size may have come from the mask that is dropped here
+    data['rows'], data['cols'] = rows, cols
+    if mask_file is None:
+        data['obstacle_runs'] = get_obstacle_runs(obstacles)
+    else:
+        np.save(os.path.join(os.path.dirname(output), mask_file), obstacles)
+        data['obstacle_mask'] = mask_file
+    with open(output, 'w') as file:
+        json.dump(data, file, separators=(',', ':'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a scenario to the compact obstacle encodings.")
+    parser.add_argument('scenario', help="scenario json file to convert")
+    parser.add_argument('output', help="converted scenario json file")
+    parser.add_argument('--mask', metavar='NPY', help="store the obstacles in this .npy mask instead of as runs")
+    args = parser.parse_args()
+    compact_scenario(args.scenario, args.output, args.mask)
+
+
+if __name__ == '__main__':
+    main()
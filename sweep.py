@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Runs every combination of scenarios, update modes and model constants on a process pool
+and collects the results into one table.
+
+    python3 sweep.py Test_Scenarios/*.json --modes dijkstra fmm --r-max 1 2 3 --dx 0.2 0.4 --output results.csv
+"""
+import argparse
+import csv
+import itertools
+import os
+import sys
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import model as model
+import runner as runner
+from field_cache import FieldCache
+
+COLUMNS = ['scenario', 'mode', 'r_max', 'dx', 'speed', 'steps', 'evacuated', 'evacuation_time', 'max_travel_time',
+           'remaining', 'gridlocked', 'load_time', 'wall_time', 'steps_per_second', 'error']
+
+
+def get_jobs(scenarios, modes, r_max=(None,), dx=(None,), speed=(None,)):
+    """
+    Returns one job per combination of the given values, None keeps the scenario's own value.
+    :param scenarios: scenario file names
+    :param modes: update modes
+    :param r_max: pedestrian repulsion ranges
+    :param dx: grid spacings
+    :param speed: pedestrian speeds
+    :return: list of job dictionaries
+    """
+    return [{'scenario': scenario, 'mode': mode, 'r_max': r, 'dx': d, 'speed': s}
+            for scenario, mode, r, d, s in itertools.product(scenarios, modes, r_max, dx, speed)]
+
+
+def run_job(job, max_steps=runner.MAX_STEPS, cache_directory=None):
+    """
+    Runs a single job; any exception is recorded in the result instead of being raised.
+    :param job:
+    :param max_steps:
+    :param cache_directory: optional directory of a field_cache.FieldCache shared by all workers
+    :return: result row
+    """
+    row = dict(job)
+    try:
+        cache = FieldCache(cache_directory) if cache_directory else None
+        parameters = {'r_max': job['r_max'], 'dx': job['dx'], 'speed': job['speed']}
+        result = runner.run_scenario(job['scenario'], job['mode'], max_steps, cache, parameters)
+        row.update({column: result[column] for column in COLUMNS if column in result and column not in job})
+    except Exception:
+        row['error'] = traceback.format_exc(limit=3).strip().splitlines()[-1]
+    return row
+
+
+def get_error_row(job, error):
+    return dict(job, error=type(error).__name__ + ": " + str(error))
+
+
+def run_sweep(jobs, max_steps=runner.MAX_STEPS, workers=None, cache_directory=None, on_result=None, run=run_job):
+    """
+    Fans the jobs out over a process pool.
+    A job that raises, or whose worker process dies, gives a row with the error filled in.
+    A dying worker breaks the whole pool, so the jobs it left unfinished run again, each in a process of its own,
+    and only the job that crashes again gets the error.
+    :param jobs:
+    :param max_steps:
+    :param workers: number of processes, defaults to the number of CPUs
+    :param cache_directory:
+    :param on_result: optional function called with every row as soon as it is done
+    :param run: function running one job in a worker, run_job by default
+    :return: result rows in the order of jobs
+    """
+    workers = workers or os.cpu_count()
+    rows = [None] * len(jobs)
+
+    def finish(i, row):
+        rows[i] = row
+        if on_result is not None:
+            on_result(row)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(run, job, max_steps, cache_directory): i for i, job in enumerate(jobs)}
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                finish(i, future.result())
+            except BrokenProcessPool:
+                pass  # run again on its own below
+            except Exception as error:
+                finish(i, get_error_row(jobs[i], error))
+
+    pending = [i for i, row in enumerate(rows) if row is None]
+    running = {}
+    while pending or running:
+        while pending and len(running) < workers:
+            i = pending.pop(0)
+            executor = ProcessPoolExecutor(max_workers=1)
+            running[executor.submit(run, jobs[i], max_steps, cache_directory)] = (i, executor)
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            i, executor = running.pop(future)
+            executor.shutdown()
+            try:
+                finish(i, future.result())
+            except Exception as error:
+                finish(i, get_error_row(jobs[i], error))
+    return rows
+
+
+def write_results(rows, file):
+    writer = csv.DictWriter(file, fieldnames=COLUMNS, extrasaction='ignore')
+    writer.writeheader()
+    writer.writerows(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a parameter sweep over scenarios on a process pool.")
+    parser.add_argument('scenarios', nargs='+', help="scenario json files")
+    parser.add_argument('--modes', nargs='+', choices=model.MODES, default=list(model.MODES))
+    parser.add_argument('--r-max', nargs='+', type=int, default=[None], help="pedestrian repulsion ranges")
+    parser.add_argument('--dx', nargs='+', type=float, default=[None], help="grid spacings for FMM travel times")
+    parser.add_argument('--speeds', nargs='+', type=float, default=[None],
+                        help="speeds given to every pedestrian, by default the scenario speeds are used")
+    parser.add_argument('--max-steps', type=int, default=runner.MAX_STEPS)
+    parser.add_argument('--workers', type=int, default=None, help="number of processes, defaults to all CPUs")
+    parser.add_argument('--cache', metavar='DIR', help="directory to cache precomputed distance fields in")
+    parser.add_argument('--output', help="csv file for the results table, printed to stdout by default")
+    args = parser.parse_args()
+
+    jobs = get_jobs(args.scenarios, args.modes, args.r_max, args.dx, args.speeds)
+    done = []
+
+    def report(row):
+        done.append(row)
+        status = "error: " + row['error'] if row.get('error') else "{} steps".format(row.get('steps'))
+        print("[{}/{}] {} {} -> {}".format(len(done), len(jobs), row['scenario'], row['mode'], status),
+              file=sys.stderr)
+
+    rows = run_sweep(jobs, args.max_steps, args.workers, args.cache, report)
+    if args.output:
+        with open(args.output, 'w', newline='') as file:
+            write_results(rows, file)
+    else:
+        write_results(rows, sys.stdout)
+
+
+if __name__ == '__main__':
+    main()
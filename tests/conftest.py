@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The modules live flat in the repository root and import each other by name
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+import agents as agents
+
+
+def test_pool_grows_with_pedestrians_not_cells():
+    pool = agents.AgentPool(10 ** 8)
+    assert pool.capacity == agents.INITIAL_CAPACITY
+    slots = [pool.add(index) for index in range(agents.INITIAL_CAPACITY + 1)]
+    assert slots == list(range(agents.INITIAL_CAPACITY + 1))
+    assert pool.capacity == 2 * agents.INITIAL_CAPACITY
+    assert len(pool) == agents.INITIAL_CAPACITY + 1
+    np.testing.assert_array_equal(pool.active(), slots)
+
+
+def test_removed_slots_leave_order_and_are_reused():
+    pool = agents.AgentPool(100)
+    for index in range(10):
+        pool.add(index)
+    pool.remove(np.array([3, 7]))
+    assert len(pool) == 8
+    assert pool.slot_at[3] == -1 and pool.slot_at[7] == -1
+    np.testing.assert_array_equal(pool.active(), [0, 1, 2, 4, 5, 6, 8, 9])
+    # Freed slots are reused last in first out, before new ones
+    assert pool.add(50) == 7
+    assert pool.add(51) == 3
+    assert pool.add(52) == 10
+    np.testing.assert_array_equal(pool.active(), [0, 1, 2, 4, 5, 6, 8, 9, 7, 3, 10])
+
+
+def test_slot_removed_before_order_is_built():
+    pool = agents.AgentPool(4, limit=2)
+    pool.add(0)
+    pool.add(1)
+    pool.remove(np.array([1]))
+    # The pool is full until the removed slot leaves the order, add builds it
+    assert pool.add(2) == 1
+    np.testing.assert_array_equal(pool.active(), [0, 1])
+    with pytest.raises(agents.PoolFull):
+        pool.add(3)
+
+
+def test_clear_frees_every_slot():
+    pool = agents.AgentPool(100)
+    for index in range(5):
+        pool.add(index)
+    pool.clear()
+    assert len(pool) == 0 and pool.vacancies() == 100
+    assert np.all(pool.slot_at == -1)
+    assert pool.add(20) == 0
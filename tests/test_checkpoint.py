@@ -0,0 +1,82 @@
+import numpy as np
+import pytest
+
+import checkpoint as checkpoint
+import model as model
+from agents import Source
+
+
+def get_system():
+    rng = np.random.default_rng(1)
+    system = model.System(40, 25)
+    obstacles = rng.random((25, 40)) < 0.1
+    obstacles[:, -3:] = False
+    system.add_obstacles(obstacles)
+    system.add_target_at((12, 39))
+    system.add_target_at((0, 39))
+    free = np.flatnonzero(system.state.reshape(-1) == model.EMPTY_CODE)
+    for index in rng.choice(free, 60, replace=False).tolist():
+        system.add_pedestrian_at(divmod(index, 40), float(rng.uniform(0.6, 1.4)))
+    system.sources = [Source(0, 0, 25, 2, rate=0.7, speed=1.2, total=80, seed=3)]
+    system.sinks = True
+    return system
+
+
+def assert_same_state(system, other):
+    for name in checkpoint.CELL_ARRAYS:
+        np.testing.assert_array_equal(getattr(system, name), getattr(other, name))
+    for first, second in zip(system.pedestrian_coordinates(), other.pedestrian_coordinates()):
+        np.testing.assert_array_equal(first, second)
+    slots, other_slots = system.agents.active(), other.agents.active()
+    np.testing.assert_array_equal(system.agents.speed[slots], other.agents.speed[other_slots])
+    np.testing.assert_array_equal(system.agents.ids[slots], other.agents.ids[other_slots])
+    assert (system.step_count, system.stalled_steps) == (other.step_count, other.stalled_steps)
+
+
+@pytest.mark.parametrize('mode', model.MODES)
+def test_restored_system_steps_identically(mode, tmp_path):
+    system = get_system()
+    for _ in range(15):
+        system.step(mode)
+    path = str(tmp_path / 'state.npz')
+    checkpoint.save_checkpoint(system, path)
+    restored = checkpoint.load_checkpoint(path)
+    assert_same_state(system, restored)
+    for _ in range(40):
+        system.step(mode)
+        restored.step(mode)
+        assert_same_state(system, restored)
+
+
+def test_in_memory_branches_are_independent():
+    system = get_system()
+    for _ in range(5):
+        system.step(model.FMM)
+    arrays = checkpoint.get_checkpoint(system)
+    first, second = checkpoint.restore_checkpoint(arrays), checkpoint.restore_checkpoint(arrays)
+    first.step(model.FMM)
+    assert second.step_count == system.step_count
+    second.step(model.FMM)
+    assert_same_state(first, second)
+
+
+def test_other_files_are_rejected(tmp_path):
+    path = str(tmp_path / 'other.npz')
+    np.savez(path, state=np.zeros(3))
+    with pytest.raises(checkpoint.CheckpointError):
+        checkpoint.load_checkpoint(path)
+
+
+def test_failed_save_leaves_no_temporary_file(tmp_path, monkeypatch):
+    path = str(tmp_path / 'run.npz')
+    checkpoint.save_checkpoint(get_system(), path)
+
+    def savez(file, **arrays):
+        file.write(b'partial')
+        raise OSError("No space left on device")
+    monkeypatch.setattr(checkpoint.np, 'savez', savez)
+    with pytest.raises(OSError):
+        checkpoint.save_checkpoint(get_system(), path)
+    assert sorted(item.name for item in tmp_path.iterdir()) == ['run.npz']
+    monkeypatch.undo()
+    assert_same_state(checkpoint.load_checkpoint(path), get_system())
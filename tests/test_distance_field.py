@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+import distance_field as distance_field
+
+
+def get_serpentine(size, gap):
+    walkable = np.ones((size, size), dtype=bool)
+    for number, row in enumerate(range(gap, size - 1, gap)):
+        walkable[row, :] = False
+        walkable[row, 0 if number % 2 else -1] = True
+    return walkable
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_methods_agree(seed):
+    rng = np.random.default_rng(seed)
+    walkable = rng.random((40, 60)) > 0.3
+    sources = [(0, 0), (39, 59), (20, 30)]
+    fields = [distance_field.distance_field(walkable, sources, method) for method in distance_field.METHODS]
+    for field in fields[1:]:
+        np.testing.assert_allclose(field, fields[0], rtol=0, atol=1e-9)
+    assert np.all(np.isinf(fields[0][~walkable]))
+
+
+@pytest.mark.parametrize('method', distance_field.METHODS)
+def test_distances_around_a_wall(method):
+    walkable = np.ones((3, 4), dtype=bool)
+    walkable[1, :3] = False
+    distance = distance_field.distance_field(walkable, [(0, 0)], method)
+    np.testing.assert_allclose(distance[0], [0, 1, 2, 3])
+    np.testing.assert_allclose(distance[1], [np.inf, np.inf, np.inf, 2 + np.sqrt(2)])
+    np.testing.assert_allclose(distance[2], [4 + 2 * np.sqrt(2), 3 + 2 * np.sqrt(2), 2 + 2 * np.sqrt(2), 3 + np.sqrt(2)])
+
+
+def test_auto_falls_back_to_heap_on_winding_plans():
+    walkable = get_serpentine(60, 4)
+    sources = np.zeros_like(walkable)
+    sources[-1, -1] = True
+    assert distance_field.sweep_distance(walkable, sources, distance_field.MAX_SWEEP_PASSES) is None
+    np.testing.assert_allclose(distance_field.distance_field(walkable, sources, distance_field.AUTO),
+                               distance_field.distance_field(walkable, sources, distance_field.HEAP), rtol=0, atol=1e-9)
+
+
+def test_unknown_method_raises():
+    with pytest.raises(ValueError):
+        distance_field.distance_field(np.ones((3, 3), dtype=bool), [(0, 0)], 'bfs')
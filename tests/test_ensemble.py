@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+
+import model as model
+from agents import Source
+from ensemble import Ensemble
+
+
+def get_system():
+    system = model.System(24, 16)
+    obstacles = np.zeros((16, 24), dtype=bool)
+    obstacles[3:13, 12] = True
+    system.add_obstacles(obstacles)
+    system.add_target_at((8, 23))
+    rng = np.random.default_rng(4)
+    for index in rng.choice(np.flatnonzero(~obstacles[:, :10].reshape(-1)), 30, replace=False).tolist():
+        row, col = divmod(index, 10)
+        system.add_pedestrian_at((row, col), float(rng.uniform(0.7, 1.3)))
+    return system
+
+
+def get_replica(ensemble, replica):
+    """
+    Builds the system replica would be on its own: the scenario with the replica's pedestrians and sources.
+    """
+    base = ensemble.base
+    system = model.System(base.cols, base.rows)
+    system.add_obstacles(base.state == model.OBSTACLE_CODE)
+    for target in base.target_coordinates():
+        system.add_target_at(target)
+    rows, cols = ensemble.system.pedestrian_coordinates()
+    speeds = ensemble.system.agents.speed[ensemble.system.agents.active()]
+    replicas, rows = ensemble.replica_of(rows)
+    for row, col, speed in zip(rows[replicas == replica].tolist(), cols[replicas == replica].tolist(),
+                               speeds[replicas == replica].tolist()):
+        system.add_pedestrian_at((row, col), speed)
+    offset = replica * ensemble.height
+    system.sources = [Source(source.rectangle[0] - offset, *source.rectangle[1:], rate=source.rate,
+                             speed=source.speed, total=source.total) for source in ensemble.sources[replica]]
+    for source, original in zip(system.sources, ensemble.sources[replica]):
+        source.rng.bit_generator.state = original.rng.bit_generator.state
+    system.sinks = base.sinks
+    return system
+
+
+@pytest.mark.parametrize('mode', model.MODES)
+def test_replicas_move_as_single_runs(mode):
+    system = get_system()
+    system.sources = [Source(0, 0, 16, 1, rate=0.5, total=10)]
+    ensemble = Ensemble(system, 4, seed=2, speed_std=0.2, random_start=True)
+    singles = [get_replica(ensemble, replica) for replica in range(ensemble.replicas)]
+    for _ in range(60):
+        ensemble.step(mode)
+        rows, cols = ensemble.system.pedestrian_coordinates()
+        replicas, rows = ensemble.replica_of(rows)
+        times = ensemble.system.travel_time[ensemble.system.pedestrian_coordinates()]
+        for replica, single in enumerate(singles):
+            single.step(mode)
+            single_rows, single_cols = single.pedestrian_coordinates()
+            np.testing.assert_array_equal(rows[replicas == replica], single_rows)
+            np.testing.assert_array_equal(cols[replicas == replica], single_cols)
+            np.testing.assert_array_equal(times[replicas == replica], single.travel_time[single_rows, single_cols])
+
+
+@pytest.mark.parametrize('mode', model.MODES)
+def test_results_match_single_runs(mode):
+    ensemble = Ensemble(get_system(), 3, seed=1, speed_std=0.1)
+    singles = [get_replica(ensemble, replica) for replica in range(ensemble.replicas)]
+    ensemble.run(mode, max_steps=150)
+    for result, single in zip(ensemble.results(), singles):
+        evacuation_time = None
+        while single.step_count < ensemble.system.step_count:
+            single.step(mode)
+            if evacuation_time is None and single.is_evacuated():
+                evacuation_time = single.step_count
+        rows, cols = single.pedestrian_coordinates()
+        assert result['evacuated'] == (evacuation_time is not None)
+        assert result['evacuation_time'] == evacuation_time
+        assert result['remaining'] == len(rows)
+        assert result['max_travel_time'] == max(single.travel_time[rows, cols].max(initial=0), 0)
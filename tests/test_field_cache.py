@@ -0,0 +1,71 @@
+import os
+import time
+
+import numpy as np
+
+import field_cache as field_cache
+import model as model
+
+
+def test_key_changes_with_geometry():
+    obstacles = np.zeros((4, 5), dtype=bool)
+    key = field_cache.geometry_key('dijkstra', obstacles, [(0, 0)])
+    moved = obstacles.copy()
+    moved[1, 1] = True
+    assert field_cache.geometry_key('dijkstra', obstacles, [(0, 0)]) == key
+    assert field_cache.geometry_key('dijkstra', moved, [(0, 0)]) != key
+    assert field_cache.geometry_key('dijkstra', obstacles, [(0, 1)]) != key
+    assert field_cache.geometry_key('fmm_distance', obstacles, [(0, 0)]) != key
+    assert field_cache.geometry_key('dijkstra', obstacles.reshape(5, 4), [(0, 0)]) != key
+    assert field_cache.geometry_key('tt', obstacles, [(0, 0)], 0.4) != field_cache.geometry_key('tt', obstacles,
+                                                                                                 [(0, 0)], 0.2)
+
+
+def test_fields_are_computed_once(tmp_path):
+    cache = field_cache.FieldCache(str(tmp_path))
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return np.arange(12.0).reshape(3, 4)
+
+    first = cache.get_or_compute('key', compute)
+    second = cache.get_or_compute('key', compute)
+    assert len(calls) == 1
+    np.testing.assert_array_equal(second, first)
+    assert not second.flags.writeable
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    field = np.zeros(1000)
+    cache = field_cache.FieldCache(str(tmp_path), max_bytes=1 << 40)
+    cache.put('a', field)
+    entry_size = cache.size()
+    cache.max_bytes = 2 * entry_size
+    cache.put('b', field)
+    now = time.time()
+    os.utime(cache.path('a'), (now - 20, now - 20))
+    os.utime(cache.path('b'), (now - 10, now - 10))
+    cache.get('a')  # a is now the most recently used
+    cache.put('c', field)
+    assert cache.get('b') is None
+    assert cache.get('a') is not None and cache.get('c') is not None
+
+
+def test_cached_system_fields_equal_computed_ones(tmp_path):
+    def get_system(cache):
+        system = model.System(20, 15)
+        system.add_obstacles(np.random.default_rng(0).random((15, 20)) < 0.2)
+        system.add_target_at((7, 19))
+        system.field_cache = cache
+        system.evaluate_dijkstra_cell_utilities()
+        system.evaluate_fmm_fields()
+        return system
+
+    plain = get_system(None)
+    cache = field_cache.FieldCache(str(tmp_path))
+    for _ in range(2):  # Computed and stored, then loaded
+        cached = get_system(cache)
+        np.testing.assert_array_equal(cached.distance_utility, plain.distance_utility)
+        np.testing.assert_array_equal(cached.fmm_distance, plain.fmm_distance)
+        np.testing.assert_array_equal(cached.tt, plain.tt)
@@ -0,0 +1,173 @@
+import numpy as np
+import pytest
+import skfmm
+
+import distance_field as distance_field
+import field_repair as field_repair
+import model as model
+
+ROWS, COLS = 30, 40
+TARGETS = [(15, 38), (2, 3)]
+
+
+def get_system(obstacles):
+    system = model.System(COLS, ROWS)
+    system.add_obstacles(obstacles)
+    for target in TARGETS:
+        system.add_target_at(target)
+    system.evaluate_dijkstra_cell_utilities()
+    system.evaluate_fmm_fields()
+    return system
+
+
+def get_obstacles(rng):
+    obstacles = rng.random((ROWS, COLS)) < 0.2
+    obstacles[10:20, 20] = True  # A wall that changes which cells are behind it
+    for row, col in TARGETS:
+        obstacles[max(row - 1, 0):row + 2, max(col - 1, 0):col + 2] = False
+    return obstacles
+
+
+def get_changes(rng, count):
+    free = np.ones((ROWS, COLS), dtype=bool)
+    for row, col in TARGETS:
+        free[max(row - 1, 0):row + 2, max(col - 1, 0):col + 2] = False
+    cells = np.flatnonzero(free)
+    return [divmod(int(index), COLS) for index in rng.choice(cells, count, replace=False)]
+
+
+def assert_same_fields(system, fresh):
+    np.testing.assert_allclose(system.dijkstra_distance, fresh.dijkstra_distance, rtol=0, atol=1e-9)
+    np.testing.assert_array_equal(system.visited, fresh.visited)
+    np.testing.assert_allclose(system.distance_utility, fresh.distance_utility, rtol=0, atol=1e-9)
+    np.testing.assert_array_equal(system.fmm_distance, fresh.fmm_distance)
+    np.testing.assert_array_equal(system.tt, fresh.tt)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_repaired_fields_equal_full_recompute(seed):
+    rng = np.random.default_rng(seed)
+    obstacles = get_obstacles(rng)
+    system = get_system(obstacles)
+    for row, col in get_changes(rng, 8):
+        if obstacles[row, col]:
+            system.remove_obstacle_at((row, col))
+        else:
+            system.add_obstacle_at((row, col))
+        obstacles[row, col] = not obstacles[row, col]
+        assert_same_fields(system, get_system(obstacles))
+
+
+def test_bulk_obstacles_equal_full_recompute():
+    rng = np.random.default_rng(7)
+    obstacles = get_obstacles(rng)
+    system = get_system(obstacles)
+    added = np.zeros_like(obstacles)
+    added[5:8, 10:14] = True
+    system.add_obstacles(added)
+    assert_same_fields(system, get_system(obstacles | added))
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_distance_repair_is_exact(seed):
+    rng = np.random.default_rng(seed)
+    walkable = ~get_obstacles(rng)
+    distance = distance_field.distance_field(walkable, TARGETS)
+    for row, col in get_changes(rng, 10):
+        index = row * COLS + col
+        walkable[row, col] = not walkable[row, col]
+        if walkable[row, col]:
+            field_repair.open_distance(distance, walkable, [index])
+        else:
+            field_repair.block_distance(distance, walkable, [index])
+        np.testing.assert_allclose(distance, distance_field.distance_field(walkable, TARGETS), rtol=0, atol=1e-9)
+
+
+def test_repair_limit_raises():
+    walkable = np.ones((ROWS, COLS), dtype=bool)
+    distance = distance_field.distance_field(walkable, [(0, 0)])
+    walkable[:, 1] = False
+    with pytest.raises(field_repair.RegionTooLarge):
+        field_repair.block_distance(distance, walkable, [row * COLS + 1 for row in range(ROWS)], limit=10)
+
+
+def get_skfmm_fields(obstacles, speed):
+    targets = np.ones((ROWS, COLS))
+    for row, col in TARGETS:
+        targets[row, col] = -1
+    phi = np.ma.MaskedArray(targets, obstacles)
+    return (np.ma.getdata(skfmm.distance(phi)).copy(),
+            np.ma.getdata(skfmm.travel_time(phi, speed, 0.4)).copy())
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_fmm_window_repair_matches_skfmm(seed):
+    rng = np.random.default_rng(seed)
+    obstacles = get_obstacles(rng)
+    speed = rng.uniform(0.5, 1.5, (ROWS, COLS))
+    distance, time = get_skfmm_fields(obstacles, speed)
+    frozen = {(row + d_row) * COLS + col + d_col for row, col in TARGETS
+              for d_row, d_col in ((0, 0), (0, -1), (0, 1), (-1, 0), (1, 0))
+              if 0 <= row + d_row < ROWS and 0 <= col + d_col < COLS}
+    targets = {row * COLS + col for row, col in TARGETS}
+    for row, col in get_changes(rng, 10):
+        obstacles[row, col] = not obstacles[row, col]
+        index = row * COLS + col
+        field_repair.repair_travel_time(distance, ~obstacles, frozen, [index])
+        field_repair.repair_travel_time(time, ~obstacles, frozen, [index], speed, 0.4, targets=targets)
+        fresh_distance, fresh_time = get_skfmm_fields(obstacles, speed)
+        walkable = ~obstacles
+        np.testing.assert_allclose(distance[walkable], fresh_distance[walkable], rtol=0, atol=1e-9)
+        np.testing.assert_allclose(time[walkable], fresh_time[walkable], rtol=0, atol=1e-9)
+
+
+def test_fmm_repair_stays_in_window(monkeypatch):
+    # A room off a long corridor, nothing outside the room depends on its cells
+    obstacles = np.ones((300, 300), dtype=bool)
+    obstacles[150, :] = False
+    obstacles[140:150, 100:110] = False
+    system = model.System(300, 300)
+    system.add_obstacles(obstacles)
+    system.add_target_at((150, 299))
+    system.evaluate_fmm_fields()
+
+    def recompute():
+        raise AssertionError("The FMM fields were computed again instead of repaired")
+    monkeypatch.setattr(system, 'evaluate_fmm_fields', recompute)
+    system.add_obstacle_at((142, 103))
+    system.remove_obstacle_at((142, 103))
+    system.add_obstacle_at((145, 107))
+    monkeypatch.undo()
+
+    obstacles[145, 107] = True
+    fresh = model.System(300, 300)
+    fresh.add_obstacles(obstacles)
+    fresh.add_target_at((150, 299))
+    fresh.evaluate_fmm_fields()
+    np.testing.assert_allclose(system.fmm_distance, fresh.fmm_distance, rtol=0, atol=1e-9)
+    np.testing.assert_allclose(system.tt, fresh.tt, rtol=0, atol=1e-9)
+
+
+def test_obstacle_on_pedestrian_raises():
+    system = get_system(get_obstacles(np.random.default_rng(0)))
+    system.add_pedestrian_at((15, 30))
+    with pytest.raises(ValueError):
+        system.add_obstacle_at((15, 30))
+    added = np.zeros((ROWS, COLS), dtype=bool)
+    added[14:17, 29:32] = True
+    with pytest.raises(ValueError):
+        system.add_obstacles(added)
+    assert system.state[15, 30] == model.PEDESTRIAN_CODE
+    assert len(system.agents.active()) == 1
+
+
+def test_obstacle_on_target_raises():
+    system = get_system(get_obstacles(np.random.default_rng(0)))
+    with pytest.raises(ValueError):
+        system.add_obstacle_at(TARGETS[0])
+    added = np.zeros((ROWS, COLS), dtype=bool)
+    added[TARGETS[1]] = True
+    with pytest.raises(ValueError):
+        system.add_obstacles(added)
+    assert system.state[TARGETS[0]] == model.TARGET_CODE
+    assert system.state[TARGETS[1]] == model.TARGET_CODE
@@ -0,0 +1,107 @@
+import numpy as np
+import pytest
+
+import model as model
+
+
+def get_room(seed, rows=25, cols=30, pedestrians=120):
+    rng = np.random.default_rng(seed)
+    system = model.System(cols, rows)
+    obstacles = rng.random((rows, cols)) < 0.1
+    obstacles[rows // 2, :] = False
+    obstacles[:, -1] = False
+    system.add_obstacles(obstacles)
+    system.add_target_at((rows // 2, cols - 1))
+    free = np.flatnonzero(system.state.reshape(-1) == model.EMPTY_CODE)
+    for index in rng.choice(free, pedestrians, replace=False).tolist():
+        system.add_pedestrian_at(divmod(index, cols), float(rng.uniform(0.5, 1.5)))
+    return system
+
+
+def select_sequentially(system, rows, cols, cost, blocked, stay_on=None, ties_to_last=False):
+    """
+    Moves the pedestrians one after another, as the batched selection claims to.
+    """
+    reserved = blocked.copy()
+    next_index = []
+    for row, col in zip(rows.tolist(), cols.tolist()):
+        best, best_cost = None, np.inf
+        for d_row, d_col in model.NEIGHBOUR_OFFSETS:
+            n_row, n_col = row + d_row, col + d_col
+            if not (0 <= n_row < system.rows and 0 <= n_col < system.cols) or reserved[n_row, n_col]:
+                continue
+            if cost[n_row, n_col] < best_cost or (ties_to_last and cost[n_row, n_col] == best_cost):
+                best, best_cost = (n_row, n_col), cost[n_row, n_col]
+        moving = best is not None and (best_cost <= cost[row, col] if ties_to_last else best_cost < cost[row, col])
+        if moving and stay_on is not None and system.state[best] == stay_on:
+            moving = False
+        if moving:
+            reserved[best] = True
+            next_index.append(best[0] * system.cols + best[1])
+        else:
+            next_index.append(row * system.cols + col)
+    return np.array(next_index)
+
+
+@pytest.mark.parametrize('seed', range(4))
+@pytest.mark.parametrize('ties_to_last', [False, True])
+def test_batched_selection_matches_sequential(seed, ties_to_last):
+    system = get_room(seed, pedestrians=250)
+    rows, cols = system.pedestrian_coordinates()
+    # Few distinct costs, so there are many ties and conflicts
+    cost = np.random.default_rng(seed).integers(0, 4, system.state.shape).astype(float)
+    blocked = (system.state == model.PEDESTRIAN_CODE) | (system.state == model.OBSTACLE_CODE)
+    for stay_on in (None, model.TARGET_CODE):
+        expected = select_sequentially(system, rows, cols, cost, blocked, stay_on, ties_to_last)
+        np.testing.assert_array_equal(system.select_next_cells(rows, cols, cost, blocked, stay_on, ties_to_last),
+                                      expected)
+
+
+def step_fmm_sequentially(system):
+    """
+    The FMM step as it processed one pedestrian after another before it was batched.
+    """
+    if system.fmm_distance.size == 0:
+        system.evaluate_fmm_fields()
+        system.initialize_predicted_times()
+    for (row, col), speed in system.pedestrian_fmm:
+        cell = system.grid[row][col]
+        choice, step_length = system.select_fmm_cells(system.fmm_distance, np.array([row]), np.array([col]),
+                                                      np.array([cell.wait_fmm_penalty]))
+        path = [divmod(int(choice[0]), system.cols)]
+        time = float(step_length[0]) / speed
+        state = system.state[path[0]]
+        if state == model.PEDESTRIAN_CODE:
+            cell.wait_fmm_penalty += 0.001
+            continue
+        if state == model.TARGET_CODE:
+            continue
+        init_time = cell.initial_predicted_time
+        time += cell.travel_time
+        system.remove_pedestrian_fmm_at((row, col), speed)
+        system.add_pedestrian_fmm(path[0], speed, time, init_time)
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_batched_fmm_step_matches_sequential(seed):
+    batched, sequential = get_room(seed), get_room(seed)
+    for _ in range(40):
+        batched.update_system_fmm()
+        step_fmm_sequentially(sequential)
+        assert batched.pedestrian_fmm == sequential.pedestrian_fmm
+        np.testing.assert_array_equal(batched.state, sequential.state)
+        np.testing.assert_allclose(batched.travel_time, sequential.travel_time, rtol=1e-12)
+        np.testing.assert_allclose(batched.initial_predicted_time, sequential.initial_predicted_time, rtol=1e-12)
+        np.testing.assert_allclose(batched.wait_fmm_penalty, sequential.wait_fmm_penalty, rtol=1e-12)
+
+
+@pytest.mark.parametrize('mode', model.MODES)
+def test_pedestrians_never_share_a_cell(mode):
+    system = get_room(5, pedestrians=200)
+    count = len(system.agents)
+    for _ in range(30):
+        system.step(mode)
+        rows, cols = system.pedestrian_coordinates()
+        assert len(set(zip(rows.tolist(), cols.tolist()))) == len(rows)
+        assert np.count_nonzero(system.state == model.PEDESTRIAN_CODE) == len(rows)
+        assert len(rows) <= count
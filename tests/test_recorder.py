@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+import model as model
+import recorder as recorder
+from agents import Source
+
+
+def get_system():
+    system = model.System(30, 20)
+    system.add_obstacles(np.pad(np.ones((10, 1), dtype=bool), ((5, 5), (15, 14))))
+    system.add_target_at((10, 29))
+    system.sources = [Source(0, 0, 20, 2, rate=1.5, total=60)]
+    system.sinks = True
+    return system
+
+
+@pytest.mark.parametrize('mode', model.MODES)
+def test_pedestrian_ids_follow_one_pedestrian(mode, tmp_path):
+    system = get_system()
+    path = str(tmp_path / 'run.trj')
+    positions = []
+    with recorder.TrajectoryRecorder(path, chunk_rows=100) as trajectories:
+        system.step_hooks.append(trajectories)
+        for _ in range(80):
+            system.step(mode)
+            slots = system.agents.active()
+            positions.append(dict(zip(system.agents.ids[slots].tolist(), system.agents.index[slots].tolist())))
+    data = recorder.read_trajectories(path)
+
+    assert len(np.unique(data['pedestrian'])) == 60
+    for step, expected in enumerate(positions, start=1):
+        rows = data['step'] == step
+        recorded = dict(zip(data['pedestrian'][rows].tolist(),
+                            (data['row'][rows] * system.cols + data['col'][rows]).tolist()))
+        assert recorded == expected
+    for pedestrian in np.unique(data['pedestrian']):
+        rows = data['pedestrian'] == pedestrian
+        steps = data['step'][rows]
+        assert np.all(np.diff(steps) == 1)
+        # Every step moves a pedestrian to a neighbouring cell at most
+        assert np.all(np.abs(np.diff(data['row'][rows])) <= 1)
+        assert np.all(np.abs(np.diff(data['col'][rows])) <= 1)
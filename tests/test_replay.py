@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+import model as model
+import replay as replay
+
+
+def test_frames_are_read_back(tmp_path):
+    system = model.System(12, 8)
+    system.add_target_at((4, 11))
+    system.add_pedestrian_at((4, 0))
+    path = str(tmp_path / 'run.frames')
+    states = [system.state.copy()]
+    with replay.FrameWriter(path, system, 10) as writer:
+        for _ in range(5):
+            system.step(model.DIJKSTRA)
+            writer(system)
+            states.append(system.state.copy())
+    reader = replay.FrameReader(path)
+    assert len(reader) == len(states)
+    for step, state in enumerate(states):
+        np.testing.assert_array_equal(reader[step], state)
+
+
+def test_empty_recording_has_no_frames(tmp_path):
+    system = model.System(12, 8)
+    path = str(tmp_path / 'run.frames')
+    writer = replay.FrameWriter(path, system, 10)
+    writer.close()
+    with open(path, 'r+b') as file:
+        file.truncate(replay.HEADER_SIZE)
+    reader = replay.FrameReader(path)
+    assert len(reader) == 0
+    with pytest.raises(IndexError):
+        reader[0]
+
+    with open(path, 'ab') as file:
+        file.write(np.ascontiguousarray(system.state, dtype=np.int8).tobytes())
+    reader.refresh()
+    assert len(reader) == 1
+    np.testing.assert_array_equal(reader[0], system.state)
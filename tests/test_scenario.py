@@ -0,0 +1,59 @@
+import json
+
+import numpy as np
+import pytest
+
+import scenario as scenario
+
+
+def test_obstacle_encodings_combine():
+    data = {'obstacles': [[0, 0]], 'obstacle_rectangles': [[1, 1, 2, 3]], 'obstacle_runs': [[4, 2, 3], [0, 4, 1]]}
+    obstacles = scenario.get_obstacle_mask(data, 5, 6)
+    expected = np.zeros((5, 6), dtype=bool)
+    expected[0, 0] = expected[0, 4] = True
+    expected[1:3, 1:4] = True
+    expected[4, 2:5] = True
+    np.testing.assert_array_equal(obstacles, expected)
+
+
+def test_runs_match_their_mask():
+    obstacles = np.random.default_rng(0).random((20, 30)) < 0.4
+    runs = scenario.get_obstacle_runs(obstacles)
+    np.testing.assert_array_equal(scenario.get_obstacle_mask({'obstacle_runs': runs}, 20, 30), obstacles)
+
+
+@pytest.mark.parametrize('key, entry', [
+    ('obstacles', [-1, 2]),
+    ('obstacles', [5, 0]),
+    ('obstacle_rectangles', [-1, 0, 2, 2]),
+    ('obstacle_rectangles', [0, -2, 2, 2]),
+    ('obstacle_rectangles', [4, 0, 2, 1]),
+    ('obstacle_rectangles', [0, 0, 1, -1]),
+    ('obstacle_runs', [-1, 0, 2]),
+    ('obstacle_runs', [5, 0, 2]),
+    ('obstacle_runs', [0, 5, 2]),
+])
+def test_entries_outside_the_grid_are_rejected(key, entry):
+    with pytest.raises(ValueError, match=r'\[' + ', '.join(str(value) for value in entry) + r'\]'):
+        scenario.get_obstacle_mask({key: [[0, 0, 1, 1][:len(entry)], entry]}, 5, 6)
+
+
+def test_missing_grid_size_is_named(tmp_path):
+    path = tmp_path / 'scenario.json'
+    path.write_text(json.dumps({'cols': 6, 'pedestrians': [[1, 1]], 'target': [4, 5]}))
+    with pytest.raises(ValueError, match="'rows'"):
+        scenario.initialize_system(str(path))
+    path.write_text(json.dumps({'pedestrians': [[1, 1]], 'target': [4, 5]}))
+    with pytest.raises(ValueError, match="'rows' or 'cols'"):
+        scenario.initialize_system(str(path))
+
+
+def test_compact_scenario_takes_the_grid_size_from_the_mask(tmp_path):
+    obstacles = np.random.default_rng(1).random((5, 6)) < 0.4
+    obstacles[4, 5] = False
+    np.save(str(tmp_path / 'mask.npy'), obstacles)
+    (tmp_path / 'scenario.json').write_text(json.dumps({'obstacle_mask': 'mask.npy', 'target': [4, 5]}))
+    scenario.compact_scenario(str(tmp_path / 'scenario.json'), str(tmp_path / 'runs.json'))
+    data = json.loads((tmp_path / 'runs.json').read_text())
+    assert (data['rows'], data['cols']) == (5, 6)
+    np.testing.assert_array_equal(scenario.get_obstacle_mask(data, 5, 6), obstacles)
@@ -0,0 +1,32 @@
+import os
+
+import sweep as sweep
+from conftest import ROOT
+
+SCENARIO = os.path.join(ROOT, 'Test_Scenarios', 'scenario_final_task1.json')
+
+
+def crash_on_fmm(job, max_steps, cache_directory):
+    if job['mode'] == 'fmm':
+        os._exit(1)
+    return sweep.run_job(job, max_steps, cache_directory)
+
+
+def test_dying_worker_only_fails_its_own_row():
+    jobs = sweep.get_jobs([SCENARIO], ['dijkstra', 'fmm', 'euclidean'], r_max=(1, 2, 3))
+    rows = sweep.run_sweep(jobs, max_steps=50, workers=3, run=crash_on_fmm)
+
+    assert [row['mode'] for row in rows] == [job['mode'] for job in jobs]
+    for row in rows:
+        if row['mode'] == 'fmm':
+            assert row['error'].startswith('BrokenProcessPool')
+        else:
+            assert not row.get('error')
+            assert row['steps'] > 0
+
+
+def test_raising_job_gives_error_row():
+    jobs = sweep.get_jobs([os.path.join(ROOT, 'missing.json'), SCENARIO], ['dijkstra'])
+    rows = sweep.run_sweep(jobs, max_steps=50, workers=2)
+    assert rows[0]['error']
+    assert not rows[1].get('error')
@@ -0,0 +1,106 @@
+import numpy as np
+import pytest
+
+import model as model
+import tiles as tiles
+
+
+def get_venue():
+    """
+    A 96x96 venue of three buildings far apart, one with an exit of its own and two sharing one through a corridor.
+    """
+    walkable = [[0, 0, 20, 24], [8, 24, 3, 30], [4, 54, 16, 14], [70, 60, 20, 20]]
+    obstacles = [[6, 6, 8, 4], [75, 65, 2, 10]]
+    rng = np.random.default_rng(5)
+    walkable_mask = np.zeros((96, 96), dtype=bool)
+    for row, col, height, width in walkable:
+        walkable_mask[row:row + height, col:col + width] = True
+    for row, col, height, width in obstacles:
+        walkable_mask[row:row + height, col:col + width] = False
+    cells = rng.choice(np.flatnonzero(walkable_mask), 60, replace=False)
+    pedestrians = np.column_stack(np.unravel_index(cells, walkable_mask.shape)).tolist()
+    return {'rows': 96, 'cols': 96, 'tile_size': 8, 'walkable_rectangles': walkable, 'obstacle_rectangles': obstacles,
+            'targets': [[19, 67], [89, 79]], 'pedestrians': pedestrians,
+            'speeds': rng.uniform(0.7, 1.3, len(pedestrians)).tolist()}
+
+
+def get_connected_venue():
+    """
+    A 256x256 venue of two buildings in opposite corners, joined by an L-shaped corridor two cells wide.
+    """
+    walkable = [[0, 0, 24, 24], [10, 24, 2, 216], [12, 238, 220, 2], [232, 216, 24, 40]]
+    obstacles = [[8, 8, 6, 2], [240, 224, 2, 12]]
+    rng = np.random.default_rng(7)
+    walkable_mask = np.zeros((256, 256), dtype=bool)
+    for row, col, height, width in walkable:
+        walkable_mask[row:row + height, col:col + width] = True
+    for row, col, height, width in obstacles:
+        walkable_mask[row:row + height, col:col + width] = False
+    cells = rng.choice(np.flatnonzero(walkable_mask), 80, replace=False)
+    pedestrians = np.column_stack(np.unravel_index(cells, walkable_mask.shape)).tolist()
+    return {'rows': 256, 'cols': 256, 'tile_size': 8, 'walkable_rectangles': walkable, 'obstacle_rectangles': obstacles,
+            'targets': [[254, 254], [3, 3]], 'pedestrians': pedestrians,
+            'speeds': rng.uniform(0.7, 1.3, len(pedestrians)).tolist()}
+
+
+def get_dense_system(data):
+    """
+    Builds the same venue as one full grid, with every void cell an obstacle.
+    """
+    obstacles = np.ones((data['rows'], data['cols']), dtype=bool)
+    for row, col, height, width in data['walkable_rectangles']:
+        obstacles[row:row + height, col:col + width] = False
+    for row, col, height, width in data['obstacle_rectangles']:
+        obstacles[row:row + height, col:col + width] = True
+    system = model.System(data['cols'], data['rows'])
+    system.add_obstacles(obstacles)
+    for row, col in data['targets']:
+        system.add_target_at((row, col))
+    for (row, col), speed in zip(data['pedestrians'], data['speeds']):
+        system.add_pedestrian_at((row, col), speed)
+    return system
+
+
+def test_pack_allocates_only_the_parts():
+    tile_map = tiles.get_tile_map(get_venue())
+    system, layout = tile_map.pack()
+    assert len(layout.parts) == 2
+    assert system.state.size < 96 * 96 / 2
+    assert tile_map.allocated_cells() < 96 * 96 / 2
+
+
+def test_pack_cuts_a_connected_venue_along_its_corridor():
+    tile_map = tiles.get_tile_map(get_connected_venue())
+    system, layout = tile_map.pack()
+    assert len(layout.parts) > 2
+    assert system.links is not None
+    assert system.state.size < 256 * 256 / 4
+
+
+def test_layout_translates_back_and_forth():
+    data = get_venue()
+    system, layout = tiles.get_tile_map(data).pack()
+    rows, cols = np.array(data['pedestrians']).T
+    packed_rows, packed_cols = layout.to_packed(rows, cols)
+    assert np.all(system.state[packed_rows, packed_cols] == model.PEDESTRIAN_CODE)
+    original_rows, original_cols = layout.to_original(packed_rows, packed_cols)
+    np.testing.assert_array_equal(original_rows, rows)
+    np.testing.assert_array_equal(original_cols, cols)
+
+
+@pytest.mark.parametrize('venue', [get_venue, get_connected_venue])
+@pytest.mark.parametrize('mode', model.MODES)
+def test_packed_venue_steps_as_dense_one(mode, venue):
+    data = venue()
+    dense = get_dense_system(data)
+    packed, layout = tiles.get_tile_map(data).pack()
+    for _ in range(60):
+        dense.step(mode)
+        packed.step(mode)
+        dense_rows, dense_cols = dense.pedestrian_coordinates()
+        packed_rows, packed_cols = packed.pedestrian_coordinates()
+        rows, cols = layout.to_original(packed_rows, packed_cols)
+        np.testing.assert_array_equal(rows, dense_rows)
+        np.testing.assert_array_equal(cols, dense_cols)
+        np.testing.assert_array_equal(packed.travel_time[packed_rows, packed_cols],
+                                      dense.travel_time[dense_rows, dense_cols])
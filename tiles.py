@@ -0,0 +1,446 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Sparse tiled venues for very large, mostly empty maps.
+
+A TileMap divides a venue into square tiles and only allocates the tiles that hold walkable cells, targets or
+pedestrians. Everything else is void, which no pedestrian can enter, just like an obstacle, so building a venue
+never allocates its bounding box.
+
+TileMap.pack turns it into a System. The venue is cut along bands of void tiles into parts, and a part whose tiles
+fill little of its bounding box is cut in two along the tile row or col that leaves the smallest bounding boxes,
+which is usually across a narrow corridor, so a long thin path does not pull in the whole box around it.
+Every part is cropped to its own tiles and the parts are placed side by side on shelves in the System, separated
+by obstacles as the replicas of ensemble.Ensemble are. No path, FMM stencil or pedestrian repulsion reaches across
+a band of void tiles. Where two parts meet along a cut, each keeps a halo of cells beyond the cut that stand for
+the other part's cells (TileLayout.get_links, model.System.links), so pedestrians, paths, stencils and the repulsion
+cross the cut as on the full venue. Every mode steps exactly as on the full venue, while the System's arrays only
+cover the parts' bounding boxes; only skfmm cannot follow the links, so the FMM fields of a venue with cuts are
+marched in Python and agree with skfmm's up to rounding. TileLayout translates between the venue's coordinates
+and the System's.
+"""
+import numpy as np
+
+import model as model
+
+TILE_SIZE = 32
+SPLIT_FRACTION = 0.5  # A part is cut in two if their bounding boxes cover less than this fraction of its own
+MAX_ASPECT = 4  # Parts longer than this many times their width are cut into pieces, see TileMap.get_parts
+
+
+class TileLayout:
+    """
+    Where the parts of a packed venue lie in the venue and in the System.
+    :param parts: list of (row, col, height, width) rectangles of the venue, one per part
+    :param positions: (row, col) of the System every part starts at
+    :param shape: (rows, cols) of the venue
+    :param halo: cells around a part that stand for the cells of the parts it meets, see get_links
+    """
+
+    def __init__(self, parts, positions, shape, halo=0):
+        self.parts = np.array(parts, dtype=np.intp).reshape(-1, 4)
+        self.positions = np.array(positions, dtype=np.intp).reshape(-1, 2)
+        self.shape = tuple(shape)
+        self.halo = halo
+
+    def find_parts(self, rows, cols, packed=False, margin=0):
+        """
+        Returns the part every given cell lies in, -1 for cells outside all parts.
+        :param rows:
+        :param cols:
+        :param packed: the coordinates are System coordinates, not venue coordinates
+        :param margin: cells around a part that count to it, less than half the gap between two parts
+        :return: integer array
+        """
+        rows, cols = np.asarray(rows), np.asarray(cols)
+        found = np.full(rows.shape, -1, dtype=np.intp)
+        for number, (row, col, height, width) in enumerate(self.parts.tolist()):
+            if packed:
+                row, col = self.positions[number].tolist()
+            found[(rows >= row - margin) & (rows < row + height + margin) & (cols >= col - margin)
+                  & (cols < col + width + margin)] = number
+        return found
+
+    def to_packed(self, rows, cols):
+        """
+        Translates venue coordinates to System coordinates.
+        :param rows: venue rows
+        :param cols: venue cols
+        :return: rows, cols
+        """
+        rows, cols = np.asarray(rows), np.asarray(cols)
+        parts = self.find_parts(rows, cols)
+        if np.any(parts < 0):
+            raise ValueError("Cells outside the walkable tiles of the venue: "
+                             + str(np.column_stack([rows[parts < 0], cols[parts < 0]]).tolist()[:10]))
+        shift = self.positions[parts] - self.parts[parts, :2]
+        return rows + shift[..., 0], cols + shift[..., 1]
+
+    def to_original(self, rows, cols, margin=0):
+        """
+        Translates System coordinates to venue coordinates.
+        :param rows: System rows
+        :param cols: System cols
+        :param margin: also translate the cells this close around a part, see find_parts
+        :return: rows, cols, both -1 for cells of no part
+        """
+        rows, cols = np.asarray(rows), np.asarray(cols)
+        parts = self.find_parts(rows, cols, packed=True, margin=margin)
+        shift = self.parts[parts, :2] - self.positions[parts]
+        found = parts >= 0
+        return np.where(found, rows + shift[..., 0], -1), np.where(found, cols + shift[..., 1], -1)
+
+    def to_packed_rectangle(self, row, col, height, width):
+        """
+        Translates a rectangle of the venue, which must lie within one part, to the System.
+        :param row:
+        :param col:
+        :param height:
+        :param width:
+        :return: row, col, height, width
+        """
+        parts = self.find_parts([row, row + height - 1], [col, col + width - 1])
+        if parts[0] < 0 or parts[0] != parts[1]:
+            raise ValueError("Rectangle " + str([row, col, height, width])
+                             + " does not lie within one connected part of the venue")
+        rows, cols = self.to_packed([row], [col])
+        return int(rows[0]), int(cols[0]), height, width
+
+    def get_links(self, rows, cols):
+        """
+        Returns the cell of the System every cell stands for, see model.System.links.
+        A cell within halo cells of a part stands for the cell of the venue at the same place, and where that lies
+        in another part, which meets this one along a cut, it is linked to that part's cell in the System.
+        All other cells stand for themselves.
+        :param rows: rows of the System
+        :param cols: cols of the System
+        :return: flat integer array of rows * cols cells, None if no two parts meet
+        """
+        links = np.arange(rows * cols)
+        linked = False
+        for number, (row, col, height, width) in enumerate(self.parts.tolist()):
+            top, left = self.positions[number].tolist()
+            halo_rows, halo_cols = np.mgrid[max(top - self.halo, 0):min(top + height + self.halo, rows),
+                                            max(left - self.halo, 0):min(left + width + self.halo, cols)]
+            outside = ((halo_rows < top) | (halo_rows >= top + height) | (halo_cols < left)
+                       | (halo_cols >= left + width))
+            halo_rows, halo_cols = halo_rows[outside], halo_cols[outside]
+            venue_rows, venue_cols = halo_rows + row - top, halo_cols + col - left
+            meets = self.find_parts(venue_rows, venue_cols) >= 0
+            if not meets.any():
+                continue
+            linked = True
+            packed_rows, packed_cols = self.to_packed(venue_rows[meets], venue_cols[meets])
+            links[halo_rows[meets] * cols + halo_cols[meets]] = packed_rows * cols + packed_cols
+        return links if linked else None
+
+    def to_dict(self):
+        return {'parts': self.parts.tolist(), 'positions': self.positions.tolist(), 'shape': list(self.shape),
+                'halo': self.halo}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['parts'], data['positions'], data['shape'], data['halo'])
+
+
+class TileMap:
+    """
+    Venue of rows x cols cells stored as lazily allocated square tiles of state codes.
+    Cells of an allocated tile start as void (OBSTACLE_CODE) until they are made walkable.
+    :param rows:
+    :param cols:
+    :param tile_size: cells along each side of a tile
+    """
+
+    def __init__(self, rows, cols, tile_size=TILE_SIZE):
+        self.rows = rows
+        self.cols = cols
+        self.tile_size = tile_size
+        self.tiles = {}  # (tile row, tile col) -> (tile_size, tile_size) int8 array of state codes
+        self.pedestrians = []  # (row, col, speed) in the order they were added, which is their processing order
+        self.targets = []  # (row, col)
+
+    def get_tile(self, tile_row, tile_col, create=False):
+        """
+        Returns the tile, allocating it if create is set, else None if it is not allocated.
+        :param tile_row:
+        :param tile_col:
+        :param create:
+        :return:
+        """
+        tile = self.tiles.get((tile_row, tile_col))
+        if tile is None and create:
+            tile = np.full((self.tile_size, self.tile_size), model.OBSTACLE_CODE, dtype=np.int8)
+            self.tiles[(tile_row, tile_col)] = tile
+        return tile
+
+    def fill_rectangle(self, row, col, height, width, code, create):
+        """
+        Sets the cells of a rectangle to a state code, tile by tile.
+        :param row:
+        :param col:
+        :param height:
+        :param width:
+        :param code: state code
+        :param create: allocate the tiles the rectangle touches, else only change allocated tiles
+        :return:
+        """
+        size = self.tile_size
+        top, left = max(row, 0), max(col, 0)
+        bottom, right = min(row + height, self.rows), min(col + width, self.cols)
+        for tile_row in range(top // size, (bottom - 1) // size + 1 if bottom > top else 0):
+            for tile_col in range(left // size, (right - 1) // size + 1 if right > left else 0):
+                tile = self.get_tile(tile_row, tile_col, create)
+                if tile is None:
+                    continue
+                row0, col0 = tile_row * size, tile_col * size
+                tile[max(top - row0, 0):min(bottom - row0, size), max(left - col0, 0):min(right - col0, size)] = code
+
+    def add_walkable(self, row, col, height, width):
+        self.fill_rectangle(row, col, height, width, model.EMPTY_CODE, create=True)
+
+    def add_obstacles(self, row, col, height, width):
+        self.fill_rectangle(row, col, height, width, model.OBSTACLE_CODE, create=False)
+
+    def add_target_at(self, row, col):
+        self.fill_rectangle(row, col, 1, 1, model.TARGET_CODE, create=True)
+        self.targets.append((row, col))
+
+    def add_pedestrian_at(self, row, col, speed=1.0):
+        tile = self.get_tile(row // self.tile_size, col // self.tile_size)
+        if tile is None or tile[row % self.tile_size, col % self.tile_size] != model.EMPTY_CODE:
+            raise ValueError("Pedestrian at " + str([row, col]) + " is not on a walkable cell")
+        self.pedestrians.append((row, col, speed))
+
+    def occupancy(self):
+        """
+        Returns which tiles are allocated.
+        :return: (tile rows, tile cols) boolean array
+        """
+        size = self.tile_size
+        occupied = np.zeros((-(-self.rows // size), -(-self.cols // size)), dtype=bool)
+        for tile_row, tile_col in self.tiles:
+            occupied[tile_row, tile_col] = True
+        return occupied
+
+    def get_parts(self):
+        """
+        Cuts the venue along bands of void tiles, again and again, until no part can be cut any more.
+        A part that has no such band is cut along the tile row or col get_split finds, if any, and cut again.
+        Long thin parts, which would leave most of a shelf empty, are finally cut into pieces as long as the side
+        of a square of the size of all parts together.
+        :return: list of (tile row, tile col, tile rows, tile cols) of every part
+        """
+        occupied = self.occupancy()
+        parts = []
+
+        def groups(used):
+            # Runs of used tile rows (or cols) separated by unused ones, as (start, stop)
+            used = np.flatnonzero(used)
+            breaks = np.flatnonzero(np.diff(used) > 1)
+            return list(zip(used[np.concatenate([[0], breaks + 1])], used[np.concatenate([breaks, [-1]])] + 1))
+
+        def cut(top, left, bottom, right):
+            box = occupied[top:bottom, left:right]
+            row_groups = groups(box.any(axis=1))
+            col_groups = groups(box.any(axis=0))
+            if len(row_groups) > 1:
+                for start, stop in row_groups:
+                    cut(top + start, left, top + stop, right)
+            elif len(col_groups) > 1:
+                for start, stop in col_groups:
+                    cut(top, left + start, bottom, left + stop)
+            elif row_groups:
+                (row_start, row_stop), (col_start, col_stop) = row_groups[0], col_groups[0]
+                top, left, bottom, right = top + row_start, left + col_start, top + row_stop, left + col_stop
+                split = get_split(occupied[top:bottom, left:right])
+                if split is None:
+                    parts.append((int(top), int(left), int(bottom - top), int(right - left)))
+                elif split[0] == 0:
+                    cut(top, left, top + split[1], right)
+                    cut(top + split[1], left, bottom, right)
+                else:
+                    cut(top, left, bottom, left + split[1])
+                    cut(top, left + split[1], bottom, right)
+
+        cut(0, 0, occupied.shape[0], occupied.shape[1])
+        side = max(int(np.sqrt(sum(rows * cols for _, _, rows, cols in parts))), 1)
+        thin = [max(rows, cols) > max(side, MAX_ASPECT * min(rows, cols)) for _, _, rows, cols in parts]
+        long_parts = [part for part, is_thin in zip(parts, thin) if is_thin]
+        parts[:] = [part for part, is_thin in zip(parts, thin) if not is_thin]
+        for top, left, rows, cols in long_parts:
+            for row in range(top, top + rows, side):
+                for col in range(left, left + cols, side):
+                    cut(row, col, min(row + side, top + rows), min(col + side, left + cols))
+        return parts
+
+    def pack(self, r_max=model.R_MAX):
+        """
+        Builds the System of the venue from its parts, see the module docstring.
+        A part gets pad cells of room for its halo on every side where it meets another part.
+        :param r_max: range of the pedestrian repulsion the System will use
+        :return: model.System, TileLayout
+        """
+        size = self.tile_size
+        pad = max(r_max, 2)
+        if size <= pad:
+            raise ValueError("Tiles of " + str(size) + " cells are too small to separate parts for r_max "
+                             + str(r_max))
+        parts = []
+        for tile_row, tile_col, tile_rows, tile_cols in self.get_parts():
+            row, col = tile_row * size, tile_col * size
+            parts.append((row, col, min(tile_rows * size, self.rows - row), min(tile_cols * size, self.cols - col)))
+        margins = get_margins(parts, pad)
+        shapes = [(height + top + bottom, width + left + right)
+                  for (_, _, height, width), (top, bottom, left, right) in zip(parts, margins)]
+        positions = [(row + margin[0], col + margin[2])
+                     for (row, col), margin in zip(get_shelf_positions(shapes, pad), margins)]
+        layout = TileLayout(parts, positions, (self.rows, self.cols), pad)
+        rows = max((row + part[2] + margin[1] for (row, _), part, margin in zip(positions, parts, margins)), default=0)
+        cols = max((col + part[3] + margin[3] for (_, col), part, margin in zip(positions, parts, margins)), default=0)
+
+        state = np.full((rows, cols), model.OBSTACLE_CODE, dtype=np.int8)
+        for (tile_row, tile_col), tile in self.tiles.items():
+            top, left = tile_row * size, tile_col * size
+            part = layout.find_parts(top, left)
+            part_row, part_col, part_height, part_width = parts[part]
+            # Tiles at the edge of the venue are cut off by it
+            height = min(size, part_row + part_height - top)
+            width = min(size, part_col + part_width - left)
+            row = positions[part][0] + top - part_row
+            col = positions[part][1] + left - part_col
+            state[row:row + height, col:col + width] = tile[:height, :width]
+
+        system = model.System(cols, rows)
+        system.r_max = r_max
+        system.layout = layout
+        system.links = layout.get_links(rows, cols)
+        system.add_obstacles(state == model.OBSTACLE_CODE)
+        target_rows, target_cols = layout.to_packed(*np.array(self.targets, dtype=np.intp).reshape(-1, 2).T)
+        for row, col in zip(target_rows.tolist(), target_cols.tolist()):
+            system.add_target_at((row, col))
+        pedestrians = np.array(self.pedestrians, dtype=np.double).reshape(-1, 3)
+        ped_rows, ped_cols = layout.to_packed(pedestrians[:, 0].astype(np.intp), pedestrians[:, 1].astype(np.intp))
+        for row, col, speed in zip(ped_rows.tolist(), ped_cols.tolist(), pedestrians[:, 2].tolist()):
+            system.add_pedestrian_at((row, col), speed)
+        return system, layout
+
+    def allocated_cells(self):
+        return len(self.tiles) * self.tile_size * self.tile_size
+
+
+def get_split(box):
+    """
+    Finds where to cut a part in two: the tile row or col whose two sides have the smallest bounding boxes,
+    if those cover less than SPLIT_FRACTION of the part's box.
+    :param box: (tile rows, tile cols) boolean array of the allocated tiles of the part, its first and last
+                tile row and col hold allocated tiles
+    :return: (axis, index) to cut before tile row (axis 0) or tile col (axis 1) index, None if no cut is worth it
+    """
+    best, best_area = None, box.size * SPLIT_FRACTION
+    for axis, lines in ((0, box), (1, box.T)):
+        areas = get_split_areas(lines)
+        if len(areas) and areas.min() < best_area:
+            best, best_area = (axis, int(np.argmin(areas)) + 1), areas.min()
+    return best
+
+
+def get_split_areas(box):
+    """
+    Returns the tiles of the bounding boxes of both sides of every cut between two tile rows of a part, added up.
+    :param box: see get_split
+    :return: integer array, the first entry for the cut before the second tile row
+    """
+    lines = np.arange(len(box))
+    used = box.any(axis=1)
+    first = np.minimum.accumulate(np.where(used, lines, len(box))[::-1])[::-1]  # First used row from here on
+    last = np.maximum.accumulate(np.where(used, lines, -1))  # Last used row up to here
+    above = np.logical_or.accumulate(box, axis=0)[:-1]
+    below = np.logical_or.accumulate(box[::-1], axis=0)[::-1][1:]
+    return (last[:-1] + 1) * get_spans(above) + (len(box) - first[1:]) * get_spans(below)
+
+
+def get_spans(used):
+    """
+    Returns how many cols lie from the first to the last used col of every row, the row must have one.
+    :param used: 2d boolean array
+    :return: integer array
+    """
+    return used.shape[1] - np.argmax(used[:, ::-1], axis=1) - np.argmax(used, axis=1)
+
+
+def get_margins(parts, pad):
+    """
+    Returns the room every part needs around it in the System for its halo:
+    pad cells on every side where another part of the venue lies within pad cells, none on the others.
+    :param parts: list of (row, col, height, width) of the venue
+    :param pad:
+    :return: list of (top, bottom, left, right)
+    """
+    margins = []
+    for row, col, height, width in parts:
+        bands = ((row - pad, col - pad, pad, width + 2 * pad), (row + height, col - pad, pad, width + 2 * pad),
+                 (row - pad, col - pad, height + 2 * pad, pad), (row - pad, col + width, height + 2 * pad, pad))
+        margins.append(tuple(pad if any(overlaps(band, other) for other in parts) else 0 for band in bands))
+    return margins
+
+
+def overlaps(first, second):
+    return (first[0] < second[0] + second[2] and second[0] < first[0] + first[2]
+            and first[1] < second[1] + second[3] and second[1] < first[1] + first[3])
+
+
+def get_shelf_positions(shapes, pad):
+    """
+    Places rectangles on shelves: from the tallest down, side by side until a shelf is as wide as the widest
+    rectangle or the square root of their total area, whichever is more, then on a new shelf below.
+    Rectangles are pad cells apart.
+    :param shapes: list of (height, width)
+    :param pad: cells between two rectangles
+    :return: list of (row, col) of every rectangle
+    """
+    if not shapes:
+        return []
+    width = max(max(shape[1] for shape in shapes), int(np.sqrt(sum(height * width for height, width in shapes))))
+    positions = [None] * len(shapes)
+    row = col = shelf_height = 0
+    for number in sorted(range(len(shapes)), key=lambda number: -shapes[number][0]):
+        height, part_width = shapes[number]
+        if col > 0 and col + part_width > width:
+            row += shelf_height + pad
+            col = shelf_height = 0
+        positions[number] = (row, col)
+        col += part_width + pad
+        shelf_height = max(shelf_height, height)
+    return positions
+
+
+def get_tile_map(data):
+    """
+    Builds the venue of a scenario with "tile_size". Its walkable area is given as "walkable_rectangles"
+    (list of [row, col, height, width]) and "walkable_runs" (list of [row, col, length] runs along a row),
+    all other cells are void. "obstacles", "obstacle_rectangles" and "obstacle_runs" block walkable cells.
+    Pedestrians take their speed from "speeds", 1 for those it does not list.
+    :param data: scenario dictionary
+    :return: TileMap
+    """
+    tile_map = TileMap(data['rows'], data['cols'], data['tile_size'])
+    for row, col, height, width in data.get('walkable_rectangles', []):
+        tile_map.add_walkable(row, col, height, width)
+    for row, col, length in data.get('walkable_runs', []):
+        tile_map.add_walkable(row, col, 1, length)
+    for row, col in data.get('obstacles', []):
+        tile_map.add_obstacles(row, col, 1, 1)
+    for row, col, height, width in data.get('obstacle_rectangles', []):
+        tile_map.add_obstacles(row, col, height, width)
+    for row, col, length in data.get('obstacle_runs', []):
+        tile_map.add_obstacles(row, col, 1, length)
+    targets = data['targets'] if 'targets' in data else [data['target']]
+    for row, col in targets:
+        tile_map.add_target_at(row, col)
+    pedestrians = data.get('pedestrians', [])
+    speeds = list(data.get('speeds', []))
+    speeds += [1] * (len(pedestrians) - len(speeds))  # As System.initialize_speeds does
+    for (row, col), speed in zip(pedestrians, speeds):
+        tile_map.add_pedestrian_at(row, col, speed)
+    return tile_map